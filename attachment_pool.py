@@ -0,0 +1,210 @@
+"""
+One attachment worker pool for the whole app.
+
+Every chat tab (and every server or batch session) submits its attachment
+jobs here instead of running them on its own threads. The pool runs up to
+`max_workers` jobs at once (one per core), but only the cores a CPU-mode
+Ollama leaves free while a session is generating in CPU mode, so
+preprocessing never starves inference; GPU-mode and idle sessions leave all
+cores to it. Jobs of the focused tab run first; the rest run oldest first.
+CPU-bound steps such as PDF text extraction are handed to a process pool
+from inside a job, so they use real cores without holding the GIL, and
+helpers a job starts (the folder walker's readers) borrow slots from the
+same budget.
+"""
+import multiprocessing
+import os
+import threading
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from contextlib import contextmanager
+
+from config import ATTACHMENT_POOL_WORKERS, ATTACHMENT_POOL_MAX_PENDING
+from ollama_client import cpu_inference_threads
+
+
+def default_worker_count(cpu_inference: bool = False) -> int:
+    """Jobs that may run at once: every core, or those a CPU-mode Ollama leaves free (at least one)."""
+    if ATTACHMENT_POOL_WORKERS:
+        return ATTACHMENT_POOL_WORKERS
+    cores = os.cpu_count() or 1
+    return max(1, cores - cpu_inference_threads()) if cpu_inference else cores
+
+
+class AttachmentPool:
+    """
+    A bounded, prioritized job pool. `submit()` returns a Future, or None when
+    `max_pending` jobs are already waiting (the caller should refuse the
+    attachment rather than queue without limit).
+    """
+    def __init__(self, max_workers: int | None = None, max_pending: int = ATTACHMENT_POOL_MAX_PENDING):
+        self.max_workers = max_workers or default_worker_count()
+        # While a CPU-mode reply is generating, only the cores Ollama leaves free are used
+        self.cpu_inference_workers = max_workers or min(self.max_workers, default_worker_count(cpu_inference=True))
+        self.max_pending = max_pending
+
+        self._cond = threading.Condition()
+        self._queues = {} # owner -> deque of (sequence, future, fn, args)
+        self._sequence = 0
+        self._pending = 0
+        self._running = 0       # Jobs running plus slots borrowed by them
+        self._cpu_inference = 0 # CPU-mode replies being generated right now
+        self._focus = None
+
+        self._process_pool = None
+        self._process_pool_failed = False
+        self._process_lock = threading.Lock()
+
+        for i in range(self.max_workers):
+            threading.Thread(target=self._worker, name=f"attachment-{i}", daemon=True).start()
+
+    # --- Scheduling ---
+
+    def submit(self, owner, fn, *args) -> Future | None:
+        with self._cond:
+            if self._pending >= self.max_pending:
+                return None
+            future = Future()
+            self._sequence += 1
+            job = (self._sequence, future, fn, args)
+            self._queues.setdefault(owner, deque()).append(job)
+            self._pending += 1
+            self._cond.notify()
+        future.add_done_callback(lambda f: f.cancelled() and self._drop_cancelled(owner, job))
+        return future
+
+    def _drop_cancelled(self, owner, job):
+        # A job cancelled while waiting stops counting toward max_pending at once
+        with self._cond:
+            queue = self._queues.get(owner)
+            if queue is None or job not in queue:
+                return # Already taken by a worker (or forgotten)
+            queue.remove(job)
+            if not queue:
+                del self._queues[owner]
+            self._pending -= 1
+
+    def _limit(self) -> int:
+        """Slots usable right now. Caller holds the lock."""
+        return self.cpu_inference_workers if self._cpu_inference else self.max_workers
+
+    @contextmanager
+    def cpu_inference(self):
+        """Wrap a CPU-mode generation: while it runs, jobs only use the cores Ollama leaves free."""
+        with self._cond:
+            self._cpu_inference += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._cpu_inference -= 1
+                self._cond.notify_all()
+
+    @contextmanager
+    def extra_workers(self, wanted: int):
+        """
+        Called from inside a job that wants helper threads: lends it up to
+        `wanted` free slots (possibly none) and yields how many it got.
+        """
+        with self._cond:
+            granted = max(0, min(wanted, self._limit() - self._running))
+            self._running += granted
+        try:
+            yield granted
+        finally:
+            with self._cond:
+                self._running -= granted
+                self._cond.notify_all()
+
+    def set_focus(self, owner):
+        """Jobs of `owner` (e.g. the visible tab's session) jump the queue."""
+        with self._cond:
+            self._focus = owner
+
+    def forget(self, owner):
+        """Cancels every job `owner` still has waiting (e.g. its tab was closed)."""
+        with self._cond:
+            jobs = self._queues.pop(owner, ())
+            self._pending -= len(jobs)
+        for _, future, _, _ in jobs:
+            future.cancel()
+
+    def _next_job(self):
+        """Pops the focused owner's oldest job, else the oldest job overall. Caller holds the lock."""
+        queue = self._queues.get(self._focus)
+        owner = self._focus
+        if not queue:
+            owner, queue = min(self._queues.items(), key=lambda item: item[1][0][0])
+        job = queue.popleft()
+        if not queue:
+            del self._queues[owner]
+        self._pending -= 1
+        return job
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._queues or self._running >= self._limit():
+                    self._cond.wait()
+                _, future, fn, args = self._next_job()
+                self._running += 1
+            try:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(fn(*args))
+                    except BaseException as e:
+                        future.set_exception(e)
+            finally:
+                with self._cond:
+                    self._running -= 1
+                    self._cond.notify_all()
+            # Don't keep the last job's payload alive while idle
+            del future, fn, args
+
+    # --- CPU-bound Steps ---
+
+    def run_in_process(self, fn, *args):
+        """
+        Runs a picklable, module-level `fn` in the process pool and waits for
+        it. Called from inside a job, so it still counts against max_workers.
+        Falls back to running `fn` in the calling thread if processes can't start.
+        """
+        pool = self._get_process_pool()
+        if pool is None:
+            return fn(*args)
+        try:
+            return pool.submit(fn, *args).result()
+        except Exception as e:
+            # BrokenProcessPool or a pickling error: do the work here instead
+            print(f"Attachment process pool failed, running in-process: {e}")
+            return fn(*args)
+
+    def _get_process_pool(self) -> ProcessPoolExecutor | None:
+        with self._process_lock:
+            if self._process_pool is None and not self._process_pool_failed:
+                try:
+                    # 'spawn' keeps forked children clear of Tk and the app's threads
+                    context = multiprocessing.get_context("spawn")
+                    self._process_pool = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=context)
+                except (OSError, ValueError, NotImplementedError) as e:
+                    print(f"Error starting attachment process pool, using threads only: {e}")
+                    self._process_pool_failed = True
+            return self._process_pool
+
+    def shutdown(self):
+        with self._process_lock:
+            if self._process_pool is not None:
+                self._process_pool.shutdown(wait=False, cancel_futures=True)
+                self._process_pool = None
+
+
+_shared_pool = None
+_shared_pool_lock = threading.Lock()
+
+def get_attachment_pool() -> AttachmentPool:
+    """Returns the process-wide attachment pool shared by every session."""
+    global _shared_pool
+    with _shared_pool_lock:
+        if _shared_pool is None:
+            _shared_pool = AttachmentPool()
+        return _shared_pool
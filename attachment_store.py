@@ -0,0 +1,90 @@
+"""
+Content-addressed store for prepared attachments, shared by every session.
+
+The same screenshot or PDF attached in several tabs (or several turns) is
+prepared once and held once: sessions and history messages keep a
+StoredAttachment handle, and identical content maps to the same handle.
+Entries are weakly referenced, so an attachment's memory is freed as soon
+as no pending attachment or history message refers to it any more.
+"""
+import hashlib
+import threading
+import weakref
+
+HASH_BLOCK_BYTES = 1024 * 1024
+
+
+class StoredAttachment:
+    """A handle to one prepared attachment. Treat it as immutable."""
+    __slots__ = ('digest', 'image', 'context', 'thumbnail', 'note', '__weakref__')
+
+    def __init__(self, digest: str | None, image: bytes | None = None, context: str | None = None,
+                 thumbnail=None, note: str | None = None):
+        self.digest = digest
+        self.image = image         # Encoded image bytes sent to the model
+        self.context = context     # Text context (file contents, extracted PDF text)
+        self.thumbnail = thumbnail # Small PIL image for the sidebar
+        self.note = note           # Shown after the file name when attached, e.g. what was sampled
+
+    @property
+    def size(self) -> int:
+        return len(self.image or b'') + len((self.context or '').encode('utf-8'))
+
+
+def digest_bytes(data: bytes, kind: str = '') -> str:
+    """Content key for in-memory data; `kind` separates e.g. raw pixels from file bytes."""
+    digest = hashlib.sha256(kind.encode('utf-8'))
+    digest.update(data)
+    return digest.hexdigest()
+
+
+def digest_file(path: str, kind: str = '') -> str:
+    digest = hashlib.sha256(kind.encode('utf-8'))
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_BYTES), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class AttachmentStore:
+    """digest -> StoredAttachment, kept only while something still holds the handle."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = weakref.WeakValueDictionary()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, digest: str) -> StoredAttachment | None:
+        with self._lock:
+            handle = self._entries.get(digest)
+            if handle is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return handle
+
+    def put(self, handle: StoredAttachment) -> StoredAttachment:
+        """Adds a handle; if another thread stored the same content first, returns that one."""
+        with self._lock:
+            existing = self._entries.get(handle.digest)
+            if existing is not None:
+                return existing
+            self._entries[handle.digest] = handle
+            return handle
+
+    def stats(self) -> dict:
+        with self._lock:
+            handles = list(self._entries.values())
+        return {
+            'entries': len(handles),
+            'bytes': sum(h.size for h in handles),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+_shared_store = AttachmentStore()
+
+def get_attachment_store() -> AttachmentStore:
+    """Returns the process-wide store shared by every session."""
+    return _shared_store
@@ -0,0 +1,272 @@
+"""
+CPU inference auto-tuner.
+
+Runs short calibration generations per model and measures prompt-eval and
+decode speed (tokens/s, from the server's own counters) for different
+num_thread, num_batch and num_ctx values. The fastest settings are saved as
+a profile per (host, model) and used by execute_ollama_call for CPU-mode
+requests from then on.
+
+The search is staged rather than a full grid: threads first (the biggest
+effect), then the batch size with the best thread count, then the context
+size. Each candidate gets a warm-up call (option changes make Ollama reload
+the model) and is then measured AUTOTUNE_REPEATS times; the median counts.
+
+Example:
+    python autotune.py gemma3:1b llama3.2:3b
+    python autotune.py gemma3:1b --host http://10.0.0.5:11434
+    python autotune.py --stub gemma3:1b    # dry run against the stand-in server
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import threading
+import time
+from urllib.parse import urlparse
+
+import ollama
+
+from config import (
+    AUTOTUNE_PROFILE_PATH, AUTOTUNE_USE_PROFILES, AUTOTUNE_REPEATS,
+    AUTOTUNE_PROMPT_WORDS, AUTOTUNE_PREDICT_TOKENS, AUTOTUNE_BATCH_SIZES, AUTOTUNE_CONTEXT_SIZES
+)
+
+# A typical turn, used to weigh prompt speed against decode speed
+_REFERENCE_PROMPT_TOKENS = 512
+_REFERENCE_REPLY_TOKENS = 128
+# Candidates within this margin of the best are treated as ties
+_TIE_MARGIN = 0.03
+
+_CALIBRATION_WORDS = (
+    "measure how quickly the local model reads this passage about rivers mountains "
+    "libraries engines gardens harbors and clocks then continue the story briefly"
+).split()
+
+
+# --- Profile Store ---
+
+_profiles_lock = threading.Lock()
+_profiles_cache = {'mtime': None, 'data': {}}
+
+
+def host_key(host: str | None) -> str:
+    """Profiles belong to the machine running Ollama: local hosts map to this machine's name."""
+    if not host:
+        return f"local:{platform.node()}"
+    parsed = urlparse(host if "://" in host else f"http://{host}")
+    if parsed.hostname in (None, "localhost", "127.0.0.1", "::1", "0.0.0.0"):
+        return f"local:{platform.node()}"
+    return f"{parsed.hostname}:{parsed.port or 11434}"
+
+
+def client_host(client) -> str | None:
+    """Base URL of an ollama.Client (None for a BackendPool, or if it can't be determined)."""
+    base_url = getattr(getattr(client, '_client', None), 'base_url', None)
+    return str(base_url) if base_url else None
+
+
+def _load_profiles() -> dict:
+    """Reads the profile file, re-reading it only when it changed on disk."""
+    with _profiles_lock:
+        try:
+            mtime = os.path.getmtime(AUTOTUNE_PROFILE_PATH)
+        except OSError:
+            return {}
+        if mtime != _profiles_cache['mtime']:
+            try:
+                with open(AUTOTUNE_PROFILE_PATH, 'r', encoding='utf-8') as f:
+                    _profiles_cache['data'] = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"Error reading tuning profiles: {e}")
+                _profiles_cache['data'] = {}
+            _profiles_cache['mtime'] = mtime
+        return _profiles_cache['data']
+
+
+def save_profile(host: str | None, model: str, profile: dict):
+    with _profiles_lock:
+        data = {}
+        if os.path.exists(AUTOTUNE_PROFILE_PATH):
+            try:
+                with open(AUTOTUNE_PROFILE_PATH, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                data = {}
+        data.setdefault(host_key(host), {})[model] = profile
+        os.makedirs(os.path.dirname(AUTOTUNE_PROFILE_PATH), exist_ok=True)
+        tmp_path = AUTOTUNE_PROFILE_PATH + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=2)
+        os.replace(tmp_path, AUTOTUNE_PROFILE_PATH)
+        _profiles_cache['mtime'] = None
+
+
+def get_tuned_options(host: str | None, model: str) -> dict:
+    """The stored CPU options for (host, model), or {} if it was never tuned."""
+    if not AUTOTUNE_USE_PROFILES:
+        return {}
+    profile = _load_profiles().get(host_key(host), {}).get(model)
+    return dict(profile['options']) if profile else {}
+
+
+# --- Calibration ---
+
+def _physical_cores() -> int | None:
+    """Physical core count on Linux (SMT siblings counted once), else None."""
+    try:
+        cores = set()
+        physical_id = core_id = None
+        with open('/proc/cpuinfo', 'r') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                key = key.strip()
+                if key == 'physical id':
+                    physical_id = value.strip()
+                elif key == 'core id':
+                    core_id = value.strip()
+                elif not key and core_id is not None:
+                    cores.add((physical_id, core_id))
+                    physical_id = core_id = None
+        if core_id is not None:
+            cores.add((physical_id, core_id))
+        return len(cores) or None
+    except OSError:
+        return None
+
+
+def thread_candidates() -> list:
+    """Thread counts worth trying: physical cores, logical cores, and a few in between."""
+    logical = os.cpu_count() or 4
+    physical = _physical_cores() or logical
+    candidates = {logical, max(1, logical - 2), physical, max(1, physical - 1), max(1, logical // 2)}
+    return sorted(candidates)
+
+
+def _calibration_prompt(rng: random.Random) -> str:
+    # A random lead word defeats Ollama's prompt cache, so every run evaluates the whole prompt
+    words = [f"run{rng.randrange(10**9)}"]
+    while len(words) < AUTOTUNE_PROMPT_WORDS:
+        words.append(rng.choice(_CALIBRATION_WORDS))
+    return " ".join(words)
+
+
+def _rate(count, duration_ns) -> float:
+    return count / (duration_ns / 1e9) if count and duration_ns else 0.0
+
+
+def measure(client, model: str, options: dict, repeats: int = AUTOTUNE_REPEATS,
+            rng: random.Random | None = None) -> dict:
+    """Median prompt-eval and decode tokens/s for one set of options."""
+    rng = rng or random.Random()
+    call_options = dict(options, num_gpu=0, num_predict=AUTOTUNE_PREDICT_TOKENS, temperature=0, seed=1)
+    prompt_rates, decode_rates = [], []
+    for run in range(repeats + 1):
+        response = client.chat(
+            model=model,
+            messages=[{'role': 'user', 'content': _calibration_prompt(rng)}],
+            stream=False,
+            options=call_options
+        )
+        if run == 0:
+            continue # Warm-up: includes any model reload caused by the new options
+        prompt_rates.append(_rate(response.get('prompt_eval_count'), response.get('prompt_eval_duration')))
+        decode_rates.append(_rate(response.get('eval_count'), response.get('eval_duration')))
+
+    prompt_tps = statistics.median(prompt_rates)
+    decode_tps = statistics.median(decode_rates)
+    # Seconds for a typical turn: the score to minimize
+    turn_time = (_REFERENCE_PROMPT_TOKENS / prompt_tps if prompt_tps else float('inf')) + \
+                (_REFERENCE_REPLY_TOKENS / decode_tps if decode_tps else float('inf'))
+    return {'prompt_tps': prompt_tps, 'decode_tps': decode_tps, 'turn_time': turn_time}
+
+
+def _best(results: list, prefer_larger: str | None = None) -> tuple:
+    """Picks the fastest (options, result); among near-ties, the largest `prefer_larger` value."""
+    fastest = min(result['turn_time'] for _, result in results)
+    ties = [(o, r) for o, r in results if r['turn_time'] <= fastest * (1 + _TIE_MARGIN)]
+    if prefer_larger:
+        return max(ties, key=lambda item: item[0][prefer_larger])
+    return min(ties, key=lambda item: item[1]['turn_time'])
+
+
+def tune_model(client, model: str, log=print) -> dict:
+    """Runs the staged search for one model and returns its profile."""
+    from ollama_client import cpu_inference_threads
+    rng = random.Random()
+
+    def run(options):
+        result = measure(client, model, options, rng=rng)
+        log(f"  {options}: prompt {result['prompt_tps']:.1f} tok/s, "
+            f"decode {result['decode_tps']:.1f} tok/s, turn {result['turn_time']:.2f} s")
+        return options, result
+
+    log(f"--- Tuning {model} ---")
+    baseline = run({'num_thread': cpu_inference_threads()})
+
+    # 1. Threads (with the server's default batch and context)
+    results = [baseline] + [run({'num_thread': n}) for n in thread_candidates() if n != cpu_inference_threads()]
+    best_options, best_result = _best(results)
+
+    # 2. Batch size with the best thread count
+    results = [(best_options, best_result)] + [
+        run(dict(best_options, num_batch=b)) for b in AUTOTUNE_BATCH_SIZES
+    ]
+    best_options, best_result = _best(results)
+
+    # 3. Context size: the largest one that is about as fast
+    results = [run(dict(best_options, num_ctx=c)) for c in AUTOTUNE_CONTEXT_SIZES]
+    best_options, best_result = _best(results, prefer_larger='num_ctx')
+
+    gain = baseline[1]['turn_time'] / best_result['turn_time'] - 1 if best_result['turn_time'] else 0.0
+    log(f"Best for {model}: {best_options} ({gain:+.0%} vs. the default num_thread)")
+    return {
+        'options': best_options,
+        'prompt_tps': round(best_result['prompt_tps'], 2),
+        'decode_tps': round(best_result['decode_tps'], 2),
+        'baseline': {
+            'options': baseline[0],
+            'prompt_tps': round(baseline[1]['prompt_tps'], 2),
+            'decode_tps': round(baseline[1]['decode_tps'], 2),
+        },
+        'measured_at': time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+
+# --- Main ---
+
+def main():
+    parser = argparse.ArgumentParser(description="Tune CPU inference options per model and save them.")
+    parser.add_argument("models", nargs="+", help="Models to tune (as named in Ollama).")
+    parser.add_argument("--host", default=None, help="Ollama URL (default: the local server).")
+    parser.add_argument("--stub", action="store_true",
+                        help="Tune against the local stand-in server (for trying the tool out).")
+    parser.add_argument("--dry-run", action="store_true", help="Measure but don't save profiles.")
+    args = parser.parse_args()
+
+    host = args.host
+    if args.stub:
+        from stub_server import start_stub_server, StubSettings
+        server = start_stub_server(settings=StubSettings(
+            prompt_rate=2000.0, decode_rate=200.0, models=args.models, cpu_cores=os.cpu_count()
+        ))
+        host = server.url
+        args.dry_run = True # The stand-in's speeds say nothing about this machine
+        print(f"Using stand-in server at {host} (profiles are not saved).")
+
+    client = ollama.Client(host=host)
+    for model in args.models:
+        try:
+            profile = tune_model(client, model)
+        except Exception as e:
+            print(f"[!!] Tuning {model} failed: {e} [!!]")
+            continue
+        if not args.dry_run:
+            save_profile(host, model, profile)
+            print(f"Saved profile for {model} ({host_key(host)}) to {AUTOTUNE_PROFILE_PATH}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,445 @@
+"""
+Several Ollama servers behind one client.
+
+BackendPool stands in for an ollama.Client (chat() and embed()), so any
+ChatSession, the server or batch mode can use it unchanged. It spreads
+requests over the endpoints in OLLAMA_ENDPOINTS (or a comma-separated
+--ollama-host list):
+
+* A background thread probes every endpoint's /api/ps (resident models) and
+  /api/tags (available models) every BACKEND_PROBE_INTERVAL seconds.
+* Each request goes to the least-loaded healthy endpoint that already has
+  the model loaded. If those are all busy (or none has it), it goes to the
+  least-loaded endpoint that can serve the model.
+* Connection failures mark an endpoint down for BACKEND_RETRY_AFTER seconds
+  and the request fails over to the next endpoint. A streamed reply only
+  fails over before its first chunk; after that the error propagates and
+  the caller's retry logic takes over.
+* With hedging on (HEDGE_ENABLED), a streamed reply whose first token is
+  later than HEDGE_PERCENTILE of the model's recent TTFTs is sent again to
+  another endpoint (or HEDGE_FALLBACK_MODELS' model). The first to stream
+  wins. The loser is dropped at its next chunk, which stops the generation
+  on its server. Hedges are capped at HEDGE_MAX_EXTRA_LOAD of requests.
+* Requests of one conversation (same model, system prompt and first
+  message) go back to the endpoint that served it last while it has a free
+  slot. Ollama only reuses the evaluated prompt prefix (its KV cache) on the
+  server that computed it, so a follow-up, a regenerated reply or a branch
+  off a long chat is not evaluated from scratch elsewhere.
+"""
+import hashlib
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+
+import ollama
+from ollama import ResponseError
+
+from config import (
+    OLLAMA_ENDPOINTS, BACKEND_PROBE_INTERVAL, BACKEND_PROBE_TIMEOUT, BACKEND_RETRY_AFTER,
+    HEDGE_ENABLED, HEDGE_PERCENTILE, HEDGE_MIN_DELAY, HEDGE_MIN_SAMPLES, HEDGE_TTFT_WINDOW,
+    HEDGE_MAX_EXTRA_LOAD, HEDGE_FALLBACK_MODELS
+)
+from autotune import get_tuned_options
+
+AFFINITY_ENTRIES = 4096 # Conversations remembered for routing back to their endpoint
+
+
+class _Endpoint:
+    def __init__(self, host: str, models: list | None = None, slots: int = 1, **client_kwargs):
+        self.host = host
+        self.models = set(models) if models else None # Configured; None = whatever /api/tags lists
+        self.slots = max(1, slots)                     # Requests it serves in parallel
+        self.available = set()                         # From /api/tags
+        self.resident = set()                          # From /api/ps
+        self.healthy = True                            # Optimistic until the first probe
+        self.down_until = 0.0
+        self.in_flight = 0
+        self.requests = 0
+        self.failures = 0
+        self.client = ollama.Client(host=host, **client_kwargs)
+        self.probe_client = ollama.Client(host=host, timeout=BACKEND_PROBE_TIMEOUT)
+
+    def serves(self, model: str) -> bool:
+        if self.models is not None:
+            return model in self.models
+        return not self.available or model in self.available # Not probed yet: worth a try
+
+    def load(self) -> float:
+        return self.in_flight / self.slots
+
+    def info(self) -> dict:
+        return {
+            'host': self.host, 'healthy': self.healthy, 'in_flight': self.in_flight,
+            'requests': self.requests, 'failures': self.failures,
+            'resident': sorted(self.resident),
+        }
+
+
+def _conversation_key(model: str, messages: list) -> str:
+    """Identifies a conversation by what every request in it starts with: model, system prompt, first message."""
+    digest = hashlib.sha1(model.encode('utf-8'))
+    for message in messages[:2]:
+        digest.update(b"\0" + str(message.get('content', '')).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def _is_connection_error(e: Exception) -> bool:
+    # ollama-python turns connect failures into ConnectionError; httpx errors cover timeouts/resets
+    return isinstance(e, (ConnectionError, OSError)) or type(e).__module__.startswith('httpx')
+
+
+class BackendPool:
+    """
+    Routes chat/embed calls across several Ollama endpoints. `endpoints` are
+    host URLs or dicts {'host', 'models'?, 'slots'?}; `client_kwargs` (e.g.
+    httpx limits) are passed to each endpoint's ollama.Client.
+    """
+    def __init__(self, endpoints: list, probe_interval: float = BACKEND_PROBE_INTERVAL,
+                 hedging: bool = HEDGE_ENABLED, **client_kwargs):
+        if not endpoints:
+            raise ValueError("BackendPool needs at least one endpoint.")
+        self.endpoints = []
+        for entry in endpoints:
+            if isinstance(entry, str):
+                entry = {'host': entry}
+            self.endpoints.append(_Endpoint(**entry, **client_kwargs))
+
+        self.probe_interval = probe_interval
+        self.hedging = hedging
+        self._ttfts = {} # model -> deque of recent first-chunk times (seconds)
+        self._hedge_stats = {'streams': 0, 'hedged': 0, 'hedge_wins': 0, 'over_budget': 0}
+        self._affinity = OrderedDict() # Conversation key -> endpoint that served it last (LRU)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        threading.Thread(target=self._probe_loop, name="backend-probe", daemon=True).start()
+
+    # --- Health Probes ---
+
+    def _probe_loop(self):
+        while not self._stop.is_set():
+            self.probe_all()
+            self._stop.wait(self.probe_interval)
+
+    def probe_all(self):
+        for endpoint in self.endpoints:
+            self.probe(endpoint)
+
+    def probe(self, endpoint: _Endpoint):
+        try:
+            resident = {m.model for m in endpoint.probe_client.ps().models}
+            available = {m.model for m in endpoint.probe_client.list().models} if endpoint.models is None else set()
+        except Exception as e:
+            self._mark_down(endpoint, e)
+            return
+        with self._lock:
+            endpoint.resident = resident
+            endpoint.available = available
+            if not endpoint.healthy:
+                print(f"Backend {endpoint.host} is back up.")
+            endpoint.healthy = True
+
+    def _mark_down(self, endpoint: _Endpoint, error: Exception):
+        with self._lock:
+            if endpoint.healthy:
+                print(f"Backend {endpoint.host} is unreachable ({error}); retrying in {BACKEND_RETRY_AFTER:.0f} secs.")
+            endpoint.healthy = False
+            endpoint.failures += 1
+            endpoint.down_until = time.monotonic() + BACKEND_RETRY_AFTER
+
+    def close(self):
+        self._stop.set()
+
+    def status(self) -> list:
+        with self._lock:
+            return [endpoint.info() for endpoint in self.endpoints]
+
+    def warm_models(self) -> set:
+        """Models loaded on a healthy endpoint with a free slot: a request for them evicts nothing."""
+        with self._lock:
+            return {
+                model for e in self.endpoints if e.healthy and e.load() < 1
+                for model in e.resident
+            }
+
+    # --- Routing ---
+
+    def _acquire(self, model: str, exclude: set, conversation: str | None = None) -> _Endpoint:
+        """Picks an endpoint for `model` and counts the request against it."""
+        now = time.monotonic()
+        with self._lock:
+            candidates = [
+                e for e in self.endpoints
+                if e not in exclude and e.serves(model) and (e.healthy or now >= e.down_until)
+            ]
+            if not candidates:
+                raise ConnectionError(f"No reachable Ollama endpoint serves model '{model}'.")
+            # A free slot first, then the endpoint holding the conversation's prompt cache, then the
+            # model already loaded, then least loaded / least used. Once every endpoint with the
+            # model is busy, loading it elsewhere beats queuing.
+            cached = self._affinity.get(conversation)
+            endpoint = min(candidates, key=lambda e: (
+                e.load() >= 1, e is not cached, model not in e.resident, e.load(), e.requests
+            ))
+            endpoint.in_flight += 1
+            endpoint.requests += 1
+            endpoint.resident.add(model) # It is loaded there now (or about to be)
+            return endpoint
+
+    def _release(self, endpoint: _Endpoint):
+        with self._lock:
+            endpoint.in_flight -= 1
+
+    def _remember(self, conversation: str | None, endpoint: _Endpoint):
+        """Records that `endpoint` now holds the conversation's prompt cache."""
+        if conversation is None:
+            return
+        with self._lock:
+            self._affinity[conversation] = endpoint
+            self._affinity.move_to_end(conversation)
+            if len(self._affinity) > AFFINITY_ENTRIES:
+                self._affinity.popitem(last=False)
+
+    def _handle_failure(self, endpoint: _Endpoint, model: str, error: Exception) -> bool:
+        """Records a failed attempt. Returns True if another endpoint should be tried."""
+        if _is_connection_error(error):
+            self._mark_down(endpoint, error)
+            return True
+        if isinstance(error, ResponseError):
+            if error.status_code == 404:
+                with self._lock:
+                    endpoint.available.discard(model)
+                    endpoint.resident.discard(model)
+                return True
+            if error.status_code >= 500:
+                with self._lock:
+                    endpoint.failures += 1
+                return True
+        return False
+
+    def _options_for(self, endpoint: _Endpoint, model: str, options: dict | None) -> dict | None:
+        # CPU-mode requests get the tuning profile of the machine they land on
+        if options and options.get('num_gpu') == 0:
+            options = dict(options)
+            options.update(get_tuned_options(endpoint.host, model))
+        return options
+
+    def _call(self, model: str, request, conversation: str | None = None):
+        tried = set()
+        while True:
+            endpoint = self._acquire(model, tried, conversation)
+            try:
+                response = request(endpoint)
+                self._remember(conversation, endpoint)
+                return response
+            except Exception as e:
+                if not self._handle_failure(endpoint, model, e):
+                    raise
+                tried.add(endpoint)
+            finally:
+                self._release(endpoint)
+
+    def _stream_chat(self, model: str, messages: list, options: dict | None, kwargs: dict,
+                     exclude: tuple = (), attempt: dict | None = None):
+        tried = set(exclude)
+        conversation = _conversation_key(model, messages)
+        while True:
+            endpoint = self._acquire(model, tried, conversation)
+            if attempt is not None:
+                attempt['endpoint'] = endpoint
+            response = None
+            started = False
+            try:
+                response = endpoint.client.chat(
+                    model=model, messages=messages, stream=True,
+                    options=self._options_for(endpoint, model, options), **kwargs
+                )
+                for chunk in response:
+                    if not started and attempt is None:
+                        self._remember(conversation, endpoint) # Hedged streams record only the winner
+                    started = True
+                    yield chunk
+                return
+            except Exception as e:
+                if started or not self._handle_failure(endpoint, model, e):
+                    raise
+                tried.add(endpoint)
+            finally:
+                if response is not None:
+                    response.close() # Drops the connection if the caller stopped early
+                self._release(endpoint)
+
+    # --- Hedging ---
+
+    def _hedge_delay(self, model: str) -> float | None:
+        """Seconds to wait for the first chunk before hedging, or None while there is too little history."""
+        with self._lock:
+            samples = sorted(self._ttfts.get(model, ()))
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return None
+        index = min(len(samples) - 1, int(len(samples) * HEDGE_PERCENTILE / 100))
+        return max(HEDGE_MIN_DELAY, samples[index])
+
+    def _record_ttft(self, model: str, ttft: float):
+        with self._lock:
+            self._ttfts.setdefault(model, deque(maxlen=HEDGE_TTFT_WINDOW)).append(ttft)
+
+    def _has_candidate(self, model: str, exclude: tuple) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            return any(
+                e not in exclude and e.serves(model) and (e.healthy or now >= e.down_until)
+                for e in self.endpoints
+            )
+
+    def _hedge_target(self, model: str, primary: dict) -> tuple | None:
+        """
+        (model, excluded endpoints) for a hedge, or None if the budget or the
+        backends don't allow one. A hedge returned here is already counted.
+        """
+        with self._lock:
+            # Counting the hedge about to start keeps the rate at or below the cap, not just past it
+            if self._hedge_stats['hedged'] + 1 > HEDGE_MAX_EXTRA_LOAD * self._hedge_stats['streams']:
+                self._hedge_stats['over_budget'] += 1
+                return None
+            self._hedge_stats['hedged'] += 1
+        exclude = (primary['endpoint'],) if primary.get('endpoint') else ()
+        if self._has_candidate(model, exclude):
+            return model, exclude
+        fallback = HEDGE_FALLBACK_MODELS.get(model)
+        if fallback and self._has_candidate(fallback, ()):
+            return fallback, ()
+        with self._lock:
+            self._hedge_stats['hedged'] -= 1
+        return None
+
+    def _start_attempt(self, model: str, messages: list, options: dict | None, kwargs: dict,
+                       events: queue.Queue, exclude: tuple = (), started: float | None = None) -> dict:
+        """
+        Streams one attempt on a thread, posting (attempt, chunk | None | error)
+        to `events`. With `started`, the time from then to the first chunk is
+        recorded as the model's TTFT, even if another attempt won meanwhile.
+        """
+        attempt = {'model': model, 'endpoint': None, 'cancel': threading.Event()}
+
+        def run():
+            stream = self._stream_chat(model, messages, options, kwargs, exclude, attempt)
+            first = True
+            try:
+                for chunk in stream:
+                    if first and started is not None:
+                        # A slow primary's TTFT is what hedging is about; leaving it out
+                        # when the hedge wins would drag the trigger down over time
+                        self._record_ttft(model, time.perf_counter() - started)
+                    first = False
+                    if attempt['cancel'].is_set():
+                        break
+                    events.put((attempt, chunk))
+                events.put((attempt, None))
+            except Exception as e:
+                events.put((attempt, e))
+            finally:
+                stream.close()
+
+        threading.Thread(target=run, name="backend-hedge", daemon=True).start()
+        return attempt
+
+    def _hedged_stream(self, model: str, messages: list, options: dict | None, kwargs: dict):
+        events = queue.Queue()
+        start = time.perf_counter()
+        delay = self._hedge_delay(model)
+        with self._lock:
+            self._hedge_stats['streams'] += 1
+
+        primary = self._start_attempt(model, messages, options, kwargs, events, started=start)
+        attempts = [primary]
+        finished = 0
+        try:
+            # Wait for the first chunk, hedging once if it is late
+            while True:
+                timeout = None
+                if delay is not None and len(attempts) == 1:
+                    timeout = max(0.0, start + delay - time.perf_counter())
+                try:
+                    attempt, item = events.get(timeout=timeout)
+                except queue.Empty:
+                    delay = None
+                    target = self._hedge_target(model, primary)
+                    if target is not None:
+                        attempts.append(self._start_attempt(target[0], messages, options, kwargs, events, target[1]))
+                    continue
+                if isinstance(item, Exception):
+                    finished += 1
+                    if finished == len(attempts):
+                        raise item
+                    continue # The other attempt may still succeed
+                winner = attempt
+                break
+
+            for attempt in attempts:
+                if attempt is not winner:
+                    attempt['cancel'].set()
+            if winner is not primary:
+                with self._lock:
+                    self._hedge_stats['hedge_wins'] += 1
+            self._remember(_conversation_key(winner['model'], messages), winner['endpoint'])
+
+            # Then relay the winner's stream
+            while item is not None:
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+                attempt, item = events.get()
+                while attempt is not winner:
+                    attempt, item = events.get()
+        finally:
+            for attempt in attempts:
+                attempt['cancel'].set()
+
+    def hedge_stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._hedge_stats)
+        stats['hedge_rate'] = stats['hedged'] / stats['streams'] if stats['streams'] else 0.0
+        stats['win_rate'] = stats['hedge_wins'] / stats['hedged'] if stats['hedged'] else 0.0
+        return stats
+
+    # --- ollama.Client Interface ---
+
+    def chat(self, model: str, messages: list, stream: bool = False, options: dict | None = None, **kwargs):
+        if stream and self.hedging:
+            return self._hedged_stream(model, messages, options, kwargs)
+        if stream:
+            return self._stream_chat(model, messages, options, kwargs)
+        return self._call(model, lambda e: e.client.chat(
+            model=model, messages=messages, stream=False,
+            options=self._options_for(e, model, options), **kwargs
+        ), _conversation_key(model, messages))
+
+    def embed(self, model: str, input, **kwargs):
+        return self._call(model, lambda e: e.client.embed(model=model, input=input, **kwargs))
+
+
+_shared_pool = None
+_shared_pool_lock = threading.Lock()
+
+def get_backend_pool() -> BackendPool | None:
+    """Returns the pool built from OLLAMA_ENDPOINTS, or None if none are configured."""
+    global _shared_pool
+    if not OLLAMA_ENDPOINTS:
+        return None
+    with _shared_pool_lock:
+        if _shared_pool is None:
+            _shared_pool = BackendPool(OLLAMA_ENDPOINTS)
+        return _shared_pool
+
+
+def make_client(host: str | None = None, **client_kwargs):
+    """
+    The backend client to use: a BackendPool for a comma-separated host list
+    (or, with no host given, for OLLAMA_ENDPOINTS), else a plain ollama.Client.
+    """
+    if host and ',' in host:
+        return BackendPool([h.strip() for h in host.split(',') if h.strip()], **client_kwargs)
+    if not host and OLLAMA_ENDPOINTS:
+        return BackendPool(OLLAMA_ENDPOINTS, **client_kwargs) if client_kwargs else get_backend_pool()
+    return ollama.Client(host=host, **client_kwargs)
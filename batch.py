@@ -0,0 +1,229 @@
+"""
+Batch offline processing (python main.py --batch jobs.jsonl --output results.jsonl).
+
+Each line of the jobs file is a JSON object:
+    {"id": "q1", "prompt": "Summarize this", "model": "gemma3:4b",
+     "persona": "Python Expert", "attachments": ["docs/a.pdf"], "use_gpu": false,
+     "options": {"temperature": 0}}
+
+Only "prompt" (or attachments) and "model" are required. A job may use
+"for_each": "docs/*.pdf" (a glob or a directory) instead of attachments to
+fan out into one job per matching file, e.g. "summarize each PDF".
+
+Jobs are grouped by model so each model is loaded once, and each group runs
+with bounded parallelism through the normal ChatSession path. Every result
+is appended to the output file as soon as it finishes; re-running the same
+command skips jobs that already succeeded, so interrupted runs resume.
+"""
+import glob
+import json
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from config import PERSONAS, VLM_MODELS, VLM_PREFIX, LLM_PREFIX, DEFAULT_SYSTEM_PROMPT
+from backend_pool import make_client
+from chat_session import ChatSession
+
+DEFAULT_BATCH_WORKERS = 2
+
+
+def _glob_root(pattern: str) -> str:
+    """The directory a glob starts from: its components up to the first wildcard."""
+    parts = []
+    for part in os.path.normpath(pattern).split(os.sep):
+        if glob.has_magic(part):
+            break
+        parts.append(part)
+    root = os.sep.join(parts) or "."
+    return os.path.dirname(root) if os.path.isfile(root) else root
+
+
+def _expand_for_each(pattern: str) -> list:
+    """
+    (path, name) for each file matching `pattern`. The name is the path
+    relative to the glob root, so same-named files in different folders of a
+    recursive glob stay apart.
+    """
+    if os.path.isdir(pattern):
+        root = pattern
+        paths = [os.path.join(pattern, name) for name in os.listdir(pattern)]
+    else:
+        root = _glob_root(pattern)
+        paths = glob.glob(pattern, recursive=True)
+    return [
+        (path, os.path.relpath(path, root).replace(os.sep, "/"))
+        for path in sorted(p for p in paths if os.path.isfile(p))
+    ]
+
+
+def load_jobs(jobs_path: str) -> list:
+    """Reads and normalizes the jobs file, expanding 'for_each' jobs."""
+    jobs = []
+    with open(jobs_path, 'r', encoding='utf-8') as f:
+        for line_number, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                job = json.loads(line)
+            except ValueError as e:
+                print(f"[!!] Skipping line {line_number}: invalid JSON ({e}) [!!]")
+                continue
+
+            job.setdefault('id', f"line-{line_number}")
+            model = job.get('model') or ''
+            for prefix in (VLM_PREFIX, LLM_PREFIX):
+                if model.startswith(prefix):
+                    model = model[len(prefix):]
+            if not model:
+                print(f"[!!] Skipping job {job['id']}: no model given [!!]")
+                continue
+            job['model'] = model
+            job['attachments'] = list(job.get('attachments') or [])
+
+            if job.get('for_each'):
+                for path, name in _expand_for_each(job.pop('for_each')):
+                    expanded = dict(job)
+                    expanded['id'] = f"{job['id']}:{name}"
+                    expanded['attachments'] = job['attachments'] + [path]
+                    jobs.append(expanded)
+            else:
+                jobs.append(job)
+    return jobs
+
+
+def load_checkpoint(output_path: str, retry_failed: bool = True) -> set:
+    """Returns the ids already finished in a previous run of the same output."""
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue # A line cut short by an interruption
+            if record.get('success') or not retry_failed:
+                done.add(record.get('id'))
+    return done
+
+
+def order_by_model(jobs: list) -> list:
+    """Groups jobs by model (in order of first appearance) to minimize model swaps."""
+    groups = {}
+    for job in jobs:
+        groups.setdefault(job['model'], []).append(job)
+    return list(groups.values())
+
+
+class BatchRunner:
+    def __init__(self, output_path: str, workers: int = DEFAULT_BATCH_WORKERS,
+                 ollama_host: str | None = None, use_cache: bool = True):
+        self.output_path = output_path
+        self.use_cache = use_cache
+        self.workers = max(1, workers)
+        self.client = make_client(ollama_host)
+        self.write_lock = threading.Lock()
+        self.completed = 0
+        self.failed = 0
+        self.total = 0
+
+    def _system_prompt(self, job: dict) -> str:
+        if job.get('system_prompt'):
+            return job['system_prompt']
+        return PERSONAS.get(job.get('persona') or '', '') or DEFAULT_SYSTEM_PROMPT
+
+    def run_job(self, job: dict) -> dict:
+        model = job['model']
+        events = queue.Queue()
+        record = {
+            'id': job['id'], 'model': model, 'persona': job.get('persona'),
+            'prompt': job.get('prompt', ''), 'attachments': job['attachments'],
+            'success': False, 'reply': '', 'elapsed': 0.0,
+        }
+        errors = []
+        # Any failure (opening the session, attaching, sending) is this job's error row,
+        # never the end of the batch
+        try:
+            session = ChatSession(
+                model,
+                'vlm' if model in VLM_MODELS else 'llm_only',
+                bool(job.get('use_gpu', False)),
+                system_prompt=self._system_prompt(job),
+                client=self.client,
+                event_queue=events,
+                options=job.get('options'),
+                use_cache=self.use_cache
+            )
+            for path in job['attachments']:
+                added, message = session.attach_file(path, source="attached")
+                if not added:
+                    errors.append(message.strip())
+
+            if not errors:
+                prompt = job.get('prompt') or "Please describe or analyze the attached content."
+                result = session.send(prompt)
+                record.update({
+                    'success': result['success'],
+                    'reply': result['reply'],
+                    'elapsed': result['elapsed'],
+                    'ttft': result['stats'].get('ttft'),
+                    'cached': result['cached'],
+                })
+        except Exception as e:
+            errors.append(str(e))
+
+        while not events.empty():
+            msg_type, text = events.get_nowait()
+            if msg_type == "LOG" and "[!!]" in text:
+                errors.append(text.strip())
+        if errors:
+            record['errors'] = errors
+        record['finished_at'] = time.strftime("%Y-%m-%dT%H:%M:%S")
+
+        self._write_record(record)
+        return record
+
+    def _write_record(self, record: dict):
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self.write_lock:
+            with open(self.output_path, 'a', encoding='utf-8') as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno()) # The checkpoint must survive a crash
+            self.completed += 1
+            if not record['success']:
+                self.failed += 1
+            status = "ok" if record['success'] else "FAILED"
+            if record.get('cached'):
+                status += " (cached)"
+            print(f"[{self.completed}/{self.total}] {record['id']} ({record['model']}) {status} "
+                  f"({record.get('elapsed', 0.0):.1f} secs)")
+
+    def run(self, jobs: list):
+        self.total = len(jobs)
+        for group in order_by_model(jobs):
+            print(f"--- Model {group[0]['model']}: {len(group)} job(s) ---")
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                list(pool.map(self.run_job, group))
+
+
+def run_batch(jobs_path: str, output_path: str, workers: int = DEFAULT_BATCH_WORKERS,
+              ollama_host: str | None = None, retry_failed: bool = True, use_cache: bool = True):
+    jobs = load_jobs(jobs_path)
+    done = load_checkpoint(output_path, retry_failed)
+    pending = [job for job in jobs if job['id'] not in done]
+    if done:
+        print(f"Resuming: {len(jobs) - len(pending)} of {len(jobs)} job(s) already finished.")
+    if not pending:
+        print("Nothing to do.")
+        return
+
+    runner = BatchRunner(output_path, workers, ollama_host, use_cache)
+    start = time.perf_counter()
+    runner.run(pending)
+    print(f"Finished {runner.completed} job(s), {runner.failed} failed, "
+          f"in {time.perf_counter() - start:.1f} secs. Results: {output_path}")
@@ -0,0 +1,431 @@
+"""
+Local HTTP serving mode for the chat engine (python main.py --serve).
+
+Exposes ChatSession over a small JSON API with Server-Sent Events (SSE)
+token streaming, so several users can share one machine's sessions,
+personas and attachment handling without running a Tk window.
+
+Endpoints:
+    GET    /health                      Server status and load (and backend state with several endpoints)
+    GET    /personas                    Predefined personas
+    GET    /models                      Configured models
+    POST   /sessions                    {"model", "persona"?, "system_prompt"?, "use_gpu"?,
+                                         "options"?, "use_cache"?, "use_semantic_cache"?}
+    GET    /sessions/<id>               Session info
+    DELETE /sessions/<id>               Drop a session
+    GET    /sessions/<id>/history       Conversation so far
+    POST   /sessions/<id>/messages      {"prompt", "attachments"?: [paths], "stream"?: bool}
+    POST   /sessions/<id>/cancel        Abort the in-flight message
+
+A streamed message is sent as SSE events: "thinking", then "token" events
+with the reply's text, "log" lines and a final "done" with the result. When
+an attempt is rejected (an invalid reply, or a backend error mid-reply) and
+retried, a "discard" event comes first: clients drop the tokens received
+so far, and the retry's tokens follow.
+
+All sessions share one pooled backend client. A global slot limit applies
+backpressure (requests wait, and are refused with 503 once the wait queue
+is full), and each session is limited to one in-flight message, a prompt
+size, a history length and an attachment count. Idle sessions only hold
+their history and are dropped after SERVER_SESSION_TTL seconds.
+"""
+import asyncio
+import json
+import os
+import re
+import secrets
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+
+from config import (
+    PERSONAS, ALL_MODELS, VLM_MODELS, VLM_PREFIX, LLM_PREFIX, DEFAULT_SYSTEM_PROMPT,
+    SERVER_HOST, SERVER_PORT, SERVER_MAX_CONCURRENT, SERVER_MAX_QUEUED,
+    SERVER_MAX_SESSIONS, SERVER_SESSION_TTL, SERVER_MAX_PROMPT_CHARS,
+    SERVER_MAX_HISTORY_TURNS, SERVER_MAX_ATTACHMENTS, SERVER_MAX_BODY_BYTES,
+    SEMANTIC_CACHE_ENABLED
+)
+from backend_pool import BackendPool, make_client
+from chat_session import ChatSession
+
+_SESSION_ROUTE = re.compile(r"^/sessions/([A-Za-z0-9_-]+)(?:/(history|messages|cancel))?$")
+
+_STATUS_TEXT = {
+    200: "OK", 201: "Created", 400: "Bad Request", 403: "Forbidden", 404: "Not Found",
+    405: "Method Not Allowed", 409: "Conflict", 413: "Payload Too Large",
+    429: "Too Many Requests", 500: "Internal Server Error", 503: "Service Unavailable",
+}
+
+
+class HttpError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+class _EventSink:
+    """
+    Stands in for a session's event queue. Events from the worker thread are
+    forwarded to the asyncio queue of the request currently being served;
+    put() blocks while that queue is full, which throttles generation to the
+    speed of the slowest reader.
+    """
+    def __init__(self):
+        self.loop = None
+        self.target = None
+
+    def put(self, item):
+        loop, target = self.loop, self.target
+        if target is None:
+            return # No request listening (e.g. a late log line)
+        asyncio.run_coroutine_threadsafe(target.put(item), loop).result()
+
+
+class ServerSession:
+    """A ChatSession plus the bookkeeping the server needs."""
+    def __init__(self, session_id: str, persona: str, session: ChatSession, sink: _EventSink):
+        self.session_id = session_id
+        self.persona = persona
+        self.session = session
+        self.sink = sink
+        self.last_used = time.monotonic()
+        self.busy = False
+
+    def info(self) -> dict:
+        return {
+            'id': self.session_id,
+            'model': self.session.selected_model,
+            'persona': self.persona,
+            'use_gpu': self.session.use_gpu,
+            'turns': len(self.session.messages),
+            'processing': self.busy,
+        }
+
+
+class ChatServer:
+    def __init__(self, ollama_host: str | None = None, attachment_root: str | None = None,
+                 max_concurrent: int = SERVER_MAX_CONCURRENT, use_cache: bool = True):
+        # One pooled HTTP client shared by every session
+        self.client = make_client(
+            ollama_host,
+            limits=httpx.Limits(max_connections=max_concurrent * 2,
+                                max_keepalive_connections=max_concurrent)
+        )
+        self.attachment_root = os.path.realpath(attachment_root) if attachment_root else None
+        self.sessions = {}
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrent, thread_name_prefix="chat-gen")
+        self.slots = None # asyncio.Semaphore, created inside the running loop
+        self.max_concurrent = max_concurrent
+        self.use_cache = use_cache
+        self.waiting = 0
+        self.active = 0
+
+    # --- Lifecycle ---
+
+    async def serve(self, host: str = SERVER_HOST, port: int = SERVER_PORT):
+        self.slots = asyncio.Semaphore(self.max_concurrent)
+        server = await asyncio.start_server(self._handle_connection, host, port)
+        asyncio.create_task(self._evict_idle_sessions())
+        print(f"Chat server listening on http://{host}:{port}")
+        async with server:
+            await server.serve_forever()
+
+    async def _evict_idle_sessions(self):
+        while True:
+            await asyncio.sleep(60)
+            cutoff = time.monotonic() - SERVER_SESSION_TTL
+            for session_id in [sid for sid, s in self.sessions.items()
+                               if not s.busy and s.last_used < cutoff]:
+                del self.sessions[session_id]
+
+    # --- HTTP Plumbing ---
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await reader.readline()
+            if not request_line:
+                return
+            method, target, _ = request_line.decode('latin-1').split(' ', 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                key, _, value = line.decode('latin-1').partition(':')
+                headers[key.strip().lower()] = value.strip()
+
+            length = int(headers.get('content-length') or 0)
+            if length > SERVER_MAX_BODY_BYTES:
+                raise HttpError(413, "Request body too large.")
+            body = await reader.readexactly(length) if length else b''
+            try:
+                payload = json.loads(body) if body else {}
+            except ValueError:
+                raise HttpError(400, "Body must be JSON.")
+            if not isinstance(payload, dict):
+                raise HttpError(400, "Body must be a JSON object.")
+
+            await self._route(method.upper(), target.split('?', 1)[0], payload, writer)
+        except HttpError as e:
+            await self._send_json(writer, e.status, {'error': e.message})
+        except (ValueError, asyncio.IncompleteReadError):
+            await self._send_json(writer, 400, {'error': "Malformed request."})
+        except (ConnectionResetError, BrokenPipeError):
+            pass
+        except Exception as e:
+            print(f"Server error: {e}")
+            await self._send_json(writer, 500, {'error': str(e)})
+        finally:
+            try:
+                writer.close()
+                await writer.wait_closed()
+            except Exception:
+                pass
+
+    def _write_head(self, writer, status: int, content_type: str, length: int | None = None, extra=None):
+        lines = [f"HTTP/1.1 {status} {_STATUS_TEXT.get(status, '')}",
+                 f"Content-Type: {content_type}", "Connection: close"]
+        if length is not None:
+            lines.append(f"Content-Length: {length}")
+        for key, value in (extra or {}).items():
+            lines.append(f"{key}: {value}")
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode('latin-1'))
+
+    async def _send_json(self, writer, status: int, payload, extra=None):
+        try:
+            body = json.dumps(payload).encode('utf-8')
+            self._write_head(writer, status, "application/json", len(body), extra)
+            writer.write(body)
+            await writer.drain()
+        except (ConnectionResetError, BrokenPipeError):
+            pass
+
+    # --- Routing ---
+
+    async def _route(self, method: str, path: str, payload: dict, writer):
+        if path == '/health' and method == 'GET':
+            return await self._send_json(writer, 200, {
+                'status': 'ok', 'sessions': len(self.sessions),
+                'active': self.active, 'waiting': self.waiting,
+                **({'backends': self.client.status(), 'hedging': self.client.hedge_stats()}
+                   if isinstance(self.client, BackendPool) else {}),
+            })
+        if path == '/personas' and method == 'GET':
+            return await self._send_json(writer, 200, PERSONAS)
+        if path == '/models' and method == 'GET':
+            return await self._send_json(writer, 200, {'models': ALL_MODELS})
+        if path == '/sessions':
+            if method != 'POST':
+                raise HttpError(405, "Use POST to create a session.")
+            return await self._send_json(writer, 201, self._create_session(payload).info())
+
+        match = _SESSION_ROUTE.match(path)
+        if not match:
+            raise HttpError(404, f"Unknown path {path}")
+        server_session = self.sessions.get(match.group(1))
+        if server_session is None:
+            raise HttpError(404, "Session not found (it may have expired).")
+        server_session.last_used = time.monotonic()
+        action = match.group(2)
+
+        if action is None and method == 'GET':
+            return await self._send_json(writer, 200, server_session.info())
+        if action is None and method == 'DELETE':
+            server_session.session.cancel()
+            del self.sessions[server_session.session_id]
+            return await self._send_json(writer, 200, {'deleted': server_session.session_id})
+        if action == 'history' and method == 'GET':
+            return await self._send_json(writer, 200, {'messages': [
+                {'role': m['role'], 'content': m['content'], 'images': len(m.get('images') or [])}
+                for m in server_session.session.history()
+            ]})
+        if action == 'cancel' and method == 'POST':
+            server_session.session.cancel()
+            return await self._send_json(writer, 200, {'cancelled': server_session.busy})
+        if action == 'messages' and method == 'POST':
+            return await self._send_message(server_session, payload, writer)
+        raise HttpError(405, f"{method} not allowed on {path}")
+
+    # --- Sessions ---
+
+    def _create_session(self, payload: dict) -> ServerSession:
+        if len(self.sessions) >= SERVER_MAX_SESSIONS:
+            raise HttpError(503, "Too many open sessions.")
+
+        model = payload.get('model') or ''
+        for prefix in (VLM_PREFIX, LLM_PREFIX):
+            if model.startswith(prefix):
+                model = model[len(prefix):]
+        if not model:
+            raise HttpError(400, "'model' is required.")
+
+        persona = payload.get('persona') or "Helpful Assistant"
+        if payload.get('system_prompt'):
+            system_prompt = payload['system_prompt']
+            persona = "Custom"
+        elif persona in PERSONAS:
+            system_prompt = PERSONAS[persona] or DEFAULT_SYSTEM_PROMPT
+        else:
+            raise HttpError(400, f"Unknown persona '{persona}'.")
+
+        options = payload.get('options')
+        if options is not None and not isinstance(options, dict):
+            raise HttpError(400, "'options' must be an object.")
+
+        sink = _EventSink()
+        session = ChatSession(
+            model,
+            'vlm' if model in VLM_MODELS else 'llm_only',
+            bool(payload.get('use_gpu', False)),
+            system_prompt=system_prompt,
+            client=self.client,
+            event_queue=sink,
+            options=options,
+            use_cache=self.use_cache and bool(payload.get('use_cache', True)),
+            use_semantic_cache=bool(payload.get('use_semantic_cache', SEMANTIC_CACHE_ENABLED))
+        )
+        session_id = secrets.token_urlsafe(9)
+        server_session = ServerSession(session_id, persona, session, sink)
+        self.sessions[session_id] = server_session
+        return server_session
+
+    def _resolve_attachment(self, path: str) -> str:
+        if self.attachment_root is None:
+            raise HttpError(403, "Attachments are disabled (start the server with --attachment-root).")
+        real_path = os.path.realpath(os.path.join(self.attachment_root, path))
+        if os.path.commonpath([real_path, self.attachment_root]) != self.attachment_root:
+            raise HttpError(403, f"Attachment outside the allowed root: {path}")
+        return real_path
+
+    # --- Messages ---
+
+    async def _send_message(self, server_session: ServerSession, payload: dict, writer):
+        session = server_session.session
+        prompt = str(payload.get('prompt') or '')
+        attachments = payload.get('attachments') or []
+        stream = bool(payload.get('stream', True))
+
+        # Per-session limits
+        if server_session.busy:
+            raise HttpError(409, "This session is already processing a message.")
+        if len(prompt) > SERVER_MAX_PROMPT_CHARS:
+            raise HttpError(413, f"Prompt exceeds {SERVER_MAX_PROMPT_CHARS} characters.")
+        if len(attachments) > SERVER_MAX_ATTACHMENTS:
+            raise HttpError(413, f"At most {SERVER_MAX_ATTACHMENTS} attachments per message.")
+        if len(session.messages) >= SERVER_MAX_HISTORY_TURNS:
+            raise HttpError(429, "Session history limit reached; start a new session.")
+        if not prompt and not attachments:
+            raise HttpError(400, "'prompt' or 'attachments' is required.")
+
+        session.clear_attachments()
+        for path in attachments:
+            added, message = session.attach_file(self._resolve_attachment(path), source="attached")
+            if not added:
+                session.clear_attachments()
+                raise HttpError(400, message.strip())
+        if not prompt:
+            prompt = "Please describe or analyze the attached content."
+
+        # Global backpressure: wait for a generation slot, refuse when the queue is full
+        if self.slots.locked() and self.waiting >= SERVER_MAX_QUEUED:
+            session.clear_attachments()
+            raise HttpError(503, "Server is busy, try again shortly.")
+
+        server_session.busy = True
+        try:
+            self.waiting += 1
+            try:
+                await self.slots.acquire()
+            finally:
+                self.waiting -= 1
+            self.active += 1
+            try:
+                await self._run_generation(server_session, prompt, stream, writer)
+            finally:
+                self.active -= 1
+                self.slots.release()
+        finally:
+            server_session.busy = False
+            server_session.last_used = time.monotonic()
+
+    async def _run_generation(self, server_session: ServerSession, prompt: str, stream: bool, writer):
+        loop = asyncio.get_running_loop()
+        events = asyncio.Queue(maxsize=64)
+        sink = server_session.sink
+        sink.loop, sink.target = loop, events
+
+        def worker():
+            result = None
+            try:
+                result = server_session.session.send(prompt, on_chunk=lambda text: sink.put(("TOKEN", text)))
+            finally:
+                sink.put(("DONE", result))
+
+        future = loop.run_in_executor(self.executor, worker)
+        if stream:
+            self._write_head(writer, 200, "text/event-stream", extra={'Cache-Control': 'no-cache'})
+
+        client_gone = False
+        streamed = False # Tokens of the current attempt have been sent
+        result = None
+        while True:
+            kind, data = await events.get()
+            if kind == "DONE":
+                result = data
+                break
+            if not stream or client_gone:
+                continue
+            try:
+                if kind == "LOG" and streamed:
+                    # Only retries and errors log mid-reply; the attempt's tokens are thrown away
+                    writer.write(b"event: discard\ndata: {}\n\n")
+                streamed = kind == "TOKEN" or (streamed and kind != "LOG")
+                name = {'TOKEN': 'token', 'LOG': 'log', 'THINKING': 'thinking'}.get(kind, kind.lower())
+                writer.write(f"event: {name}\ndata: {json.dumps(data)}\n\n".encode('utf-8'))
+                await writer.drain() # Backpressure from slow readers
+            except (ConnectionResetError, BrokenPipeError):
+                # Client went away: stop generating, but keep draining until the worker is done
+                client_gone = True
+                server_session.session.cancel()
+
+        sink.target = None
+        try:
+            await future
+        except Exception as e:
+            result = None
+            error = str(e)
+        else:
+            error = None
+
+        response = {
+            'reply': result['reply'] if result else '',
+            'success': bool(result and result['success']),
+            'cancelled': bool(result and result['cancelled']),
+            'elapsed': result['elapsed'] if result else 0.0,
+            'ttft': result['stats'].get('ttft') if result else None,
+            'cached': result['cached'] if result else None,
+        }
+        if error:
+            response['error'] = error
+
+        if stream:
+            if not client_gone:
+                try:
+                    writer.write(f"event: done\ndata: {json.dumps(response)}\n\n".encode('utf-8'))
+                    await writer.drain()
+                except (ConnectionResetError, BrokenPipeError):
+                    pass
+        else:
+            await self._send_json(writer, 200 if not error else 500, response)
+
+
+def run_server(host: str = SERVER_HOST, port: int = SERVER_PORT, ollama_host: str | None = None,
+               attachment_root: str | None = None, max_concurrent: int = SERVER_MAX_CONCURRENT,
+               use_cache: bool = True):
+    server = ChatServer(ollama_host, attachment_root, max_concurrent, use_cache)
+    try:
+        asyncio.run(server.serve(host, port))
+    except KeyboardInterrupt:
+        print("Stopping chat server.")
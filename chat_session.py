@@ -0,0 +1,686 @@
+import base64
+import os
+import queue
+import threading
+import time
+from contextlib import nullcontext
+
+# Pillow
+from PIL import Image
+
+# This project's modules
+from config import (
+    DEFAULT_SYSTEM_PROMPT, GENERATION_OPTIONS, RESPONSE_CACHE_ENABLED, SEMANTIC_CACHE_ENABLED,
+    PDF_EXTENSIONS, TEXT_EXTENSIONS, IMAGE_EXTENSIONS, ARCHIVE_EXTENSIONS,
+    PDF_FUNCTIONALITY_DISABLED, MAX_RETRIES, PREWARM_MIN_CHARS, FOLDER_READ_WORKERS
+)
+from utils import (
+    read_image_bytes_from_file, read_text_file_budgeted, extract_pdf_text, is_binary_file,
+    encode_image, sample_text
+)
+from attachment_pool import get_attachment_pool
+from backend_pool import make_client
+from attachment_store import StoredAttachment, get_attachment_store, digest_bytes, digest_file
+from directory_reader import read_directory, read_archive
+from ollama_client import (
+    execute_ollama_call, build_user_message, build_messages_for_call, model_is_loaded, prewarm_prefix
+)
+from response_cache import get_response_cache, is_cacheable, make_cache_key
+from semantic_cache import get_semantic_cache, context_digest
+from session_store import turn_messages
+
+FALLBACK_REPLY = "[The assistant is unable to provide a valid response at this time.]"
+
+# The conversation the server evaluated last (see _prefix_key): prewarming it again is pointless
+_last_evaluated = None
+# One prewarm at a time for the whole app, so typing in several tabs doesn't queue up work
+_prewarm_lock = threading.Lock()
+
+
+def _pack_message(message: dict) -> dict:
+    """A JSON-ready copy of a history message: images become base64 plus their store digest."""
+    images = message.get('images')
+    if not images:
+        return dict(message)
+    packed = dict(message)
+    packed['images'] = [
+        {'digest': getattr(img, 'digest', None), 'data': base64.b64encode(getattr(img, 'image', img)).decode('ascii')}
+        for img in images
+    ]
+    return packed
+
+
+def _unpack_message(packed: dict) -> dict:
+    """Reverses _pack_message, re-sharing images with the attachment store where possible."""
+    images = packed.get('images')
+    if not images:
+        return dict(packed)
+    store = get_attachment_store()
+    message = dict(packed)
+    message['images'] = []
+    for entry in images:
+        data = base64.b64decode(entry['data'])
+        if entry['digest']:
+            handle = store.get(entry['digest']) or store.put(StoredAttachment(entry['digest'], image=data))
+            message['images'].append(handle)
+        else:
+            message['images'].append(data)
+    return message
+
+
+def _set_last_evaluated(key: str):
+    global _last_evaluated
+    _last_evaluated = key
+
+
+def _prefix_key(model: str, options: dict, system_prompt: str, history: list) -> str:
+    """Identifies a conversation prefix as the server sees it: model, options, system prompt and turns."""
+    return make_cache_key(model, options, [{'role': 'system', 'content': system_prompt}] + history)
+
+
+def _turn_ref(turn: dict) -> dict:
+    """What a session keeps about a turn loaded from the store (see ChatSession.turns)."""
+    return {'id': turn['id'], 'parent_id': turn['parent_id'], 'prompt': turn['prompt'],
+            'versions': turn.get('versions') or [turn['id']]}
+
+
+class ChatSession:
+    """
+    The conversation engine for a *single* chat: history, pending attachments
+    and backend calls. It has no GUI dependencies, so the same engine drives
+    a Tk tab, the load generator, batch jobs or a server.
+
+    All public methods are thread-safe. `send()` blocks and is meant to run on
+    a worker thread; progress is reported as (type, data) tuples on
+    `self.events` ("LOG", "THINKING"), the same protocol the GUI consumes.
+
+    Attachments are prepared (read, encoded, extracted) on the app-wide
+    attachment pool as soon as they are added; `send()` only waits for jobs still running.
+    `on_attachment_ready` is called from the pool after each job, and with
+    `thumbnail_size` set the job also renders a preview image.
+    """
+    def __init__(self, selected_model: str, chat_mode: str = 'vlm', use_gpu: bool = False,
+                 system_prompt: str = DEFAULT_SYSTEM_PROMPT, client=None,
+                 event_queue: queue.Queue | None = None, options: dict | None = None,
+                 use_cache: bool = RESPONSE_CACHE_ENABLED,
+                 use_semantic_cache: bool = SEMANTIC_CACHE_ENABLED,
+                 on_attachment_ready=None, thumbnail_size: tuple | None = None,
+                 history_store=None, history_id: str | None = None, history_turns: int = 0,
+                 history_head: int | None = None):
+        self._lock = threading.RLock()
+        self._cancel_event = threading.Event()
+        self._prewarm_cancel = threading.Event() # Set by send(): a running prewarm is dropped
+        self._cold_model = None # Model a prewarm found not loaded; not checked again until the next send
+
+        self.selected_model = selected_model
+        self.chat_mode = chat_mode
+        self.use_gpu = use_gpu
+        self.system_prompt = system_prompt or DEFAULT_SYSTEM_PROMPT
+        self.options = dict(GENERATION_OPTIONS if options is None else options)
+        self.use_cache = use_cache # Bypass switch for the response cache
+        self.use_semantic_cache = use_semantic_cache
+
+        self.client = client if client is not None else make_client()
+        self.events = event_queue if event_queue is not None else queue.Queue()
+        self.on_attachment_ready = on_attachment_ready
+        self.thumbnail_size = thumbnail_size
+        self.history_store = history_store # A SessionStore that saves every turn, or None
+        self.history_id = history_id       # This conversation's id in it (created with the first turn)
+        self.history_turns = history_turns # Turns on the current branch; the next one is number history_turns + 1
+        self.history_head = history_head   # Id of the branch's last saved turn; the next one follows it
+
+        self.messages = []
+        self.turns = [] # {'id', 'parent_id', 'prompt', 'versions'} for each (user, assistant) pair in self.messages
+        self._rewound_versions = None # Versions of the turn rewind() dropped; the next turn saved joins them
+        self.image_attachments = []
+        self.pdf_attachments = []
+        self.text_attachments = []
+
+        self.processing = False
+        self.last_result = None
+
+    # --- Settings ---
+
+    def set_system_prompt(self, text: str):
+        with self._lock:
+            self.system_prompt = text or DEFAULT_SYSTEM_PROMPT
+
+    # --- Attachments ---
+
+    def attach_file(self, file_path: str, source: str = "dropped") -> tuple[bool, str]:
+        """
+        Classifies and queues a file for the next message.
+
+        Returns:
+            tuple[bool, str]: (attached, message for the user)
+        """
+        if not os.path.exists(file_path):
+            return False, f"[!!] Error: {source.title()} file path not found: {file_path} [!!]"
+
+        ext = os.path.splitext(file_path)[1].lower()
+        name = os.path.basename(os.path.normpath(file_path))
+
+        with self._lock:
+            # Folders and archives travel with the text files: they become text context
+            if os.path.isdir(file_path):
+                return self._queue_attachment(self.text_attachments, {'type': 'folder', 'path': file_path},
+                                              f"Folder {{n}} {source}: {name}")
+
+            elif ext in ARCHIVE_EXTENSIONS:
+                return self._queue_attachment(self.text_attachments, {'type': 'archive', 'path': file_path},
+                                              f"Archive {{n}} {source}: {name}")
+
+            elif ext in IMAGE_EXTENSIONS:
+                if self.chat_mode == 'llm_only':
+                    return False, "[!!] Image attachments are disabled for this LLM. [!!]"
+                return self._queue_attachment(self.image_attachments, {'type': 'image', 'path': file_path},
+                                              f"Image {{n}} {source}: {name}")
+
+            elif ext in PDF_EXTENSIONS:
+                if PDF_FUNCTIONALITY_DISABLED:
+                    return False, "[!!] PDF processing is disabled. Please install 'pypdf'. [!!]"
+                return self._queue_attachment(self.pdf_attachments, {'type': 'pdf', 'path': file_path},
+                                              f"PDF {{n}} {source}: {name}")
+
+            elif ext in TEXT_EXTENSIONS or ext not in PDF_EXTENSIONS:
+                # Unknown extensions are only accepted if they sniff as text
+                if ext not in TEXT_EXTENSIONS and is_binary_file(file_path):
+                    return False, f"\n[!!] Skipping binary file: {name} [!!]"
+                return self._queue_attachment(self.text_attachments, {'type': 'text', 'path': file_path},
+                                              f"File {{n}} {source}: {name}")
+
+        return False, f"\n[!!] Unhandled file type: {name} [!!]"
+
+    def attach_image_data(self, image) -> tuple[bool, str]:
+        """Queues an in-memory PIL image (e.g. pasted from the clipboard)."""
+        with self._lock:
+            if self.chat_mode == 'llm_only':
+                return False, "[!!] Image pasting is disabled for this LLM. [!!]"
+            return self._queue_attachment(self.image_attachments, {'type': 'image', 'data': image},
+                                          "Image {n} pasted from clipboard.")
+
+    def attach_text_data(self, text: str) -> tuple[bool, str]:
+        """Queues in-memory text (a large paste); it gets the same budget as a text file."""
+        with self._lock:
+            n = len(self.text_attachments) + 1
+            att = {'type': 'text', 'data': text, 'name': f"pasted text {n}"}
+            lines = text.count("\n") + 1
+            return self._queue_attachment(self.text_attachments, att,
+                                          f"Text {{n}} pasted from clipboard ({lines:,} lines) as an attachment.")
+
+    def _queue_attachment(self, target: list, att: dict, label: str) -> tuple[bool, str]:
+        """Starts preparing `att` and adds it to `target`. `label` may use {n}, the attachment number."""
+        if not self._start_preparing(att):
+            return False, "\n[!!] Too many attachments are being prepared. Please try again in a moment. [!!]"
+        target.append(att)
+        return True, "\n[+] " + label.format(n=len(target))
+
+    def attachments(self) -> tuple[list, list, list]:
+        """Returns a snapshot of the pending (images, pdfs, text files)."""
+        with self._lock:
+            return list(self.image_attachments), list(self.pdf_attachments), list(self.text_attachments)
+
+    def has_attachments(self) -> bool:
+        with self._lock:
+            return bool(self.image_attachments or self.pdf_attachments or self.text_attachments)
+
+    def clear_attachments(self):
+        with self._lock:
+            self._cancel_preparing(self.image_attachments + self.pdf_attachments + self.text_attachments)
+            self.image_attachments = []
+            self.pdf_attachments = []
+            self.text_attachments = []
+
+    def _take_attachments(self) -> tuple[list, list, list]:
+        with self._lock:
+            taken = (self.image_attachments, self.pdf_attachments, self.text_attachments)
+            self.image_attachments = []
+            self.pdf_attachments = []
+            self.text_attachments = []
+            return taken
+
+    # --- Attachment Preparation ---
+
+    def _start_preparing(self, att: dict) -> bool:
+        """Submits the job that prepares `att` to the shared pool. False if the pool is saturated."""
+        future = get_attachment_pool().submit(self, self._prepare_attachment, att)
+        if future is None:
+            return False
+        att['future'] = future
+        if self.on_attachment_ready is not None:
+            future.add_done_callback(lambda _: self.on_attachment_ready())
+        return True
+
+    def _cancel_preparing(self, attachments: list):
+        # Jobs still queued are dropped; a running job finishes but its result is unused
+        for att in attachments:
+            if att.get('future') is not None:
+                att['future'].cancel()
+
+    def prepared(self, att: dict) -> dict | None:
+        """Returns the prepared payload of an attachment, or None while its job is still running."""
+        future = att.get('future')
+        if future is None or future.cancelled() or not future.done():
+            return None
+        return future.result()
+
+    def _prepare_attachment(self, att: dict) -> dict:
+        """
+        Prepares one attachment. Returns {'handle': StoredAttachment or None,
+        'logs': [messages for the chat, emitted at send time]}. Content seen
+        before (in any session) is served from the shared attachment store.
+        """
+        payload = {'handle': None, 'logs': []}
+        path = att.get('path')
+        name = os.path.basename(os.path.normpath(path)) if path else att.get('name', 'pasted image')
+        store = get_attachment_store()
+
+        try:
+            if att['type'] == 'text' and 'data' in att:
+                digest = digest_bytes(att['data'].encode('utf-8'), 'text')
+            elif att['type'] == 'image':
+                if 'data' in att:
+                    image = att['data']
+                    digest = digest_bytes(image.tobytes(), f"pixels:{image.mode}:{image.size}")
+                else:
+                    digest = digest_file(path, 'image')
+            elif att['type'] == 'folder':
+                digest = None # No cheap content key; folders are packed every time
+            else:
+                digest = digest_file(path, att['type'])
+        except OSError as e:
+            payload['logs'].append(f"[!!] Failed to read {name}: {e} [!!]")
+            return payload
+
+        handle = store.get(digest) if digest else None
+        if handle is None:
+            handle = self._build_stored_attachment(att, digest, name, payload['logs'])
+            if handle is not None and digest:
+                handle = store.put(handle)
+        if handle is not None and handle.note:
+            payload['logs'].append(f"[i] {name}{handle.note}.")
+        payload['handle'] = handle
+        return payload
+
+    def _build_stored_attachment(self, att: dict, digest: str | None, name: str, logs: list) -> StoredAttachment | None:
+        """Does the actual reading/encoding/extraction for an attachment not in the store."""
+        path = att.get('path')
+
+        if att['type'] == 'image':
+            try:
+                if 'data' in att:
+                    image_bytes = encode_image(att['data'])
+                    source = att['data']
+                else:
+                    image_bytes = read_image_bytes_from_file(path)
+                    source = Image.open(path) if image_bytes else None
+                if not image_bytes:
+                    logs.append(f"[!!] Failed to read image {name} [!!]")
+                    return None
+                thumbnail = None
+                if source is not None and self.thumbnail_size:
+                    # thumbnail() resizes in place, so never run it on the image being sent
+                    thumbnail = source.copy() if source is att.get('data') else source
+                    thumbnail.thumbnail(self.thumbnail_size)
+                return StoredAttachment(digest, image=image_bytes, thumbnail=thumbnail)
+            except Exception as e:
+                logs.append(f"[!!] Failed to read image {name}: {e} [!!]")
+                return None
+
+        elif att['type'] in ('folder', 'archive'):
+            reader = read_directory if att['type'] == 'folder' else read_archive
+            # The walker's reader threads come out of the pool's budget (this job is one of them)
+            with get_attachment_pool().extra_workers(FOLDER_READ_WORKERS - 1) as extra:
+                content, report = reader(path, workers=1 + extra)
+            if content is None:
+                logs.append(f"[!!] {att['type'].title()} {name} {report} [!!]")
+                return None
+            return StoredAttachment(digest, context=content, note=f": {report}")
+
+        elif att['type'] == 'pdf':
+            # pypdf is pure Python: extract in a worker process to use a real core
+            content = get_attachment_pool().run_in_process(extract_pdf_text, path)
+            if content is None:
+                logs.append(f"[!!] Failed to extract text from PDF {path} [!!]")
+                return None
+            return StoredAttachment(digest, context=content)
+
+        if 'data' in att:
+            content, report = sample_text(att['data'])
+            return StoredAttachment(digest, context=content, note=f" is large: {report}" if report else None)
+
+        content, report = read_text_file_budgeted(path)
+        if content is None:
+            logs.append(f"[!!] {name} {report} [!!]" if report else f"[!!] Failed to read text file {path} [!!]")
+            return None
+        return StoredAttachment(digest, context=content, note=f" is large: {report}" if report else None)
+
+    def _read_attachments(self, image_list: list, pdf_list: list, text_list: list) -> tuple[list, list]:
+        """
+        Collects prepared attachments into (image handles, file_context_parts),
+        waiting only for jobs that have not finished yet. The image handles go
+        into the history as they are; see build_messages_for_call.
+        """
+        image_handles = []
+        file_context_parts = []
+        images = image_list if self.chat_mode == 'vlm' else []
+        for att in images + text_list + pdf_list:
+            future = att.get('future')
+            if future is None or future.cancelled():
+                payload = self._prepare_attachment(att)
+            else:
+                payload = future.result()
+
+            for message in payload['logs']:
+                self.events.put(("LOG", message))
+            handle = payload['handle']
+            if handle is None:
+                continue
+            if handle.image:
+                image_handles.append(handle)
+            if att['type'] in ('folder', 'archive'):
+                file_context_parts.append(handle.context) # Already has its own header
+            elif handle.context is not None:
+                name = att['name'] if 'data' in att else os.path.basename(att['path'])
+                file_context_parts.append(f"--- Content of {name} ---\n{handle.context}\n")
+
+        return image_handles, file_context_parts
+
+    # --- Conversation ---
+
+    def send(self, prompt: str, on_chunk=None, user_message: dict | None = None) -> dict:
+        """
+        Sends a message with all pending attachments and waits for the reply.
+        To regenerate a reply, pass the `user_message` returned by rewind():
+        it is sent again exactly as before (pending attachments stay pending)
+        and the response caches are skipped.
+
+        Returns a result dict with 'reply', 'elapsed', 'success', 'cancelled',
+        'cached' and 'stats'. Failed (not cancelled) turns are recorded in the
+        history with a fallback reply, like the GUI always did.
+
+        Deterministic requests (see response_cache.is_cacheable) are answered
+        from the shared response cache when an identical one was seen before.
+        With the semantic cache on, a near-duplicate question asked in the same
+        context is answered too. 'cached' is then 'exact' or 'semantic'.
+        """
+        with self._lock:
+            if self.processing:
+                raise RuntimeError("A message is already being processed for this session.")
+            self.processing = True
+            self._cancel_event.clear()
+            self._prewarm_cancel.set()
+            self._cold_model = None
+            system_prompt = self.system_prompt
+            history = list(self.messages)
+            model = self.selected_model
+            options = dict(self.options)
+            use_cache = self.use_cache and user_message is None
+            use_semantic_cache = self.use_semantic_cache and user_message is None
+
+        try:
+            if user_message is None:
+                image_list, pdf_list, text_list = self._take_attachments()
+                image_handles, file_context_parts = self._read_attachments(image_list, pdf_list, text_list)
+                user_message = build_user_message(prompt, file_context_parts, image_handles)
+            messages_for_call = build_messages_for_call(system_prompt, history, user_message)
+
+            self.events.put(("THINKING", None))
+
+            stats = {}
+            start_time = time.perf_counter()
+
+            # 1. Exact-match cache (deterministic requests only)
+            cache = get_response_cache() if use_cache and is_cacheable(options) else None
+            # Keyed on the unresolved messages: image handles carry their digest already
+            cache_key = make_cache_key(
+                model, options, [{'role': 'system', 'content': system_prompt}] + history + [user_message]
+            ) if cache else None
+            cached_reply = cache.get(cache_key) if cache else None
+            cache_kind = 'exact' if cached_reply is not None else None
+
+            # 2. Semantic cache (near-duplicate question in the same context)
+            semantic_cache = get_semantic_cache() if use_semantic_cache and cached_reply is None else None
+            question_vector = semantic_cache.embed(self.client, prompt) if semantic_cache else None
+            if question_vector is not None:
+                digest = context_digest(history, file_context_parts, image_handles)
+                cached_reply, stats['similarity'] = semantic_cache.lookup(
+                    model, system_prompt, question_vector, digest
+                )
+                if cached_reply is not None:
+                    cache_kind = 'semantic'
+
+            if cached_reply is not None:
+                if on_chunk:
+                    on_chunk(cached_reply)
+                reply, success = cached_reply, True
+                elapsed_time = time.perf_counter() - start_time
+                stats.update({'ttft': elapsed_time, 'attempts': 0, 'cached': cache_kind})
+            else:
+                with self._generating():
+                    reply, elapsed_time, success = execute_ollama_call(
+                        self.client, model, self.use_gpu, messages_for_call, self.events,
+                        on_chunk=on_chunk, stats=stats, cancel_event=self._cancel_event,
+                        extra_options=options
+                    )
+                if success and cache:
+                    cache.put(cache_key, model, reply)
+                if success and question_vector is not None:
+                    semantic_cache.store(model, system_prompt, question_vector, digest, reply)
+            cancelled = bool(stats.get('cancelled'))
+
+            if not success and not cancelled:
+                self.events.put(("LOG", f"\n[!!] Chatbot failed to generate a valid response after {MAX_RETRIES} attempts. [!!]"))
+                reply = FALLBACK_REPLY
+
+            assistant_message = {'role': 'assistant', 'content': reply}
+            evaluated = None
+            if not cancelled and cache_kind is None:
+                evaluated = _prefix_key(model, options, system_prompt, history + [user_message, assistant_message])
+
+            with self._lock:
+                if not cancelled:
+                    self.messages.append(user_message)
+                    self.messages.append(assistant_message)
+                    self._save_turn(prompt, user_message, reply, model, system_prompt)
+                    if evaluated is not None:
+                        _set_last_evaluated(evaluated)
+                result = {
+                    'reply': reply,
+                    'elapsed': elapsed_time,
+                    'success': success,
+                    'cancelled': cancelled,
+                    'cached': cache_kind,
+                    'stats': stats,
+                }
+                self.last_result = result
+            return result
+        finally:
+            with self._lock:
+                self.processing = False
+
+    def prewarm(self) -> dict | None:
+        """
+        Sends the conversation so far ahead of the next message, so its prompt
+        is evaluated while the user is still typing (see prewarm_prefix).
+        Blocks; returns the server's prompt-eval stats, or None if nothing was
+        sent or it was dropped: a message is being processed (or was sent
+        meanwhile), the conversation is short or already evaluated, another
+        prewarm is running, or the model isn't loaded (loading it could evict
+        another tab's model; that answer stands until the next send()).
+        """
+        with self._lock:
+            if self.processing or self._cold_model == self.selected_model:
+                return None
+            self._prewarm_cancel.clear()
+            system_prompt = self.system_prompt
+            history = list(self.messages)
+            model = self.selected_model
+            options = dict(self.options)
+        size = len(system_prompt) + sum(len(m['content']) for m in history)
+        has_images = any(m.get('images') for m in history)
+        if size < PREWARM_MIN_CHARS and not has_images:
+            return None
+        key = _prefix_key(model, options, system_prompt, history)
+        if key == _last_evaluated:
+            return None
+        if not _prewarm_lock.acquire(blocking=False):
+            return None
+        try:
+            if not model_is_loaded(self.client, model):
+                with self._lock:
+                    self._cold_model = model
+                return None
+            with self._lock:
+                if self.processing or len(self.messages) != len(history):
+                    return None # Sent in the meantime; the real request evaluates the prompt itself
+            with self._generating():
+                stats = prewarm_prefix(self.client, model, self.use_gpu,
+                                       build_messages_for_call(system_prompt, history, None), options,
+                                       cancel_event=self._prewarm_cancel)
+            if stats is not None:
+                _set_last_evaluated(key)
+            return stats
+        except Exception as e:
+            print(f"Error prewarming the prompt: {e}")
+            return None
+        finally:
+            _prewarm_lock.release()
+
+    def _generating(self):
+        """Context for a backend call: in CPU mode, attachment jobs keep to the cores Ollama leaves free."""
+        return nullcontext() if self.use_gpu else get_attachment_pool().cpu_inference()
+
+    def stream(self, prompt: str):
+        """
+        Sends a message and yields the reply as it is generated.
+        The final result dict is available as `last_result` afterwards.
+        """
+        chunks = queue.Queue()
+        done = object()
+
+        def worker():
+            try:
+                self.send(prompt, on_chunk=chunks.put)
+            finally:
+                chunks.put(done)
+
+        threading.Thread(target=worker, daemon=True).start()
+        while True:
+            chunk = chunks.get()
+            if chunk is done:
+                return
+            yield chunk
+
+    def cancel(self):
+        """Aborts the in-flight request, if any. The turn is not recorded."""
+        self._cancel_event.set()
+
+    def history(self) -> list:
+        """Returns a copy of the conversation so far (user/assistant turns)."""
+        with self._lock:
+            return list(self.messages)
+
+    # --- Snapshots ---
+
+    def snapshot(self) -> dict:
+        """The settings and history as a JSON-ready dict, for from_snapshot(). Pending attachments are not included."""
+        with self._lock:
+            return {
+                'selected_model': self.selected_model,
+                'chat_mode': self.chat_mode,
+                'use_gpu': self.use_gpu,
+                'system_prompt': self.system_prompt,
+                'options': dict(self.options),
+                'use_cache': self.use_cache,
+                'use_semantic_cache': self.use_semantic_cache,
+                'history_id': self.history_id,
+                'history_turns': self.history_turns,
+                'history_head': self.history_head,
+                'messages': [_pack_message(m) for m in self.messages],
+                'turns': [dict(turn) for turn in self.turns],
+            }
+
+    @classmethod
+    def from_snapshot(cls, state: dict, **kwargs) -> 'ChatSession':
+        """Rebuilds a session from snapshot(); `kwargs` override constructor arguments (e.g. event_queue)."""
+        params = {key: value for key, value in state.items() if key not in ('messages', 'turns')}
+        params.update(kwargs)
+        session = cls(**params)
+        session.messages = [_unpack_message(m) for m in state['messages']]
+        session.turns = [dict(turn) for turn in state.get('turns', [])]
+        return session
+
+    def _save_turn(self, prompt: str, user_message: dict, reply: str, model: str, system_prompt: str):
+        # Only reserves the turn id and queues the write; the store's own thread does the I/O
+        turn = {'id': None, 'parent_id': self.history_head, 'prompt': prompt}
+        versions, self._rewound_versions = self._rewound_versions or [], None
+        self.history_turns += 1
+        if self.history_store is not None:
+            if self.history_id is None:
+                self.history_id = self.history_store.create_session(model, self.chat_mode, self.use_gpu, system_prompt)
+            turn['id'] = self.history_store.append_turn(
+                self.history_id, prompt, user_message, reply, model, system_prompt,
+                parent_id=self.history_head, seq=self.history_turns
+            )
+            self.history_head = turn['id']
+        turn['versions'] = versions + [turn['id']]
+        self.turns.append(turn)
+
+    # --- Branches ---
+
+    def prepend_turns(self, turns: list):
+        """Adds older turns of the branch (paged in from the saved history) before the current ones."""
+        with self._lock:
+            self.messages[:0] = [m for turn in turns for m in turn_messages(turn)]
+            self.turns[:0] = [_turn_ref(turn) for turn in turns]
+
+    def append_turns(self, turns: list):
+        """Continues the conversation with saved turns, e.g. the rest of another branch after rewind()."""
+        if not turns:
+            return
+        with self._lock:
+            self.messages.extend(m for turn in turns for m in turn_messages(turn))
+            self.turns.extend(_turn_ref(turn) for turn in turns)
+            self.history_turns = turns[-1]['seq']
+            self.history_head = turns[-1]['id']
+            self._rewound_versions = None
+
+    def user_message(self, index: int) -> dict:
+        """The message sent in turn `index` of self.turns, as it went to the model."""
+        with self._lock:
+            return self.messages[len(self.messages) - 2 * (len(self.turns) - index)]
+
+    def rewind(self, index: int) -> dict:
+        """
+        Drops turn `index` of self.turns and every later one, so the next
+        send() starts a new branch after the turn before it; the dropped turns
+        stay saved. Returns the dropped turn's ref plus its 'user_message'.
+        """
+        with self._lock:
+            if self.processing:
+                raise RuntimeError("A message is already being processed for this session.")
+            turn = self.turns[index]
+            # Older turns may come from a snapshot without refs, so count from the end
+            cut = len(self.messages) - 2 * (len(self.turns) - index)
+            user_message = self.messages[cut]
+            self.history_turns -= len(self.turns) - index
+            self.history_head = turn['parent_id']
+            self._rewound_versions = turn.get('versions') or [turn['id']]
+            del self.messages[cut:]
+            del self.turns[index:]
+            return dict(turn, user_message=user_message)
+
+    def reset(self):
+        """Clears the history and pending attachments. Later turns are saved as a new conversation."""
+        with self._lock:
+            self._cancel_preparing(self.image_attachments + self.pdf_attachments + self.text_attachments)
+            self.messages = []
+            self.history_id = None
+            self.history_turns = 0
+            self.history_head = None
+            self.turns = []
+            self._rewound_versions = None
+            self.image_attachments = []
+            self.pdf_attachments = []
+            self.text_attachments = []
@@ -1,33 +1,35 @@
 import tkinter as tk
 from tkinter import ttk, font
-import re
+import platform
+from bisect import bisect_left, bisect_right
 from tkinterdnd2 import DND_FILES
 
-# --- Pygments Import ---
-try:
-    from pygments import lex
-    from pygments.lexers import get_lexer_by_name, guess_lexer
-    from pygments.styles import get_style_by_name
-    from pygments.token import Token
-    PYGMENTS_AVAILABLE = True
-except ImportError:
-    PYGMENTS_AVAILABLE = False
-
-# --- Predefined Personalities ---
-PERSONAS = {
-    "Helpful Assistant": "You are a helpful assistant. Be concise and clear.",
-    "Python Expert": "You are a senior Python software engineer. You provide efficient, PEP8-compliant code and explain complex concepts simply.",
-    "Creative Writer": "You are a creative writer. Use evocative language, metaphors, and varied sentence structures.",
-    "Skeptical Scientist": "You are a skeptical scientist. Demand evidence for claims, think critically, and look for logical fallacies.",
-    "Pirate": "You are a pirate captain. Speak in nautical slang, be boisterous, and refer to the user as 'matey'.",
-    "Custom": "" # Placeholder for user edits
-}
+from config import PERSONAS, CODE_BLOCK_LIVE_MARGIN, OUTPUT_FLUSH_INTERVAL
+from syntax_highlighter import PYGMENTS_AVAILABLE, highlight_async, style_table, guess_language
+from markdown_stream import MarkdownStreamParser, HEADING_PATTERN, inline_segments
 
 class ChatbotGuiLibrary:
     def __init__(self, root, drop_callback, paste_callback):
         self.root = root
         self.image_references = [] 
         self.thinking_message_start_index = None
+        self.transcript = [] # ('log' | 'reply', text) as shown, so a hibernated tab can be rebuilt
+
+        # Code blocks in the transcript. Only those near the view get full widgets;
+        # the rest are swapped for plain frames of the same size.
+        self.code_blocks = []      # {'index', 'line', 'language', 'code', 'widget', 'live', 'size'}
+        self.code_block_lines = [] # Transcript line of each block, for bisecting the view
+        self.live_code_blocks = set()
+        self._virtualize_pending = None
+        self._stream = None # State of the reply being streamed, if any
+
+        # Output that arrives in bursts (logs, streamed chunks) is drawn once per frame
+        self._pending_output = [] # (text, tags) inserts
+        self._pending_chunks = [] # Chunks of the streamed reply
+        self._flush_id = None
+
+        self.on_scroll_top = None # Called when the chat is scrolled to the very top (to page in older turns)
+        self.turn_menu_items = None # Called with a turn's seq on right-click; returns [(label, command or None), ...]
 
         # --- Layout ---
         
@@ -118,14 +120,16 @@ class ChatbotGuiLibrary:
         self.text_output = tk.Text(chat_frame,
                                    state=tk.DISABLED,
                                    wrap=tk.WORD,
-                                   yscrollcommand=self.chat_scrollbar.set,
+                                   yscrollcommand=self._on_output_scrolled,
                                    font=("Arial", 15)) 
         
         self.chat_scrollbar.config(command=self.text_output.yview)
         self.chat_scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
         self.text_output.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        self.text_output.bind("<Configure>", lambda e: self._schedule_virtualize())
         
         self._setup_markdown_tags()
+        self.code_font = font.Font(family="Consolas", size=11)
 
         # --- Bindings ---
         self.text_input.bind("<Return>", self._on_enter_key)
@@ -136,6 +140,9 @@ class ChatbotGuiLibrary:
         self.text_input.drop_target_register(DND_FILES)
         self.text_input.dnd_bind('<<Drop>>', drop_callback)
         self.text_input.bind("<<Paste>>", paste_callback)
+        # macOS reports the right mouse button as button 2
+        right_click = "<Button-2>" if platform.system() == "Darwin" else "<Button-3>"
+        self.text_output.bind(right_click, self._on_output_right_click)
         
         self.set_personality_text(PERSONAS["Helpful Assistant"])
 
@@ -170,89 +177,6 @@ class ChatbotGuiLibrary:
         self.text_output.tag_configure("code_span", font=("Consolas", 12), background="#444444", foreground="#E0E0E0")
 
 
-    def _insert_markdown_text(self, text_chunk):
-        """
-        Inserts text and applies Markdown formatting (Headers, Bold, Italic).
-        """
-        start_index = self.text_output.index(tk.END)
-        self.text_output.insert(tk.END, text_chunk)
-        
-        count_var = tk.IntVar()
-
-        # 2. Process Headings
-        # H1
-        while True:
-            pos = self.text_output.search(r"^#\s+", start_index, stopindex=tk.END, regexp=True, count=count_var)
-            if not pos: break
-            match_len = count_var.get()
-            line_end = self.text_output.index(f"{pos} lineend")
-            self.text_output.tag_add("h1", pos, line_end)
-            self.text_output.delete(pos, f"{pos}+{match_len}c") 
-
-        # H2
-        while True:
-            pos = self.text_output.search(r"^##\s+", start_index, stopindex=tk.END, regexp=True, count=count_var)
-            if not pos: break
-            match_len = count_var.get()
-            line_end = self.text_output.index(f"{pos} lineend")
-            self.text_output.tag_add("h2", pos, line_end)
-            self.text_output.delete(pos, f"{pos}+{match_len}c")
-
-        # H3
-        while True:
-            pos = self.text_output.search(r"^###\s+", start_index, stopindex=tk.END, regexp=True, count=count_var)
-            if not pos: break
-            match_len = count_var.get()
-            line_end = self.text_output.index(f"{pos} lineend")
-            self.text_output.tag_add("h3", pos, line_end)
-            self.text_output.delete(pos, f"{pos}+{match_len}c")
-
-        # 3. Process Bold
-        while True:
-            pos = self.text_output.search(r"\*\*.*?\*\*", start_index, stopindex=tk.END, regexp=True, count=count_var)
-            if not pos: break
-            
-            match_len = count_var.get()
-            match_end = f"{pos}+{match_len}c"
-            
-            inner_start = f"{pos}+2c"
-            inner_end = f"{match_end}-2c"
-            
-            self.text_output.tag_add("bold", inner_start, inner_end)
-            self.text_output.delete(inner_end, match_end)
-            self.text_output.delete(pos, inner_start)
-
-        # 4. Process Italic
-        while True:
-            pos = self.text_output.search(r"\*[^*]+\*", start_index, stopindex=tk.END, regexp=True, count=count_var)
-            if not pos: break
-            
-            match_len = count_var.get()
-            match_end = f"{pos}+{match_len}c"
-            
-            inner_start = f"{pos}+1c"
-            inner_end = f"{match_end}-1c"
-            
-            self.text_output.tag_add("italic", inner_start, inner_end)
-            self.text_output.delete(inner_end, match_end)
-            self.text_output.delete(pos, inner_start)
-
-        # 5. Process Inline Code
-        while True:
-            pos = self.text_output.search(r"`[^`]+`", start_index, stopindex=tk.END, regexp=True, count=count_var)
-            if not pos: break
-            
-            match_len = count_var.get()
-            match_end = f"{pos}+{match_len}c"
-            
-            inner_start = f"{pos}+1c"
-            inner_end = f"{match_end}-1c"
-            
-            self.text_output.tag_add("code_span", inner_start, inner_end)
-            self.text_output.delete(inner_end, match_end)
-            self.text_output.delete(pos, inner_start)
-
-
     # --- NEW: Toast Notification ---
 
     def show_toast(self, message, duration=2000):
@@ -298,37 +222,42 @@ class ChatbotGuiLibrary:
         self.show_toast("Code copied to clipboard!") # Trigger toast
 
     def _apply_syntax_highlighting(self, text_widget, code_content, language):
+        """Shows the code at once; colours are applied when the highlighter thread is done."""
+        text_widget.insert("1.0", code_content)
+        self._highlight_code_widget(text_widget, language)
+
+    def _highlight_code_widget(self, text_widget, language, cache: bool = True):
+        """(Re)highlights the widget's current code. Only the newest request for a widget is applied."""
         if not PYGMENTS_AVAILABLE:
-            text_widget.insert("1.0", code_content)
             return
+        text_widget.highlight_generation = getattr(text_widget, 'highlight_generation', 0) + 1
+        future = highlight_async(text_widget.get("1.0", "end-1c"), language, cache=cache)
+        self._apply_highlight_ranges(text_widget, future, text_widget.highlight_generation)
 
+    def _apply_highlight_ranges(self, text_widget, future, generation, start: str = "1.0", clear: bool = True):
+        """
+        Tags the ranges once the highlighter is done. Offsets count from
+        `start`; with clear=False only that new range is tagged (a streamed
+        block is highlighted a piece at a time).
+        """
+        if not future.done():
+            self.root.after(15, self._apply_highlight_ranges, text_widget, future, generation, start, clear)
+            return
+        if not text_widget.winfo_exists() or text_widget.highlight_generation != generation:
+            return # Virtualized away, or superseded by a newer request
         try:
-            if language and language.strip():
-                lexer = get_lexer_by_name(language.strip())
-            else:
-                lexer = guess_lexer(code_content)
-        except Exception:
-            try:
-                lexer = get_lexer_by_name("text")
-            except:
-                text_widget.insert("1.0", code_content)
-                return
-
-        try:
-            style = get_style_by_name('monokai')
-        except:
-            style = get_style_by_name('default')
-
-        for token, opts in style.list_styles():
-            kwargs = {}
-            if opts['color']: kwargs['foreground'] = '#' + opts['color']
-            if opts['bgcolor']: kwargs['background'] = '#' + opts['bgcolor']
-            if opts['bold']: kwargs['font'] = ("Consolas", 11, "bold")
-            if kwargs:
-                text_widget.tag_configure(str(token), **kwargs)
-
-        for token, text in lex(code_content, lexer):
-            text_widget.insert(tk.END, text, str(token))
+            ranges = future.result()
+        except Exception as e:
+            print(f"Error highlighting code block: {e}")
+            return
+        table = style_table()
+        if clear:
+            for tag in text_widget.tag_names():
+                if tag in table:
+                    text_widget.tag_remove(tag, "1.0", tk.END)
+        for tag, spans in ranges.items():
+            text_widget.tag_configure(tag, **table[tag])
+            text_widget.tag_add(tag, *[f"{start}+{offset}c" for offset in spans])
 
     def _render_code_block(self, language, code_content):
         code_bg = "#1E1E1E"
@@ -352,7 +281,7 @@ class ChatbotGuiLibrary:
                              activeforeground="black",
                              font=("Arial", 9, "bold"),
                              bd=0, padx=10, pady=2,
-                             command=lambda: self._copy_to_clipboard(code_content))
+                             command=lambda: self._copy_to_clipboard(code_text_widget.get("1.0", "end-1c")))
         copy_btn.pack(side="right", padx=5, pady=2)
 
         line_count = len(code_content.splitlines())
@@ -368,64 +297,159 @@ class ChatbotGuiLibrary:
         self._apply_syntax_highlighting(code_text_widget, code_content, language)
         code_text_widget.config(state=tk.DISABLED)
         code_text_widget.pack(fill="x", side="top", padx=0, pady=0)
+        block_frame.code_text = code_text_widget
 
         return block_frame
 
     def render_markdown(self, raw_text):
         """Parses the text for code blocks AND markdown syntax."""
-        self.text_output.config(state=tk.NORMAL)
-        
-        pattern = r"```(\w*)\n(.*?)```"
-        last_pos = 0
-        
-        for match in re.finditer(pattern, raw_text, re.DOTALL):
-            start_idx, end_idx = match.span()
-            
-            # 1. Process Text BEFORE code block
-            pre_text = raw_text[last_pos:start_idx]
-            if pre_text:
-                self._insert_markdown_text(pre_text)
-            
-            # 2. Process Code Block
-            language = match.group(1).strip()
-            code_content = match.group(2)
-            if code_content.endswith('\n'):
-                code_content = code_content[:-1]
-
-            code_widget = self._render_code_block(language, code_content)
-            
-            self.text_output.insert(tk.END, "\n")
-            self.text_output.window_create(tk.END, window=code_widget, stretch=1)
-            self.text_output.insert(tk.END, "\n")
-            
-            last_pos = end_idx
-
-        # 3. Process remaining text
-        remaining_text = raw_text[last_pos:]
-        if remaining_text:
-            self._insert_markdown_text(remaining_text)
-            
-        self.text_output.see(tk.END)
-        self.text_output.config(state=tk.DISABLED)
+        at_bottom = self._open_output()
+        self._render_markdown_text(raw_text)
+        self._close_output(at_bottom)
+        self._schedule_virtualize()
+
+    def _render_markdown_text(self, raw_text):
+        # The streaming parser's events, rendered whole: a rebuilt reply (retried, restored,
+        # reopened) looks exactly as it did while streaming, fences included
+        parser = MarkdownStreamParser()
+        code_parts = []
+        for kind, text in parser.feed(raw_text) + parser.close():
+            if kind == 'line':
+                self._insert_markdown_line(text)
+            elif kind == 'code_open':
+                language, code_parts = text, []
+            elif kind == 'code':
+                code_parts.append(text)
+            elif kind == 'code_close':
+                code_content = "".join(code_parts)
+                if code_content.endswith('\n'):
+                    code_content = code_content[:-1]
+                self.text_output.insert(tk.END, "\n")
+                self._add_code_block(language, code_content)
+                self.text_output.insert(tk.END, "\n")
+            # 'partial' text is always followed by its finished 'line'
+
+    # --- Code Block Virtualization ---
+
+    def _add_code_block(self, language, code_content, streaming: bool = False) -> dict:
+        """
+        Appends a code block as a placeholder; _virtualize_code_blocks builds it
+        if it is in view. A streaming block gets its full widget at once and is
+        left alone by virtualization until _finish_stream_code_block().
+        """
+        index = self.text_output.index("end-1c")
+        block = {
+            'index': index, 'line': int(index.split('.')[0]),
+            'language': language, 'code': code_content,
+            'widget': None, 'live': streaming, 'streaming': streaming,
+            'size': self._estimate_code_block_size(code_content),
+        }
+        block['widget'] = self._render_code_block(language, code_content) if streaming else self._make_placeholder(block)
+        self.text_output.window_create(index, window=block['widget'], stretch=1)
+        self.code_blocks.append(block)
+        self.code_block_lines.append(block['line'])
+        return block
+
+    def _estimate_code_block_size(self, code_content) -> tuple:
+        lines = max(1, min(len(code_content.splitlines()), 20))
+        width = self.code_font.measure("0") * 80 + 12
+        height = 27 + lines * self.code_font.metrics("linespace") + 12
+        return width, height
+
+    def _make_placeholder(self, block):
+        width, height = block['size']
+        return tk.Frame(self.text_output, width=width, height=height, bg="#1E1E1E", bd=1, relief="solid")
+
+    def _swap_code_block(self, block, live: bool):
+        old_widget = block['widget']
+        if live:
+            new_widget = self._render_code_block(block['language'], block['code'])
+        else:
+            if old_widget.winfo_ismapped():
+                block['size'] = (old_widget.winfo_width(), old_widget.winfo_height()) # Keep the layout stable
+            new_widget = self._make_placeholder(block)
+        self.text_output.window_configure(block['index'], window=new_widget)
+        old_widget.destroy()
+        block['widget'] = new_widget
+        block['live'] = live
+
+    def _on_output_scrolled(self, first, last):
+        self.chat_scrollbar.set(first, last)
+        self._schedule_virtualize()
+        if self.on_scroll_top is not None and float(first) <= 0.0:
+            self.on_scroll_top()
+
+    def _schedule_virtualize(self):
+        if self._virtualize_pending is None:
+            self._virtualize_pending = self.root.after(30, self._virtualize_code_blocks)
+
+    def _virtualize_code_blocks(self):
+        """Gives blocks near the view full widgets and turns the rest back into placeholders."""
+        self._virtualize_pending = None
+        if not self.code_blocks:
+            return
+        top_line = int(self.text_output.index("@0,0").split('.')[0])
+        bottom_line = int(self.text_output.index(f"@0,{self.text_output.winfo_height()}").split('.')[0])
+        first = bisect_left(self.code_block_lines, top_line - CODE_BLOCK_LIVE_MARGIN)
+        last = bisect_right(self.code_block_lines, bottom_line + CODE_BLOCK_LIVE_MARGIN)
+        wanted = set(range(first, last))
+
+        # Only blocks entering or leaving the window are touched, however long the chat is
+        for i in self.live_code_blocks - wanted:
+            self._swap_code_block(self.code_blocks[i], live=False)
+        for i in wanted - self.live_code_blocks:
+            if not self.code_blocks[i]['streaming']:
+                self._swap_code_block(self.code_blocks[i], live=True)
+        self.live_code_blocks = {i for i in wanted if self.code_blocks[i]['live']}
+
+    def _shift_code_blocks(self, first: int, lines: int):
+        """Moves the recorded positions of blocks[first:] down by `lines` after text was inserted above them."""
+        for i in range(first, len(self.code_blocks)):
+            block = self.code_blocks[i]
+            block['line'] += lines
+            block['index'] = f"{block['line']}.{block['index'].split('.')[1]}"
+            self.code_block_lines[i] = block['line']
+
+    def _drop_code_blocks_from(self, index):
+        """Forgets the blocks at or after `index` (their text is about to be deleted)."""
+        while self.code_blocks and self.text_output.compare(self.code_blocks[-1]['index'], ">=", index):
+            self.code_blocks.pop()
+            self.code_block_lines.pop()
+            self.live_code_blocks.discard(len(self.code_blocks))
+
+    def _reset_code_blocks(self):
+        # Deleting the transcript text destroys the embedded widgets
+        self.code_blocks = []
+        self.code_block_lines = []
+        self.live_code_blocks = set()
 
     # --- Public API Methods ---
 
     def log_output(self, message):
-        self.text_output.config(state=tk.NORMAL)
-        self.text_output.insert(tk.END, f"{message}\n")
-        self.text_output.see(tk.END)
-        self.text_output.config(state=tk.DISABLED)
+        self.transcript.append(('log', message))
+        self._queue_output(f"{message}\n")
 
     def clear_output(self):
+        self.transcript = []
+        self._drop_pending_output()
         self.text_output.config(state=tk.NORMAL)
         self.text_output.delete("1.0", tk.END)
+        for mark in self.text_output.mark_names():
+            if mark.startswith("turn_"):
+                self.text_output.mark_unset(mark)
         self.text_output.config(state=tk.DISABLED)
+        self._reset_code_blocks()
 
     def get_input_text(self):
         text = self.text_input.get("1.0", tk.END).strip()
         self.text_input.delete("1.0", tk.END)
         return text
 
+    def set_input_text(self, text: str):
+        self.text_input.delete("1.0", tk.END)
+        self.text_input.insert("1.0", text)
+        self.text_input.focus()
+
     def set_button_state(self, enabled: bool):
         state = tk.NORMAL if enabled else tk.DISABLED
         self.text_process_button.config(state=state)
@@ -444,6 +468,12 @@ class ChatbotGuiLibrary:
         self.attachment_viewer.see(tk.END)
         self.attachment_viewer.config(state=tk.DISABLED)
 
+    def show_pending_image(self, source_text):
+        self.attachment_viewer.config(state=tk.NORMAL)
+        self.attachment_viewer.insert(tk.END, f"[Image]\n{source_text}\n\n---\n\n")
+        self.attachment_viewer.see(tk.END)
+        self.attachment_viewer.config(state=tk.DISABLED)
+
     def show_pdf_path(self, path_text):
         self.attachment_viewer.config(state=tk.NORMAL)
         self.attachment_viewer.insert(tk.END, f"[PDF]\n{path_text}\n\n---\n\n")
@@ -456,6 +486,18 @@ class ChatbotGuiLibrary:
         self.attachment_viewer.see(tk.END)
         self.attachment_viewer.config(state=tk.DISABLED)
 
+    def show_pasted_text(self, title, preview):
+        self.attachment_viewer.config(state=tk.NORMAL)
+        self.attachment_viewer.insert(tk.END, f"[Pasted Text]\n{title}\n{preview}\n\n---\n\n")
+        self.attachment_viewer.see(tk.END)
+        self.attachment_viewer.config(state=tk.DISABLED)
+
+    def show_folder_path(self, path_text):
+        self.attachment_viewer.config(state=tk.NORMAL)
+        self.attachment_viewer.insert(tk.END, f"[Folder]\n{path_text}\n\n---\n\n")
+        self.attachment_viewer.see(tk.END)
+        self.attachment_viewer.config(state=tk.DISABLED)
+
     def get_personality_text(self):
         try:
             return self.personality_input.get("1.0", tk.END).strip()
@@ -470,19 +512,412 @@ class ChatbotGuiLibrary:
             print(f"Error setting personality text: {e}")
 
     def show_thinking_indicator(self):
-        self.text_output.config(state=tk.NORMAL)
+        at_bottom = self._open_output()
         self.thinking_message_start_index = self.text_output.index(f"{tk.END} -1c")
         self.text_output.insert(tk.END, "\n--- Chatbot ---\nChatbot is thinking...")
-        self.text_output.see(tk.END)
-        self.text_output.config(state=tk.DISABLED)
+        self._close_output(at_bottom)
 
     def replace_thinking_indicator(self, final_message_content: str):
         if self.thinking_message_start_index:
+            self._flush_output()
             self.text_output.config(state=tk.NORMAL)
             self.text_output.delete(self.thinking_message_start_index, tk.END)
-            self.text_output.insert(tk.END, f"\n\n--- Chatbot ---\n")
-            self.render_markdown(final_message_content)
+            self._insert_reply(final_message_content)
+            self.thinking_message_start_index = None
+        else:
+            self._insert_reply(final_message_content)
+
+    def _insert_reply(self, content: str):
+        self.transcript.append(('reply', content))
+        at_bottom = self._open_output()
+        self.text_output.insert(tk.END, f"\n\n--- Chatbot ---\n")
+        self._render_markdown_text(content)
+        self._close_output(at_bottom)
+        self._schedule_virtualize()
+
+    # --- Output Buffer ---
+
+    def _queue_output(self, text: str, tags: tuple = ()):
+        """Adds an insert for the next frame; bursts of output cost one layout pass per frame."""
+        self._pending_output.append((text, tags))
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self._flush_id is None:
+            self._flush_id = self.root.after(OUTPUT_FLUSH_INTERVAL, self._flush_output)
+
+    def _flush_output(self):
+        """Draws everything queued since the last frame with a single state toggle and see()."""
+        if self._flush_id is not None:
+            self.root.after_cancel(self._flush_id)
+            self._flush_id = None
+        if not (self._pending_output or self._pending_chunks) or not self.text_output.winfo_exists():
+            return
+        output, chunks = self._pending_output, self._pending_chunks
+        self._pending_output, self._pending_chunks = [], []
+
+        at_bottom = self._at_bottom()
+        self.text_output.config(state=tk.NORMAL)
+        if output:
+            args = []
+            for text, tags in output:
+                args += [text, tags]
+            self.text_output.insert(tk.END, *args)
+        if chunks and self._stream is not None:
+            self._render_stream_events(self._stream['parser'].feed("".join(chunks)))
+        self._close_output(at_bottom)
+
+    def _drop_pending_output(self):
+        if self._flush_id is not None:
+            self.root.after_cancel(self._flush_id)
+            self._flush_id = None
+        self._pending_output, self._pending_chunks = [], []
+
+    def _at_bottom(self) -> bool:
+        """False when the user has scrolled up to read; new output then leaves the view alone."""
+        return self.text_output.yview()[1] >= 0.999
+
+    def _open_output(self) -> bool:
+        """Draws queued output first (to keep the order), then makes the transcript writable."""
+        self._flush_output()
+        at_bottom = self._at_bottom()
+        self.text_output.config(state=tk.NORMAL)
+        return at_bottom
+
+    def _close_output(self, at_bottom: bool):
+        self.text_output.config(state=tk.DISABLED)
+        if at_bottom:
+            self.text_output.see(tk.END)
+
+    # --- Streaming Replies ---
+
+    @property
+    def streaming(self) -> bool:
+        return self._stream is not None
+
+    def begin_streaming_reply(self):
+        """Replaces the thinking indicator with an empty reply that append_streaming_reply() fills."""
+        at_bottom = self._open_output()
+        if self.thinking_message_start_index:
+            self.text_output.delete(self.thinking_message_start_index, tk.END)
             self.thinking_message_start_index = None
+        self.text_output.mark_set("stream_start", "end-1c")
+        self.text_output.mark_gravity("stream_start", tk.LEFT)
+        self.text_output.insert(tk.END, "\n\n--- Chatbot ---\n")
+        self.text_output.mark_set("reply_start", "end-1c")
+        self.text_output.mark_gravity("reply_start", tk.LEFT)
+        self._close_output(at_bottom)
+        self._stream = {
+            'parser': MarkdownStreamParser(), 'parts': [], 'tail': False,
+            'block': None, 'highlight': None, 'first_block': len(self.code_blocks),
+        }
+
+    def append_streaming_reply(self, chunk: str):
+        """
+        Queues one chunk of the reply. The chunks of a frame are parsed and drawn
+        together, at a cost that depends on them, not on the reply so far.
+        """
+        self._stream['parts'].append(chunk)
+        self._pending_chunks.append(chunk)
+        self._schedule_flush()
+
+    def finish_streaming_reply(self, final_message_content: str, reply: str):
+        """
+        Completes the streamed reply and adds the header line (timing) above it.
+        If the final reply isn't what was streamed (a retry or an error), the
+        streamed text is replaced by the final message.
+        """
+        stream = self._stream
+        streamed = "".join(stream['parts'])
+        at_bottom = self._open_output()
+        if streamed == reply and final_message_content.endswith(reply + "\n"):
+            self._render_stream_events(stream['parser'].feed("\n") + stream['parser'].close())
+            prefix = final_message_content[:len(final_message_content) - len(reply) - 1]
+            self.text_output.insert("reply_start", prefix)
+            self._shift_code_blocks(stream['first_block'], prefix.count("\n"))
+            self.transcript.append(('reply', final_message_content))
         else:
-            self.log_output(f"\n--- Chatbot ---")
-            self.render_markdown(final_message_content)
\ No newline at end of file
+            if stream['highlight'] is not None:
+                self.root.after_cancel(stream['highlight'])
+            self._drop_code_blocks_from("reply_start")
+            self.text_output.delete("reply_start", tk.END)
+            self.transcript.append(('reply', final_message_content))
+            self._render_markdown_text(final_message_content)
+            self._schedule_virtualize()
+        self._stream = None
+        self._close_output(at_bottom)
+
+    def discard_streaming_reply(self):
+        """Removes a reply that is being retried and puts the thinking indicator back."""
+        if self._stream['highlight'] is not None:
+            self.root.after_cancel(self._stream['highlight'])
+        self._stream = None
+        self._pending_chunks = []
+        at_bottom = self._open_output()
+        self._drop_code_blocks_from("stream_start")
+        self.text_output.delete("stream_start", tk.END)
+        self._close_output(at_bottom)
+        self.show_thinking_indicator()
+
+    def abandon_streaming_reply(self):
+        """Keeps what was streamed of a cancelled reply and ends the stream."""
+        at_bottom = self._open_output()
+        self._render_stream_events(self._stream['parser'].close())
+        self.transcript.append(('reply', "".join(self._stream['parts'])))
+        self._stream = None
+        self._close_output(at_bottom)
+
+    def _render_stream_events(self, events: list):
+        """Applies parser events to the (already writable) transcript."""
+        stream = self._stream
+        for kind, text in events:
+            if kind == 'partial':
+                if not stream['tail']:
+                    self.text_output.mark_set("stream_tail", "end-1c")
+                    self.text_output.mark_gravity("stream_tail", tk.LEFT)
+                    stream['tail'] = True
+                self.text_output.insert(tk.END, text)
+                continue
+            if stream['tail']:
+                # The finished line replaces its raw partial text
+                self.text_output.delete("stream_tail", "end-1c")
+                stream['tail'] = False
+            if kind == 'line':
+                self._insert_markdown_line(text)
+            elif kind == 'code_open':
+                self.text_output.insert(tk.END, "\n")
+                stream['block'] = self._add_code_block(text, "", streaming=True)
+                stream['block_line'] = 1 # First line of the block not highlighted yet
+            elif kind == 'code':
+                self._append_stream_code(text)
+            elif kind == 'code_close':
+                self._finish_stream_code_block()
+
+    def _insert_markdown_line(self, line: str):
+        """Inserts one finished line with heading and inline formatting, in a single insert call."""
+        line_tags = ()
+        heading = HEADING_PATTERN.match(line)
+        if heading:
+            line_tags = (f"h{len(heading.group(1))}",)
+            line = line[heading.end():]
+        args = []
+        for text, tag in inline_segments(line):
+            args += [text, line_tags + ((tag,) if tag else ())]
+        if args:
+            self.text_output.insert(tk.END, *args)
+
+    def _append_stream_code(self, text: str):
+        stream = self._stream
+        code_text = stream['block']['widget'].code_text
+        code_text.config(state=tk.NORMAL)
+        code_text.insert(tk.END, text)
+        code_text.config(state=tk.DISABLED)
+        lines = int(code_text.index("end-1c").split('.')[0])
+        if lines <= 20 and lines != int(code_text.cget("height")):
+            code_text.config(height=lines)
+        # Highlight the newly finished lines a few times a second, not per token
+        if stream['highlight'] is None:
+            stream['highlight'] = self.root.after(150, self._highlight_stream_code)
+
+    def _highlight_stream_code(self):
+        stream = self._stream
+        if stream is None or stream['block'] is None:
+            return
+        stream['highlight'] = None
+        block = stream['block']
+        code_text = block['widget'].code_text
+        # Only the lines finished since the last pass are lexed and tagged, so a pass costs
+        # the new code, not the block so far. A construct spanning passes (a long string or
+        # comment) may be coloured wrongly until the block closes and is highlighted whole.
+        first, end_line = stream['block_line'], int(code_text.index("end-1c").split('.')[0])
+        if not PYGMENTS_AVAILABLE or first >= end_line:
+            return
+        code = code_text.get(f"{first}.0", f"{end_line}.0")
+        if first == 1:
+            # Unlabelled code is guessed once, from the first lines, not per piece
+            stream['block_language'] = block['language'] or guess_language(code)
+        stream['block_line'] = end_line
+        generation = getattr(code_text, 'highlight_generation', 0)
+        code_text.highlight_generation = generation
+        future = highlight_async(code, stream['block_language'], cache=False)
+        self._apply_highlight_ranges(code_text, future, generation, start=f"{first}.0", clear=False)
+
+    def _finish_stream_code_block(self):
+        stream = self._stream
+        block = stream['block']
+        code_text = block['widget'].code_text
+        if code_text.get("end-2c") == "\n":
+            code_text.config(state=tk.NORMAL)
+            code_text.delete("end-2c")
+            code_text.config(state=tk.DISABLED)
+        if stream['highlight'] is not None:
+            self.root.after_cancel(stream['highlight'])
+            stream['highlight'] = None
+        block['code'] = code_text.get("1.0", "end-1c")
+        block['streaming'] = False
+        self.live_code_blocks.add(len(self.code_blocks) - 1)
+        self._highlight_code_widget(code_text, block['language'])
+        self.text_output.insert(tk.END, "\n")
+        stream['block'] = None
+        self._schedule_virtualize()
+
+    # --- Saved History ---
+
+    def mark_turn(self, seq: int):
+        """Marks where turn `seq` of the saved chat starts (call before showing its question)."""
+        self._flush_output()
+        self._set_turn_mark(seq, "end-1c")
+        self.transcript.append(('turn', seq))
+
+    def _set_turn_mark(self, seq: int, index: str):
+        self.text_output.mark_set(f"turn_{seq}", index)
+        self.text_output.mark_gravity(f"turn_{seq}", tk.LEFT)
+
+    def scroll_to_turn(self, seq: int) -> bool:
+        """Shows turn `seq` at the top of the chat. False if it isn't loaded."""
+        self._flush_output()
+        mark = f"turn_{seq}"
+        if mark not in self.text_output.mark_names():
+            return False
+        self.text_output.yview(mark)
+        return True
+
+    def show_saved_turn(self, seq: int, prompt: str, reply: str):
+        """Appends one turn of a reopened chat, formatted like a live one."""
+        self.mark_turn(seq)
+        self.log_output(f"\n--- Me ---\n{prompt}")
+        self._insert_reply(f"{reply}\n")
+
+    def truncate_from_turn(self, seq: int):
+        """Removes turn `seq` and everything shown after it (the chat was rewound to before it)."""
+        self._flush_output()
+        mark = f"turn_{seq}"
+        if mark not in self.text_output.mark_names():
+            return
+        self._drop_code_blocks_from(mark)
+        self.text_output.config(state=tk.NORMAL)
+        self.text_output.delete(mark, tk.END)
+        self.text_output.config(state=tk.DISABLED)
+        for name in self.text_output.mark_names():
+            if name.startswith("turn_") and int(name[5:]) >= seq:
+                self.text_output.mark_unset(name)
+        for i in range(len(self.transcript) - 1, -1, -1):
+            if self.transcript[i][0] == 'turn' and self.transcript[i][1] == seq:
+                del self.transcript[i:]
+                break
+
+    def _turn_at(self, index: str) -> int | None:
+        """Seq of the turn shown at `index`: the nearest turn mark before it."""
+        mark = self.text_output.mark_previous(f"{index} +1c")
+        while mark is not None and not mark.startswith("turn_"):
+            mark = self.text_output.mark_previous(mark)
+        return int(mark[5:]) if mark is not None else None
+
+    def _on_output_right_click(self, event):
+        if self.turn_menu_items is None:
+            return
+        self._flush_output()
+        seq = self._turn_at(f"@{event.x},{event.y}")
+        items = self.turn_menu_items(seq) if seq is not None else []
+        if not items:
+            return
+        menu = tk.Menu(self.text_output, tearoff=0)
+        for label, command in items:
+            menu.add_command(label=label, command=command, state=tk.NORMAL if command else tk.DISABLED)
+        try:
+            menu.tk_popup(event.x_root, event.y_root)
+        finally:
+            menu.grab_release()
+
+    def prepend_transcript(self, entries: list):
+        """
+        Inserts older transcript entries above everything shown, as plain
+        text (like the older part of a restored tab). The view stays on the
+        text the user was looking at.
+        """
+        text, marks = self._plain_transcript(entries)
+        self._flush_output()
+        top_line = int(self.text_output.index("@0,0").split('.')[0])
+        lines = text.count("\n")
+        # Turn marks keep left gravity, so one at the very top would stay above the new text
+        top_marks = [name for name in self.text_output.mark_names()
+                     if name.startswith("turn_") and self.text_output.index(name) == "1.0"]
+        self.text_output.config(state=tk.NORMAL)
+        self.text_output.insert("1.0", text)
+        self.text_output.config(state=tk.DISABLED)
+        for name in top_marks:
+            self.text_output.mark_set(name, f"{lines + 1}.0")
+        for seq, line in marks:
+            self._set_turn_mark(seq, f"{line + 1}.0")
+        self._shift_code_blocks(0, lines)
+        self.transcript[:0] = entries
+        self.text_output.yview(f"{top_line + lines}.0")
+
+    def _plain_transcript(self, entries: list) -> tuple[str, list]:
+        """The entries as plain text, and (turn seq, line offset) for each turn mark."""
+        parts = []
+        marks = []
+        lines = 0
+        for kind, text in entries:
+            if kind == 'turn':
+                marks.append((text, lines))
+                continue
+            part = f"\n\n--- Chatbot ---\n{text}\n" if kind == 'reply' else f"{text}\n"
+            parts.append(part)
+            lines += part.count("\n")
+        return "".join(parts), marks
+
+    # --- Hibernation ---
+
+    def snapshot(self) -> dict:
+        """Everything needed to rebuild this view: transcript, persona and the unsent draft."""
+        return {
+            'transcript': list(self.transcript),
+            'persona': self.persona_var.get(),
+            'personality': self.get_personality_text(),
+            'draft': self.text_input.get("1.0", "end-1c"),
+        }
+
+    def cancel_callbacks(self):
+        """Cancels pending redraws; called before the widgets are destroyed."""
+        pending = [self._virtualize_pending, self._flush_id]
+        if self._stream is not None:
+            pending.append(self._stream['highlight'])
+        for after_id in pending:
+            if after_id is not None:
+                self.root.after_cancel(after_id)
+        self._virtualize_pending = None
+        self._flush_id = None
+
+    def restore(self, state: dict, render_chars: int):
+        """
+        Rebuilds the view from snapshot(). Only the newest `render_chars` of
+        the transcript are rendered as markdown (code blocks are widgets and
+        slow to build); everything older is inserted as plain text in one go.
+        """
+        transcript = state['transcript']
+        split = len(transcript)
+        while split > 0 and render_chars > 0:
+            split -= 1
+            kind, text = transcript[split]
+            if kind != 'turn':
+                render_chars -= len(text)
+
+        text, marks = self._plain_transcript(transcript[:split])
+        at_bottom = self._open_output()
+        self.text_output.insert(tk.END, text)
+        self._close_output(at_bottom)
+        for seq, line in marks:
+            self._set_turn_mark(seq, f"{line + 1}.0")
+        for kind, text in transcript[split:]:
+            if kind == 'reply':
+                self._insert_reply(text)
+            elif kind == 'turn':
+                self.mark_turn(text)
+            else:
+                self.log_output(text)
+        self.transcript = list(transcript)
+
+        self.persona_dropdown.set(state['persona'])
+        self.set_personality_text(state['personality'])
+        self.text_input.insert("1.0", state['draft'])
\ No newline at end of file
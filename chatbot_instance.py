@@ -1,29 +1,26 @@
 import tkinter as tk
+from tkinter import ttk
 import threading
 import queue
 import os
-import io
-import time
+import json
 import platform
 import re
+import time
 
 # Pillow
 from PIL import ImageGrab, Image, ImageTk
 
-# Ollama
-import ollama
-
 # This project's modules
 from chatbot_gui_library import ChatbotGuiLibrary
+from chat_session import ChatSession
+from attachment_pool import get_attachment_pool
+from session_store import get_session_store
 from config import (
-    DEFAULT_SYSTEM_PROMPT, THUMBNAIL_SIZE, 
-    PDF_EXTENSIONS, TEXT_EXTENSIONS, IMAGE_EXTENSIONS, 
-    PDF_FUNCTIONALITY_DISABLED, MAX_RETRIES
-)
-from utils import (
-    read_image_bytes_from_file, read_text_file, extract_pdf_text
+    DEFAULT_SYSTEM_PROMPT, THUMBNAIL_SIZE, TAB_WAKE_RENDER_CHARS,
+    PASTE_ATTACHMENT_MIN_CHARS, PASTE_PREVIEW_CHARS,
+    SESSION_STORE_ENABLED, SESSION_PAGE_TURNS, PREWARM_ENABLED, PREWARM_DELAY
 )
-from ollama_client import execute_ollama_call
 
 # --- PLATFORM-SPECIFIC IMPORTS ---
 try:
@@ -40,22 +37,31 @@ except ImportError:
     pass
 # --- END PLATFORM-SPECIFIC IMPORTS ---
 
+_EDITING_KEYSYMS = {"BackSpace", "Delete", "Return", "Tab"}
+_CONTROL_MASK = 0x4
+
+def _is_editing_key(event) -> bool:
+    """Whether a key press changes the message being typed (not arrows, modifiers or shortcuts)."""
+    if event.keysym in _EDITING_KEYSYMS:
+        return True
+    if event.state & _CONTROL_MASK:
+        return event.keysym.lower() in ("v", "x") # Paste, cut
+    return bool(event.char) and event.char.isprintable()
+
 
 class ChatbotInstance:
     """
     This class manages the logic and state for a *single* chat tab.
     It acts as the controller, connecting the GUI (View) to the Ollama (Model) logic.
     """
-    def __init__(self, parent_tab_frame, close_callback, chat_mode: str, selected_model: str, use_gpu: bool):
+    def __init__(self, parent_tab_frame, close_callback, chat_mode: str, selected_model: str, use_gpu: bool,
+                 use_cache: bool = True, use_semantic_cache: bool = False, history_id: str | None = None):
 
         # 1. State
         self.root = parent_tab_frame
         self.close_callback = close_callback
         self.logic_queue = queue.Queue()
 
-        self.image_attachments = [] 
-        self.pdf_attachments = []   
-        self.text_attachments = []  
         self.attachment_photo_refs = [] 
 
         self.processing = False
@@ -63,10 +69,54 @@ class ChatbotInstance:
         self.selected_model = selected_model
         self.use_gpu = use_gpu
 
-        # 2. LLM State
-        self.client = ollama.Client()
-        self.messages = [] 
+        self.last_active = time.monotonic() # Last time the tab was visible (for hibernation)
+        self.hibernated_path = None
+        self._unsaved_state = None
+        self._save_thread = None
+        self._wake_id = None      # Pending check for the save to finish before waking
+        self._wake_callbacks = [] # Called once the tab is awake
+        self._poll_id = None
+        self._prewarm_id = None # Pending prewarm, started PREWARM_DELAY ms after typing begins
+
+        # Paging of a reopened saved chat: turns before this one are still on disk
+        self.history_first_id = None
+        self.history_first_seq = None
+        self.history_more = False
+        self.history_loading = False
+        self.jump_target = None     # (turn id, seq) to show once it has been paged in (from a search result)
+        self.editing = None         # (turn id, seq) of the message being edited; the chat is rewound when it is sent
+        self.opening = False        # A saved chat is being read in
+        self._opened_callbacks = [] # Called once it is shown
+        self._hibernated_history_id = None
+
+        # 2. Conversation engine (history, attachments, Ollama calls)
+        self.session = ChatSession(
+            selected_model, chat_mode, use_gpu,
+            use_cache=use_cache,
+            use_semantic_cache=use_semantic_cache,
+            **self._session_hooks()
+        )
+
+        # 3.-5. GUI View, bindings and the queue-checking loop
+        self._build_view()
 
+        # 6. Start the chat (or reopen a saved one)!
+        if history_id is not None:
+            self.open_saved_chat(history_id)
+        else:
+            self.start_new_chat()
+
+    def _session_hooks(self) -> dict:
+        """ChatSession arguments that connect it to this tab."""
+        return {
+            'event_queue': self.logic_queue,
+            # Attachments are prepared in the background; refresh the sidebar as each one is ready
+            'on_attachment_ready': lambda: self.logic_queue.put(("ATTACHMENTS", None)),
+            'thumbnail_size': THUMBNAIL_SIZE,
+            'history_store': get_session_store() if SESSION_STORE_ENABLED else None,
+        }
+
+    def _build_view(self):
         # 3. Create the GUI View
         self.gui = ChatbotGuiLibrary(
             self.root,
@@ -76,18 +126,19 @@ class ChatbotInstance:
 
         # 4. Bind GUI widgets to controller methods
         self.setup_gui_bindings()
+        self.gui.on_scroll_top = self.load_older_turns
+        self.gui.turn_menu_items = self.turn_menu_items
 
         # 5. Start the queue-checking loop
-        self.root.after(100, self.check_logic_queue)
-
-        # 6. Start the chat!
-        self.start_new_chat()
+        self._poll_id = self.root.after(100, self.check_logic_queue)
 
     def setup_gui_bindings(self):
         """Binds all GUI buttons to their controller methods."""
         self.gui.text_process_button.config(command=self.on_send_message)
         self.gui.restart_button.config(command=self.on_restart_chat)
         self.gui.close_button.config(command=self.on_closing)
+        if PREWARM_ENABLED:
+            self.gui.text_input.bind("<KeyPress>", self.on_typing, add="+")
 
     def start_new_chat(self):
         """Clears the screen and state for a new chat."""
@@ -112,15 +163,294 @@ class ChatbotInstance:
 
         self.gui.log_output("--------------------------------------------------")
 
-        self.messages.clear()
+        self.session.reset()
+        self.editing = None
         self.gui.set_personality_text(DEFAULT_SYSTEM_PROMPT)
 
-        self.image_attachments.clear()
-        self.pdf_attachments.clear()
-        self.text_attachments.clear()
         self.attachment_photo_refs.clear()
         self.processing = False
         self.gui.set_button_state(True)
+        self.history_more = False
+
+    def _read_history(self, work, then):
+        """
+        Runs work() (store reads) on a thread and then(result) on the Tk thread,
+        through the logic queue like every other update. `result` is None if
+        the read failed, or if the tab was restarted, unloaded or woken meanwhile
+        (then() is not called at all in that case).
+        """
+        session = self.session
+
+        def run():
+            try:
+                result = work()
+            except Exception as e:
+                print(f"Error reading chat history: {e}")
+                result = None
+            self.logic_queue.put(("HISTORY_READ", (session, then, result)))
+        threading.Thread(target=run, daemon=True).start()
+
+    def open_saved_chat(self, history_id: str, head_id: int | None = None, on_ready=None):
+        """
+        Shows the newest turns of a saved chat (of the branch ending at
+        `head_id`, default: the one shown last) and continues it; older turns
+        load on scroll. They are read in the background; `on_ready` is called
+        once they are shown.
+        """
+        store = self.session.history_store
+        if store is None:
+            self.start_new_chat()
+            self.gui.log_output("[!!] The saved chat could not be found. [!!]")
+            return
+        self.processing = True
+        self.opening = True
+        if on_ready is not None:
+            self._opened_callbacks.append(on_ready)
+        self.gui.set_button_state(False)
+        self.gui.log_output("\n[Opening saved chat...]")
+
+        def read():
+            meta = store.load_session(history_id)
+            return meta, (store.load_turns(history_id, head_id=head_id) if meta is not None else [])
+        self._read_history(read, lambda result: self._show_saved_chat(history_id, head_id, result))
+
+    def _show_saved_chat(self, history_id: str, head_id: int | None, result: tuple | None):
+        self.processing = False
+        self.opening = False
+        callbacks, self._opened_callbacks = self._opened_callbacks, []
+        self.gui.set_button_state(True)
+        meta, turns = result or (None, [])
+        if meta is None:
+            self.start_new_chat()
+            self.gui.log_output("[!!] The saved chat could not be found. [!!]")
+            return
+
+        store = self.session.history_store
+        if head_id is not None:
+            store.set_head(history_id, head_id)
+        self.gui.clear_output()
+        self.gui.clear_attachment_viewer()
+        self.session.reset()
+        self.editing = None
+        self.session.history_id = history_id
+        self.session.set_system_prompt(meta['system_prompt'])
+        self.gui.set_personality_text(meta['system_prompt'] or DEFAULT_SYSTEM_PROMPT)
+        self.session.append_turns(turns)
+        for turn in turns:
+            self.gui.show_saved_turn(turn['seq'], turn['prompt'], turn['reply'])
+        self.gui.log_output(f"\n[Reopened saved chat \"{meta['title']}\" ({self.session.history_turns} turns).]")
+
+        self._set_history_first(turns[0] if turns else None)
+        for callback in callbacks:
+            callback()
+
+    def _set_history_first(self, turn: dict | None):
+        """Records the oldest loaded turn; the next page is read from before it."""
+        self.history_first_id = turn['id'] if turn else None
+        self.history_first_seq = turn['seq'] if turn else None
+        self.history_more = turn is not None and turn['parent_id'] is not None
+
+    @property
+    def history_id(self) -> str | None:
+        """The saved chat shown in this tab, if any (also while hibernated)."""
+        return self.session.history_id if self.session is not None else self._hibernated_history_id
+
+    def jump_to_turn(self, turn_id: int, seq: int):
+        """
+        Scrolls to saved turn `turn_id` (turn `seq` of its branch), paging in
+        older turns first, or switching to its branch, if it isn't shown.
+        """
+        self.jump_target = None
+        if self.opening:
+            self._opened_callbacks.append(lambda: self.jump_to_turn(turn_id, seq))
+            return
+        if any(turn['id'] == turn_id for turn in self.session.turns):
+            self.gui.scroll_to_turn(seq)
+            return
+        store, history_id = self.session.history_store, self.session.history_id
+        head, more = self.session.history_head, self.history_more
+
+        def find():
+            if more and store.on_branch(head, turn_id):
+                return 'older', None
+            return 'branch', store.branch_leaf(turn_id)
+
+        def show(result):
+            if result is None or history_id != self.session.history_id:
+                return
+            where, leaf = result
+            if where == 'older':
+                self.jump_target = (turn_id, seq)
+                self.load_older_turns()
+            elif leaf is not None and not self.processing:
+                self.open_saved_chat(history_id, head_id=leaf[0], on_ready=lambda: self._jump_in_branch(turn_id, seq))
+        self._read_history(find, show)
+
+    def _jump_in_branch(self, turn_id: int, seq: int):
+        """Second half of jump_to_turn once the turn's branch is shown."""
+        if any(turn['id'] == turn_id for turn in self.session.turns):
+            self.gui.scroll_to_turn(seq)
+        elif self.history_more:
+            self.jump_target = (turn_id, seq)
+            self.load_older_turns()
+
+    def load_older_turns(self):
+        """Reads the previous page of a reopened chat in the background (the chat was scrolled to the top)."""
+        if not self.history_more or self.history_loading or self.hibernated:
+            return
+        self.history_loading = True
+        store, history_id, before = self.session.history_store, self.session.history_id, self.history_first_id
+        limit = SESSION_PAGE_TURNS
+        if self.jump_target is not None:
+            limit = max(limit, self.history_first_seq - self.jump_target[1])
+
+        def load():
+            try:
+                turns = store.load_turns(history_id, before_id=before, limit=limit)
+            except Exception as e:
+                print(f"Error loading older turns: {e}")
+                turns = []
+            self.logic_queue.put(("HISTORY", (history_id, before, turns)))
+        threading.Thread(target=load, daemon=True).start()
+
+    def _show_older_turns(self, history_id: str, before: int, turns: list):
+        self.history_loading = False
+        if self.hibernated or history_id != self.session.history_id or before != self.history_first_id:
+            return # The chat was restarted, unloaded or switched to another branch meanwhile
+        if not turns:
+            self.history_more = False
+            return
+        self.session.prepend_turns(turns)
+        entries = []
+        for turn in turns:
+            entries += [('turn', turn['seq']), ('log', f"\n--- Me ---\n{turn['prompt']}"),
+                        ('reply', f"{turn['reply']}\n")]
+        self.gui.prepend_transcript(entries)
+        self._set_history_first(turns[0])
+        if self.jump_target is not None:
+            self.jump_to_turn(*self.jump_target)
+
+    # --- Branches (edit, regenerate, versions) ---
+
+    def _turn_index(self, seq: int) -> int | None:
+        """Position in session.turns of turn `seq` of the current branch (None if it isn't loaded)."""
+        index = seq - (self.session.history_turns - len(self.session.turns)) - 1
+        return index if 0 <= index < len(self.session.turns) else None
+
+    def turn_menu_items(self, seq: int) -> list:
+        """Context-menu entries for turn `seq` (right-click in the chat)."""
+        index = self._turn_index(seq)
+        if index is None:
+            return []
+        if self.processing:
+            return [("Wait for the reply to finish to edit or regenerate", None)]
+        items = [
+            ("Edit and Resend Message", lambda: self.edit_turn(seq)),
+            ("Regenerate Reply", lambda: self.regenerate_turn(seq)),
+        ]
+        if self.editing is not None:
+            items.append((f"Cancel Editing Message {self.editing[1]}", self.cancel_edit))
+        # Versions are kept with the loaded turns, so the menu never waits on the store
+        versions = self.session.turns[index]['versions']
+        if len(versions) > 1:
+            position = versions.index(self.session.turns[index]['id'])
+            items.append((f"Previous Version ({position + 1}/{len(versions)})",
+                          (lambda: self.switch_version(seq, -1)) if position > 0 else None))
+            items.append((f"Next Version ({position + 1}/{len(versions)})",
+                          (lambda: self.switch_version(seq, 1)) if position < len(versions) - 1 else None))
+        return items
+
+    def edit_turn(self, seq: int):
+        """
+        Puts turn `seq`'s message back in the input box to edit. The chat is
+        only rewound to before it when the edited message is sent, so until
+        then nothing is lost (see cancel_edit).
+        """
+        index = self._turn_index(seq)
+        if self.processing or index is None:
+            return
+        turn = self.session.turns[index]
+        self.editing = (turn['id'], seq)
+        self.gui.log_output(f"\n[Editing message {seq}. Sending it starts a new version; the old one stays saved. "
+                            "Right-click the chat to cancel.]")
+        message = self.session.user_message(index)
+        if message['content'] != turn['prompt'] or message.get('images'):
+            self.gui.log_output("[Its attachments are not sent again; attach them if they are still needed.]")
+        self.gui.set_input_text(turn['prompt'])
+
+    def cancel_edit(self):
+        """Drops the pending edit; the chat stays as it is."""
+        if self.editing is None:
+            return
+        self.editing = None
+        self.gui.set_input_text("")
+        self.gui.log_output("[Edit cancelled.]")
+
+    def _apply_edit(self):
+        """Rewinds the chat to before the message being edited (called as the edited message is sent)."""
+        turn_id, seq = self.editing
+        self.editing = None
+        index = self._turn_index(seq)
+        if index is None or self.session.turns[index]['id'] != turn_id:
+            return # The chat changed meanwhile; the message is sent as a new turn
+        self.session.rewind(index)
+        self.gui.truncate_from_turn(seq)
+
+    def regenerate_turn(self, seq: int):
+        """Asks for a new reply to turn `seq`'s message, as a new version of that turn."""
+        index = self._turn_index(seq)
+        if self.processing or index is None:
+            return
+        self._cancel_prewarm()
+        self.editing = None
+        turn = self.session.rewind(index)
+        self.gui.truncate_from_turn(seq)
+        self.gui.mark_turn(seq)
+        self.gui.log_output(f"\n--- Me (regenerating) ---\n{turn['prompt']}")
+        self.session.set_system_prompt(self.gui.get_personality_text() or DEFAULT_SYSTEM_PROMPT)
+        self.start_processing_thread(
+            target=self.process_message_thread,
+            args=(turn['prompt'], turn['user_message'])
+        )
+
+    def switch_version(self, seq: int, step: int):
+        """Shows the previous (step -1) or next (step 1) version of turn `seq`, with the rest of its branch."""
+        index = self._turn_index(seq)
+        if self.processing or index is None:
+            return
+        turn_id, versions = self.session.turns[index]['id'], self.session.turns[index]['versions']
+        position = versions.index(turn_id) + step
+        if not 0 <= position < len(versions):
+            return
+        store, history_id = self.session.history_store, self.session.history_id
+        self.processing = True
+        self.gui.set_button_state(False)
+
+        def read():
+            store.flush(timeout=2.0) # The version may have been sent moments ago and still be queued
+            leaf = store.branch_leaf(versions[position])
+            if leaf is None:
+                return None
+            return leaf[0], store.load_turns(history_id, head_id=leaf[0], limit=leaf[1] - seq + 1)
+        self._read_history(read, lambda result: self._show_version(seq, turn_id, result))
+
+    def _show_version(self, seq: int, turn_id: int, result: tuple | None):
+        """Second half of switch_version, once the other version's branch has been read."""
+        self.processing = False
+        self.gui.set_button_state(True)
+        index = self._turn_index(seq)
+        if result is None or index is None or self.session.turns[index]['id'] != turn_id:
+            return
+        leaf_id, turns = result
+        store, history_id = self.session.history_store, self.session.history_id
+        self.editing = None
+        self.session.rewind(index)
+        self.session.append_turns(turns)
+        store.set_head(history_id, leaf_id)
+        self.gui.truncate_from_turn(seq)
+        for turn in turns:
+            self.gui.show_saved_turn(turn['seq'], turn['prompt'], turn['reply'])
+        self.gui.scroll_to_turn(seq)
 
     def on_restart_chat(self):
         if self.processing:
@@ -176,35 +506,9 @@ class ChatbotInstance:
         """Attaches a list of file paths."""
         file_added = False
         for file_path in file_paths:
-            if not os.path.exists(file_path):
-                self.gui.log_output(f"[!!] Error: {source.title()} file path not found: {file_path} [!!]")
-                continue
-
-            ext = os.path.splitext(file_path)[1].lower()
-
-            if ext in IMAGE_EXTENSIONS:
-                if self.chat_mode == 'llm_only':
-                    self.gui.log_output("[!!] Image attachments are disabled for this LLM. [!!]")
-                    continue
-                self.image_attachments.append({'type': 'image', 'path': file_path})
-                self.gui.log_output(f"\n[+] Image {len(self.image_attachments)} {source}: {os.path.basename(file_path)}")
-                file_added = True
-
-            elif ext in PDF_EXTENSIONS:
-                if PDF_FUNCTIONALITY_DISABLED:
-                    self.gui.log_output("[!!] PDF processing is disabled. Please install 'pypdf'. [!!]")
-                    continue
-                self.pdf_attachments.append({'type': 'pdf', 'path': file_path})
-                self.gui.log_output(f"\n[+] PDF {len(self.pdf_attachments)} {source}: {os.path.basename(file_path)}")
-                file_added = True
-
-            elif ext in TEXT_EXTENSIONS or ext not in PDF_EXTENSIONS:
-                self.text_attachments.append({'type': 'text', 'path': file_path})
-                self.gui.log_output(f"\n[+] File {len(self.text_attachments)} {source}: {os.path.basename(file_path)}")
-                file_added = True
-            
-            else:
-                 self.gui.log_output(f"\n[!!] Unhandled file type: {os.path.basename(file_path)} [!!]")
+            added, message = self.session.attach_file(file_path, source)
+            self.gui.log_output(message)
+            file_added = file_added or added
 
         if file_added:
             self.update_attachment_viewer()
@@ -241,7 +545,16 @@ class ChatbotInstance:
         try:
             # Try to get data as standard string first
             text_data = self.root.clipboard_get()
-            
+
+            # Laying out a huge paste in the word-wrapped input box freezes the UI;
+            # send it as a text attachment instead (sampled like a large file)
+            if len(text_data) >= PASTE_ATTACHMENT_MIN_CHARS:
+                added, message = self.session.attach_text_data(text_data)
+                self.gui.log_output(message)
+                if added:
+                    self.update_attachment_viewer()
+                return "break"
+
             # Check if this text is likely a file path
             is_likely_file = False
             if os.path.exists(text_data) or text_data.startswith('file://'):
@@ -266,13 +579,10 @@ class ChatbotInstance:
         try:
             image = ImageGrab.grabclipboard()
             if isinstance(image, Image.Image):
-                if self.chat_mode == 'llm_only':
-                    self.gui.log_output("[!!] Image pasting is disabled for this LLM. [!!]")
-                    return "break"
-
-                self.image_attachments.append({'type': 'image', 'data': image})
-                self.gui.log_output(f"\n[+] Image {len(self.image_attachments)} pasted from clipboard.")
-                self.update_attachment_viewer()
+                added, message = self.session.attach_image_data(image)
+                self.gui.log_output(message)
+                if added:
+                    self.update_attachment_viewer()
                 return "break" # Stop default paste
 
         except Exception:
@@ -287,36 +597,73 @@ class ChatbotInstance:
         """Clears and repopulates the attachment viewer based on current state."""
         self.gui.clear_attachment_viewer()
         self.attachment_photo_refs.clear()
-
-        # 1. Show Images
-        for i, att in enumerate(self.image_attachments):
-            pil_image = None
-            source_text = ""
-            try:
-                if 'data' in att: 
-                    pil_image = att['data']
-                    source_text = f"Pasted Image {i+1}"
-                elif 'path' in att: 
-                    pil_image = Image.open(att['path'])
-                    source_text = os.path.basename(att['path'])
-
-                if pil_image:
-                    pil_image.thumbnail(THUMBNAIL_SIZE)
-                    photo = ImageTk.PhotoImage(pil_image)
-                    self.attachment_photo_refs.append(photo) 
-                    self.gui.add_image_thumbnail(photo, source_text)
-            except Exception as e:
-                self.gui.log_output(f"[!!] Error creating thumbnail: {e} [!!]")
+        image_list, pdf_list, text_list = self.session.attachments()
+
+        # 1. Show Images (thumbnails are rendered by the background job)
+        for i, att in enumerate(image_list):
+            source_text = f"Pasted Image {i+1}" if 'data' in att else os.path.basename(att['path'])
+            payload = self.session.prepared(att)
+            handle = payload['handle'] if payload else None
+            if handle is not None and handle.thumbnail is not None:
+                photo = ImageTk.PhotoImage(handle.thumbnail)
+                self.attachment_photo_refs.append(photo) 
+                self.gui.add_image_thumbnail(photo, source_text)
+            else:
+                self.gui.show_pending_image(f"{source_text}{self._attachment_status(att)}")
 
         # 2. Show PDFs
-        for i, att in enumerate(self.pdf_attachments):
+        for i, att in enumerate(pdf_list):
             path = att['path']
-            self.gui.show_pdf_path(f"{i+1}. {os.path.basename(path)}")
+            self.gui.show_pdf_path(f"{i+1}. {os.path.basename(path)}{self._attachment_status(att)}")
+
+        # 3. Show Text Files, Folders and Archives
+        for i, att in enumerate(text_list):
+            if 'data' in att:
+                self.gui.show_pasted_text(f"{i+1}. {len(att['data']):,} chars{self._attachment_status(att)}",
+                                          self._paste_preview(att['data']))
+            elif att['type'] in ('folder', 'archive'):
+                self.gui.show_folder_path(f"{i+1}. {os.path.basename(os.path.normpath(att['path']))}{self._attachment_status(att)}")
+            else:
+                self.gui.show_text_file_path(f"{i+1}. {os.path.basename(att['path'])}{self._attachment_status(att)}")
+
+    def _paste_preview(self, text: str) -> str:
+        """The first non-empty line of a pasted text, shortened."""
+        for line in text[:PASTE_PREVIEW_CHARS * 20].splitlines():
+            if line.strip():
+                line = line.strip()
+                return line if len(line) <= PASTE_PREVIEW_CHARS else line[:PASTE_PREVIEW_CHARS - 3] + "..."
+        return ""
+
+    def _attachment_status(self, att: dict) -> str:
+        payload = self.session.prepared(att)
+        if payload is None:
+            return " (preparing...)"
+        if payload['handle'] is None:
+            return " (failed)"
+        return ""
+
+    # --- Prompt Prewarming ---
+
+    def on_typing(self, event):
+        """
+        The user is typing a message: have the conversation so far evaluated
+        before it is sent, once they pause for PREWARM_DELAY ms.
+        """
+        if self.processing or not _is_editing_key(event):
+            return
+        self._cancel_prewarm()
+        self._prewarm_id = self.root.after(PREWARM_DELAY, self._start_prewarm)
 
-        # 3. Show Text Files
-        for i, att in enumerate(self.text_attachments):
-            path = att['path']
-            self.gui.show_text_file_path(f"{i+1}. {os.path.basename(path)}")
+    def _cancel_prewarm(self):
+        if self._prewarm_id is not None:
+            self.root.after_cancel(self._prewarm_id)
+            self._prewarm_id = None
+
+    def _start_prewarm(self):
+        self._prewarm_id = None
+        if self.processing or self.hibernated:
+            return
+        threading.Thread(target=self.session.prewarm, daemon=True).start()
 
     # --- Main Send Logic ---
 
@@ -324,147 +671,65 @@ class ChatbotInstance:
         """Handles sending text and all attachments to the 'LLM'."""
         if self.processing:
             return
+        self._cancel_prewarm()
 
         prompt_text = self.gui.get_input_text()
-
-        image_list = self.image_attachments
-        pdf_list = self.pdf_attachments
-        text_list = self.text_attachments
-        self.image_attachments = []
-        self.pdf_attachments = []
-        self.text_attachments = []
+        image_list, pdf_list, text_list = self.session.attachments()
 
         self.gui.clear_attachment_viewer()
         self.attachment_photo_refs.clear()
 
         has_attachments = bool(image_list or pdf_list or text_list)
+        if self.editing is not None and (has_attachments or prompt_text):
+            self._apply_edit()
 
         if has_attachments:
             if not prompt_text:
                 prompt_text = "Please describe or analyze the attached content."
             
             log_msg = f"--- Me (with {len(image_list)} images, {len(pdf_list)} PDFs, {len(text_list)} files) ---"
+            self.gui.mark_turn(self.session.history_turns + 1)
             self.gui.log_output(f"\n{log_msg}\n{prompt_text}")
-            self.start_processing_thread(
-                target=self.process_attachments_thread,
-                args=(prompt_text, image_list, pdf_list, text_list)
-            )
         elif prompt_text:
+            self.gui.mark_turn(self.session.history_turns + 1)
             self.gui.log_output(f"\n--- Me ---\n{prompt_text}")
-            self.start_processing_thread(
-                target=self.process_text_thread,
-                args=(prompt_text,)
-            )
         else:
             self.gui.log_output("\n[!!] Please type a message or attach a file. [!!]")
+            return
+
+        # Read the widget here, on the Tk thread; the worker only sees the session
+        self.session.set_system_prompt(self.gui.get_personality_text() or DEFAULT_SYSTEM_PROMPT)
+        self.start_processing_thread(
+            target=self.process_message_thread,
+            args=(prompt_text,)
+        )
 
     def start_processing_thread(self, target, args):
         self.processing = True
         self.gui.set_button_state(False)
         threading.Thread(target=target, args=args, daemon=True).start()
 
-    # --- Processing Threads ---
+    # --- Processing Thread ---
 
-    def _handle_ollama_result(self, success: bool, reply: str, user_message: dict, elapsed_time: float):
-        if success:
-            assistant_message = {'role': 'assistant', 'content': reply}
-            self.messages.append(user_message) 
-            self.messages.append(assistant_message) 
-            time_str = f"({elapsed_time:.1f} secs)"
-            final_message_content = f"{time_str}\n{reply}\n"
-            self.logic_queue.put(("REPLACE_THINKING", final_message_content))
-        else:
-            self.logic_queue.put(("LOG", f"\n[!!] Chatbot failed to generate a valid response after {MAX_RETRIES} attempts. [!!]"))
-            fallback_reply = "[The assistant is unable to provide a valid response at this time.]"
-            assistant_message = {'role': 'assistant', 'content': fallback_reply}
-            self.messages.append(user_message) 
-            self.messages.append(assistant_message) 
-            final_message_content = f"\n{fallback_reply}\n"
-            self.logic_queue.put(("REPLACE_THINKING", final_message_content))
-
-    def process_text_thread(self, prompt: str):
+    def process_message_thread(self, prompt: str, user_message: dict | None = None):
         try:
-            system_prompt = self.gui.get_personality_text() or DEFAULT_SYSTEM_PROMPT
-            user_message = {'role': 'user', 'content': prompt}
-            messages_for_call = [{'role': 'system', 'content': system_prompt}]
-            messages_for_call.extend(self.messages) 
-            messages_for_call.append(user_message) 
-
-            self.logic_queue.put(("THINKING", None))
-
-            reply, elapsed_time, success = execute_ollama_call(
-                self.client, self.selected_model, self.use_gpu, messages_for_call, self.logic_queue
-            )
-            self._handle_ollama_result(success, reply, user_message, elapsed_time)
-
-        except Exception as e:
-            self.logic_queue.put(("LOG", f"\n[!!] CRITICAL THREAD ERROR: {e} [!!]"))
-        finally:
-            self.logic_queue.put(("READY", None))
-
-
-    def process_attachments_thread(self, prompt: str, image_list: list, pdf_list: list, text_list: list):
-        try:
-            system_prompt = self.gui.get_personality_text() or DEFAULT_SYSTEM_PROMPT
-
-            image_bytes_list = []
-            if self.chat_mode == 'vlm':
-                for att in image_list:
-                    try:
-                        if 'data' in att: 
-                            with io.BytesIO() as output:
-                                att['data'].save(output, format="PNG")
-                                image_bytes_list.append(output.getvalue())
-                        elif 'path' in att: 
-                            img_bytes = read_image_bytes_from_file(att['path'])
-                            if img_bytes:
-                                image_bytes_list.append(img_bytes)
-                    except Exception as e:
-                        self.logic_queue.put(("LOG", f"[!!] Failed to read image {att.get('path', 'pasted image')}: {e} [!!]"))
-
-            file_context_parts = []
-            if text_list:
-                for att in text_list:
-                    path = att['path']
-                    content = read_text_file(path)
-                    if content is not None:
-                        file_context_parts.append(f"--- Content of {os.path.basename(path)} ---\n{content}\n")
-                    else:
-                        self.logic_queue.put(("LOG", f"[!!] Failed to read text file {path} [!!]"))
-
-            if pdf_list:
-                for att in pdf_list:
-                    path = att['path']
-                    content = extract_pdf_text(path)
-                    if content is not None:
-                        file_context_parts.append(f"--- Content of {os.path.basename(path)} ---\n{content}\n")
-                    else:
-                        self.logic_queue.put(("LOG", f"[!!] Failed to extract text from PDF {path} [!!]"))
-
-            file_context = "\n".join(file_context_parts)
-            final_prompt = prompt
-            if file_context:
-                final_prompt = (
-                    "Here is the context from the attached files:\n"
-                    f"{file_context}\n"
-                    "--- End of file context ---\n\n"
-                    f"User's question: {prompt}"
-                )
-
-            user_message = {'role': 'user', 'content': final_prompt}
-            if image_bytes_list: 
-                user_message['images'] = image_bytes_list
-
-            messages_for_call = [{'role': 'system', 'content': system_prompt}]
-            messages_for_call.extend(self.messages) 
-            messages_for_call.append(user_message) 
-
-            self.logic_queue.put(("THINKING", None))
-
-            reply, elapsed_time, success = execute_ollama_call(
-                self.client, self.selected_model, self.use_gpu, messages_for_call, self.logic_queue
-            )
-            self._handle_ollama_result(success, reply, user_message, elapsed_time)
+            # Chunks go through the queue like every other update, so the Tk thread renders them in order
+            result = self.session.send(prompt, on_chunk=lambda text: self.logic_queue.put(("CHUNK", text)),
+                                       user_message=user_message)
+            if not result['cancelled']:
+                if result['cached'] == 'semantic':
+                    similarity = result['stats'].get('similarity', 0.0)
+                    time_str = f"(cached: similar question, {similarity:.0%} match, {result['elapsed']:.1f} secs)"
+                    final_message_content = f"{time_str}\n{result['reply']}\n"
+                elif result['cached']:
+                    time_str = f"(cached response, {result['elapsed']:.1f} secs)"
+                    final_message_content = f"{time_str}\n{result['reply']}\n"
+                elif result['success']:
+                    time_str = f"({result['elapsed']:.1f} secs)"
+                    final_message_content = f"{time_str}\n{result['reply']}\n"
+                else:
+                    final_message_content = f"\n{result['reply']}\n"
+                self.logic_queue.put(("REPLACE_THINKING", (final_message_content, result['reply'])))
 
         except Exception as e:
             self.logic_queue.put(("LOG", f"\n[!!] CRITICAL THREAD ERROR: {e} [!!]"))
@@ -476,18 +741,148 @@ class ChatbotInstance:
             while not self.logic_queue.empty():
                 msg_type, data = self.logic_queue.get_nowait()
                 if msg_type == "LOG":
+                    if self.gui.streaming:
+                        # Only retries and errors log mid-reply; the attempt's text is thrown away
+                        self.gui.discard_streaming_reply()
                     self.gui.log_output(data)
+                elif msg_type == "CHUNK":
+                    if not self.gui.streaming:
+                        self.gui.begin_streaming_reply()
+                    self.gui.append_streaming_reply(data)
                 elif msg_type == "THINKING":
                     self.gui.show_thinking_indicator()
+                elif msg_type == "HISTORY":
+                    self._show_older_turns(*data)
+                elif msg_type == "HISTORY_READ":
+                    session, then, result = data
+                    if session is self.session:
+                        then(result)
+                elif msg_type == "ATTACHMENTS":
+                    if not self.processing:
+                        self.update_attachment_viewer()
                 elif msg_type == "REPLACE_THINKING":
-                    self.gui.replace_thinking_indicator(data)
+                    final_message_content, reply = data
+                    if self.gui.streaming:
+                        self.gui.finish_streaming_reply(final_message_content, reply)
+                    else:
+                        self.gui.replace_thinking_indicator(final_message_content)
                 elif msg_type == "READY":
+                    if self.gui.streaming:
+                        self.gui.abandon_streaming_reply() # Cancelled mid-reply
                     self.processing = False
                     self.gui.set_button_state(True)
                     self.gui.text_input.focus()
         finally:
-            self.root.after(100, self.check_logic_queue)
+            self._poll_id = self.root.after(100, self.check_logic_queue)
+
+    # --- Hibernation ---
+
+    @property
+    def hibernated(self) -> bool:
+        return self.hibernated_path is not None
+
+    def can_hibernate(self) -> bool:
+        """Only idle tabs are unloaded: nothing generating and no attachments waiting to be sent."""
+        return not self.hibernated and not self.processing and not self.session.has_attachments()
+
+    def hibernate(self, path: str):
+        """Saves the conversation and view to `path`, then frees the widgets, images and history."""
+        state = {'session': self.session.snapshot(), 'view': self.gui.snapshot()}
+        self._hibernated_history_id = self.session.history_id
+        self.root.after_cancel(self._poll_id)
+        self._cancel_prewarm()
+        self.gui.cancel_callbacks()
+        get_attachment_pool().forget(self.session)
+        for child in self.root.winfo_children():
+            child.destroy()
+        self.gui = None
+        self.session = None
+        self.attachment_photo_refs.clear()
+        self.hibernated_path = path
+        # Writing megabytes of history must not stall the UI
+        self._save_thread = threading.Thread(target=self._save_state, args=(path, state), daemon=True)
+        self._save_thread.start()
+
+    def _save_state(self, path: str, state: dict):
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = path + ".tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(state, f)
+            os.replace(tmp_path, path)
+        except (OSError, TypeError, ValueError) as e:
+            print(f"Error saving hibernated tab, keeping it in memory: {e}")
+            self._unsaved_state = state
+
+    def wake(self, use_cache: bool, use_semantic_cache: bool, on_ready=None):
+        """
+        Rebuilds the tab from its saved state (called when it is selected
+        again), then calls `on_ready`. If the state is still being written,
+        waits for that by polling, without blocking the UI.
+        """
+        if on_ready is not None:
+            self._wake_callbacks.append(on_ready)
+        if self._wake_id is not None:
+            return # Already waiting for the save
+        if self._save_thread.is_alive():
+            if not self.root.winfo_children():
+                ttk.Label(self.root, text="Restoring chat...").pack(expand=True)
+            self._wake_id = self.root.after(50, self._retry_wake, use_cache, use_semantic_cache)
+            return
+
+        for child in self.root.winfo_children():
+            child.destroy() # The "Restoring" label
+        state = self._unsaved_state
+        if state is None:
+            try:
+                with open(self.hibernated_path, 'r', encoding='utf-8') as f:
+                    state = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"Error reading hibernated tab: {e}")
+        self.discard_saved_state()
+
+        if state is None:
+            self.session = ChatSession(
+                self.selected_model, self.chat_mode, self.use_gpu,
+                use_cache=use_cache, use_semantic_cache=use_semantic_cache, **self._session_hooks()
+            )
+            self._build_view()
+            self.start_new_chat()
+            self.gui.log_output("[!!] This chat could not be restored after being unloaded. [!!]")
+            self._run_wake_callbacks()
+            return
+
+        self.session = ChatSession.from_snapshot(
+            state['session'], use_cache=use_cache, use_semantic_cache=use_semantic_cache, **self._session_hooks()
+        )
+        self._build_view()
+        self.gui.restore(state['view'], TAB_WAKE_RENDER_CHARS)
+        self.processing = False
+        self.gui.set_button_state(True)
+        self._run_wake_callbacks()
+
+    def _retry_wake(self, use_cache: bool, use_semantic_cache: bool):
+        self._wake_id = None
+        self.wake(use_cache, use_semantic_cache)
+
+    def _run_wake_callbacks(self):
+        callbacks, self._wake_callbacks = self._wake_callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def discard_saved_state(self):
+        """Deletes the hibernation file (the tab is awake again or being closed)."""
+        if self.hibernated_path is not None:
+            try:
+                os.remove(self.hibernated_path)
+            except OSError:
+                pass
+        self.hibernated_path = None
+        self._unsaved_state = None
 
     def on_closing(self):
         print("Closing chat instance.")
+        self._cancel_prewarm()
+        self.session.cancel()
+        get_attachment_pool().forget(self.session)
         self.close_callback()
\ No newline at end of file
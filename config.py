@@ -44,8 +44,21 @@ ALL_MODELS = FORMATTED_VLM_MODELS + FORMATTED_LLM_MODELS
 
 # --- UI & Chat Configuration ---
 THUMBNAIL_SIZE = (150, 150) # Size for attachment viewer
+CODE_BLOCK_LIVE_MARGIN = 30 # Code blocks within this many transcript lines of the view keep full widgets
+OUTPUT_FLUSH_INTERVAL = 16 # ms; chat output arriving in bursts is drawn at most once per frame
+CODE_HIGHLIGHT_STYLE = "monokai" # Pygments style for code blocks
 DEFAULT_SYSTEM_PROMPT = "You are a helpful assistant. Be concise."
 
+# --- Predefined Personalities ---
+PERSONAS = {
+    "Helpful Assistant": "You are a helpful assistant. Be concise and clear.",
+    "Python Expert": "You are a senior Python software engineer. You provide efficient, PEP8-compliant code and explain complex concepts simply.",
+    "Creative Writer": "You are a creative writer. Use evocative language, metaphors, and varied sentence structures.",
+    "Skeptical Scientist": "You are a skeptical scientist. Demand evidence for claims, think critically, and look for logical fallacies.",
+    "Pirate": "You are a pirate captain. Speak in nautical slang, be boisterous, and refer to the user as 'matey'.",
+    "Custom": "" # Placeholder for user edits
+}
+
 # --- File Extension Categories ---
 PDF_EXTENSIONS = ['.pdf']
 TEXT_EXTENSIONS = [
@@ -55,9 +68,49 @@ TEXT_EXTENSIONS = [
 ]
 IMAGE_EXTENSIONS = ['.png', '.jpg', '.jpeg', '.bmp', '.gif']
 
+# --- Attachment Preprocessing ---
+# Attachments are read/encoded in the background as soon as they are added,
+# on one pool shared by all tabs. 0 = one job per core, but only the cores a CPU-mode
+# Ollama leaves free while it is generating.
+ATTACHMENT_POOL_WORKERS = 0
+ATTACHMENT_POOL_MAX_PENDING = 64   # Attachments refused beyond this many waiting jobs
+
+# --- Pasted Images ---
+# Clipboard images are encoded once, in the background, right after pasting.
+PASTED_IMAGE_FORMAT = "PNG"         # "PNG", "JPEG" or "WEBP"
+PASTED_IMAGE_MAX_SIDE = 2048        # Downscale larger screenshots to this size (0 = never)
+PASTED_IMAGE_PNG_COMPRESS_LEVEL = 1 # 0-9; higher is smaller but much slower
+PASTED_IMAGE_QUALITY = 85           # JPEG/WebP quality
+
+# --- Large Text Attachments ---
+# Files over the budget are sampled as head + tail + lines matching the pattern.
+TEXT_ATTACHMENT_MAX_TOKENS = 8000
+CHARS_PER_TOKEN = 4                 # Rough estimate used to turn tokens into bytes
+TEXT_HEAD_FRACTION = 0.4            # Share of the budget for the start of the file
+TEXT_TAIL_FRACTION = 0.3            # Share for the end; the rest goes to lines with these words
+LOG_MATCH_KEYWORDS = ['error', 'exception', 'traceback', 'fatal', 'fail', 'warn', 'critical', 'panic']
+# Pastes this long skip the input box (slow to lay out) and become a text attachment
+PASTE_ATTACHMENT_MIN_CHARS = 20_000
+PASTE_PREVIEW_CHARS = 60            # Shown for the pasted text in the attachment list
+
+# --- Folder & Archive Attachments ---
+ARCHIVE_EXTENSIONS = ['.zip']
+FOLDER_ATTACHMENT_MAX_TOKENS = 16000  # Manifest + file contents for one folder or archive
+FOLDER_FILE_MAX_TOKENS = 2000         # Larger files are sampled like big text attachments
+FOLDER_MAX_FILES = 20000              # Stop walking after this many files
+FOLDER_READ_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+# Always skipped, on top of any .gitignore rules found in the folder
+FOLDER_DEFAULT_IGNORES = [
+    '.git/', '.hg/', '.svn/', 'node_modules/', '__pycache__/', '.venv/', 'venv/',
+    '.mypy_cache/', '.pytest_cache/', '.tox/', '.idea/', '.DS_Store', '*.pyc', '*.egg-info/'
+]
+
 
 # --- Ollama & Retry Logic ---
 MAX_RETRIES = 5
+# Sampling options sent with every request (e.g. {'temperature': 0, 'seed': 42}).
+# Only deterministic requests (temperature 0 or a fixed seed) are cached.
+GENERATION_OPTIONS = {}
 FORBIDDEN_KEYWORDS = [
     "as an ai",
     "as a large language model",
@@ -76,4 +129,86 @@ FORBIDDEN_KEYWORDS = [
     "help with that request",
     "I can't continue",
     "provide a response"
-]
\ No newline at end of file
+]
+
+# --- Prompt Prewarming (opt-in) ---
+# When you start typing, the conversation so far is sent ahead with a one-token reply, so the
+# server has evaluated it (and holds it in its prompt cache) by the time you press Send.
+# Only done for a model that is already loaded, so it never evicts another tab's model.
+PREWARM_ENABLED = False
+PREWARM_DELAY = 400                # ms of pause in typing before the conversation is sent
+PREWARM_MIN_CHARS = 2000           # Shorter conversations evaluate too fast to be worth it
+
+# --- Backend Pool (several Ollama servers) ---
+# Empty = the single default server. Otherwise requests are spread over these, e.g.
+# [{'host': 'http://10.0.0.5:11434', 'models': ['gemma3:4b'], 'slots': 2},
+#  {'host': 'http://10.0.0.6:11434'}]
+# 'models' limits what is routed to an endpoint (default: whatever its /api/tags lists);
+# 'slots' is how many requests it serves in parallel (OLLAMA_NUM_PARALLEL).
+OLLAMA_ENDPOINTS = []
+BACKEND_PROBE_INTERVAL = 5.0       # Seconds between health / loaded-model probes
+BACKEND_PROBE_TIMEOUT = 2.0
+BACKEND_RETRY_AFTER = 15.0         # Seconds an unreachable endpoint is skipped
+
+# --- Hedged Requests (backend pool only) ---
+# If a streamed reply's first token is late, the same request is also sent to another
+# endpoint (or a fallback model); whichever streams first is used and the other dropped.
+HEDGE_ENABLED = False
+HEDGE_PERCENTILE = 95              # "Late" = slower than this percentile of recent TTFTs for the model
+HEDGE_MIN_DELAY = 0.5              # ...and at least this many seconds
+HEDGE_MIN_SAMPLES = 20             # TTFTs seen per model before hedging starts
+HEDGE_TTFT_WINDOW = 200            # Recent TTFTs kept per model
+HEDGE_MAX_EXTRA_LOAD = 0.10        # Hedges allowed, as a fraction of streamed requests
+HEDGE_FALLBACK_MODELS = {}         # e.g. {'gemma3:12b': 'gemma3:4b'}, used when no other endpoint has the model
+
+# --- Local Data ---
+APP_DATA_DIR = os.path.join(os.path.expanduser("~"), ".local_chatbot")
+
+# --- Saved Chats ---
+SESSION_STORE_ENABLED = True
+SESSION_STORE_PATH = os.path.join(APP_DATA_DIR, "chats.sqlite3")
+SESSION_LOAD_TURNS = 20            # Turns shown when a saved chat is reopened
+SESSION_PAGE_TURNS = 20            # Older turns read at a time when scrolling to the top
+SESSION_LIST_LIMIT = 50            # Chats listed in the "Saved Chats" window
+SEARCH_RESULT_LIMIT = 50           # Matching turns listed when searching saved chats
+SEARCH_DELAY = 150                 # ms after the last keystroke before searching
+
+# --- Tab Hibernation ---
+TAB_HIBERNATE_AFTER = 15           # Minutes unfocused before an idle tab is saved to disk and unloaded (0 = never)
+TAB_HIBERNATE_CHECK_INTERVAL = 60  # Seconds between checks
+TAB_WAKE_RENDER_CHARS = 20_000     # Newest transcript text re-rendered as markdown on wake; older text comes back plain
+HIBERNATE_DIR = os.path.join(APP_DATA_DIR, "hibernated")
+
+# --- CPU Auto-Tuning (python autotune.py MODEL ...) ---
+AUTOTUNE_USE_PROFILES = True       # Apply saved per-(host, model) profiles to CPU-mode requests
+AUTOTUNE_PROFILE_PATH = os.path.join(APP_DATA_DIR, "tuning_profiles.json")
+AUTOTUNE_REPEATS = 2               # Measured runs per candidate (after one warm-up)
+AUTOTUNE_PROMPT_WORDS = 300        # Calibration prompt length
+AUTOTUNE_PREDICT_TOKENS = 48       # Tokens generated per calibration run
+AUTOTUNE_BATCH_SIZES = [128, 256, 512, 1024]
+AUTOTUNE_CONTEXT_SIZES = [2048, 4096, 8192]
+
+# --- Response Cache (exact match) ---
+RESPONSE_CACHE_ENABLED = True
+RESPONSE_CACHE_PATH = os.path.join(APP_DATA_DIR, "response_cache.sqlite3")
+RESPONSE_CACHE_MEMORY_ENTRIES = 256          # Hot entries kept in the in-memory LRU
+RESPONSE_CACHE_MAX_BYTES = 50 * 1024 * 1024  # Size limit of the on-disk store
+RESPONSE_CACHE_TTL = 7 * 24 * 60 * 60        # Seconds before an entry expires
+
+# --- Semantic Cache (near-duplicate questions, opt-in) ---
+SEMANTIC_CACHE_ENABLED = False
+SEMANTIC_CACHE_EMBED_MODEL = "nomic-embed-text"  # Pull it first: ollama pull nomic-embed-text
+SEMANTIC_CACHE_THRESHOLD = 0.92                  # Minimum cosine similarity for a hit
+SEMANTIC_CACHE_MAX_ENTRIES = 2000                # Per (model, persona) scope
+
+# --- Server Mode (main.py --serve) ---
+SERVER_HOST = "127.0.0.1"
+SERVER_PORT = 8765
+SERVER_MAX_CONCURRENT = 2          # Generations running against the backend at once
+SERVER_MAX_QUEUED = 32             # Requests allowed to wait for a slot before 503
+SERVER_MAX_SESSIONS = 1000
+SERVER_SESSION_TTL = 2 * 60 * 60   # Idle sessions are dropped after this many seconds
+SERVER_MAX_PROMPT_CHARS = 100_000
+SERVER_MAX_HISTORY_TURNS = 200     # Per-session limit (user + assistant messages)
+SERVER_MAX_ATTACHMENTS = 16        # Per message
+SERVER_MAX_BODY_BYTES = 1_000_000
\ No newline at end of file
@@ -0,0 +1,446 @@
+"""
+Folder and archive attachments.
+
+A dropped directory (or .zip) is walked on a thread pool, honouring
+.gitignore files and FOLDER_DEFAULT_IGNORES, skipping binaries and
+deduplicating identical files by content hash. Everything is packed into
+one context block: a manifest listing every file, followed by as many file
+contents as fit in the token budget (key files such as the README first,
+then shallow files before deep ones). Files are read in that order and
+reading stops once the budget is spent; the rest are only listed.
+"""
+import hashlib
+import os
+import re
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from config import (
+    FOLDER_ATTACHMENT_MAX_TOKENS, FOLDER_FILE_MAX_TOKENS, FOLDER_MAX_FILES,
+    FOLDER_READ_WORKERS, FOLDER_DEFAULT_IGNORES, CHARS_PER_TOKEN
+)
+from utils import (
+    looks_binary, is_binary_file, read_text_file_budgeted, sample_text, format_size,
+    BINARY_SNIFF_BYTES
+)
+
+# Archive members above this size are listed but never decompressed
+_MAX_ARCHIVE_ENTRY_BYTES = 64 * 1024 * 1024
+# The manifest may use at most this share of the budget
+_MANIFEST_BUDGET_FRACTION = 0.25
+# Header, footer and the smallest useful file block: below this, reading stops
+_PACK_OVERHEAD_BYTES = 200
+_MIN_BLOCK_BYTES = 64
+# Files that explain a project; their contents are packed first
+_KEY_FILES = {
+    'readme', 'readme.md', 'readme.rst', 'readme.txt', 'pyproject.toml', 'setup.py',
+    'setup.cfg', 'requirements.txt', 'package.json', 'cargo.toml', 'go.mod', 'makefile'
+}
+
+
+# --- Ignore Rules ---
+
+def _pattern_to_regex(pattern: str) -> str:
+    """Translates one gitignore glob ('*', '?', '[...]', '**') into a regex."""
+    out = []
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        if c == '*':
+            if pattern[i:i + 3] == '**/':
+                out.append('(?:.*/)?') # Zero or more directories
+                i += 3
+                continue
+            if pattern[i:i + 2] == '**':
+                out.append('.*')
+                i += 2
+                continue
+            out.append('[^/]*')
+        elif c == '?':
+            out.append('[^/]')
+        elif c == '[' and pattern.find(']', i + 1) != -1:
+            end = pattern.find(']', i + 1)
+            body = pattern[i + 1:end]
+            if body.startswith('!'):
+                body = '^' + body[1:]
+            out.append('[' + body.replace('\\', '\\\\') + ']')
+            i = end + 1
+            continue
+        elif c == '\\' and i + 1 < n:
+            out.append(re.escape(pattern[i + 1]))
+            i += 2
+            continue
+        else:
+            out.append(re.escape(c))
+        i += 1
+    return ''.join(out)
+
+
+class IgnoreRules:
+    """
+    A list of gitignore-style rules. As in git, the last matching rule wins
+    and a '!' rule re-includes a path. Rules from a nested .gitignore only
+    apply below the directory that holds it.
+    """
+    def __init__(self, rules: list | None = None):
+        self.rules = rules or [] # (base dir, compiled regex, negate, directories only)
+
+    def extended(self, lines: list, base: str = '') -> 'IgnoreRules':
+        """Returns a copy with the rules parsed from `lines` (relative to `base`) appended."""
+        rules = list(self.rules)
+        for line in lines:
+            line = line.rstrip()
+            if not line or line.startswith('#'):
+                continue
+            negate = line.startswith('!')
+            if negate:
+                line = line[1:]
+            dir_only = line.endswith('/')
+            line = line.rstrip('/')
+            if not line:
+                continue
+            # A slash anywhere but the end anchors the pattern to `base`
+            anchored = '/' in line
+            regex = _pattern_to_regex(line.lstrip('/'))
+            if not anchored:
+                regex = '(?:.*/)?' + regex
+            rules.append((base, re.compile(regex + r'\Z', re.DOTALL), negate, dir_only))
+        return IgnoreRules(rules)
+
+    def ignored(self, rel_path: str, is_dir: bool) -> bool:
+        result = False
+        for base, regex, negate, dir_only in self.rules:
+            if dir_only and not is_dir:
+                continue
+            if base:
+                if not rel_path.startswith(base + '/'):
+                    continue
+                path = rel_path[len(base) + 1:]
+            else:
+                path = rel_path
+            if regex.match(path):
+                result = not negate
+        return result
+
+
+def _read_ignore_file(path: str) -> list:
+    try:
+        with open(path, 'r', encoding='utf-8', errors='ignore') as f:
+            return f.read().splitlines()
+    except OSError:
+        return []
+
+
+DEFAULT_IGNORE_RULES = IgnoreRules().extended(FOLDER_DEFAULT_IGNORES)
+
+
+# --- Reading ---
+
+def _text_from_bytes(data: bytes) -> tuple[str | None, str | None, str | None]:
+    """(content, note, digest) for an in-memory file; content is None for binaries."""
+    if looks_binary(data[:BINARY_SNIFF_BYTES]):
+        return None, "binary", None
+    digest = hashlib.sha256(data).hexdigest()
+    content, report = sample_text(data.decode('utf-8', errors='ignore'), FOLDER_FILE_MAX_TOKENS)
+    return content, "sampled" if report else None, digest
+
+
+def _read_disk_file(path: str, size: int) -> tuple[str | None, str | None, str | None]:
+    try:
+        if size <= FOLDER_FILE_MAX_TOKENS * CHARS_PER_TOKEN:
+            with open(path, 'rb') as f:
+                return _text_from_bytes(f.read())
+
+        # Large file: sniff and sample through mmap. Only the sample is kept, so the
+        # sample plus size and mtime identify it; hashing the whole file would read
+        # gigabytes of logs just to find duplicates
+        if is_binary_file(path):
+            return None, "binary", None
+        content, report = read_text_file_budgeted(path, FOLDER_FILE_MAX_TOKENS)
+        if content is None:
+            return None, "unreadable", None
+        digest = hashlib.sha256(f"{size}:{os.stat(path).st_mtime_ns}\n".encode('utf-8'))
+        digest.update(content.encode('utf-8'))
+        return content, "sampled" if report else None, digest.hexdigest()
+    except OSError as e:
+        print(f"Error reading {path}: {e}")
+        return None, "unreadable", None
+
+
+def _read_archive_member(archive: zipfile.ZipFile, info: zipfile.ZipInfo) -> tuple[str | None, str | None, str | None]:
+    if info.file_size > _MAX_ARCHIVE_ENTRY_BYTES:
+        return None, "too large", None
+    try:
+        return _text_from_bytes(archive.read(info))
+    except (zipfile.BadZipFile, RuntimeError, NotImplementedError, OSError) as e:
+        # RuntimeError: encrypted member; NotImplementedError: unsupported compression
+        print(f"Error reading archive member {info.filename}: {e}")
+        return None, "unreadable", None
+
+
+# --- Walking ---
+
+def _scan_directory(root: str, rel_dir: str, rules: IgnoreRules) -> tuple[IgnoreRules, list, list, int]:
+    """Lists one directory. Returns (rules for its children, subdirectories, (file, size) pairs, ignored count)."""
+    abs_dir = os.path.join(root, rel_dir)
+    ignore_file = os.path.join(abs_dir, '.gitignore')
+    if os.path.isfile(ignore_file):
+        rules = rules.extended(_read_ignore_file(ignore_file), rel_dir)
+
+    subdirs, files, ignored = [], [], 0
+    with os.scandir(abs_dir) as entries:
+        for entry in entries:
+            rel_path = f"{rel_dir}/{entry.name}" if rel_dir else entry.name
+            try:
+                # Symlinked directories are not followed (they may loop)
+                is_dir = entry.is_dir(follow_symlinks=False)
+                if not is_dir and not entry.is_file():
+                    continue
+                if rules.ignored(rel_path, is_dir):
+                    ignored += 1
+                elif is_dir:
+                    subdirs.append(rel_path)
+                else:
+                    files.append((rel_path, entry.stat().st_size))
+            except OSError:
+                continue
+    return rules, subdirs, files, ignored
+
+
+def _walk_directory(pool: ThreadPoolExecutor, root: str) -> tuple[list, int, bool]:
+    """Walks `root` with one pool task per directory. Returns (files, ignored count, truncated)."""
+    files, ignored, truncated = [], 0, False
+    pending = {pool.submit(_scan_directory, root, '', DEFAULT_IGNORE_RULES)}
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            try:
+                rules, subdirs, dir_files, dir_ignored = future.result()
+            except OSError as e:
+                print(f"Error listing directory: {e}")
+                continue
+            files.extend(dir_files)
+            ignored += dir_ignored
+            if len(files) >= FOLDER_MAX_FILES:
+                truncated = True
+                continue
+            for subdir in subdirs:
+                pending.add(pool.submit(_scan_directory, root, subdir, rules))
+    files.sort()
+    return files[:FOLDER_MAX_FILES], ignored, truncated
+
+
+def _archive_members(archive: zipfile.ZipFile) -> tuple[list, int, bool]:
+    """Lists the archive's files that survive the ignore rules. Returns (members, ignored count, truncated)."""
+    infos = [info for info in archive.infolist() if not info.is_dir()]
+
+    # .gitignore files in the archive, shallowest first so deeper rules win
+    rules = DEFAULT_IGNORE_RULES
+    ignore_files = [info for info in infos if os.path.basename(info.filename) == '.gitignore']
+    for info in sorted(ignore_files, key=lambda i: i.filename.count('/')):
+        if info.file_size <= _MAX_ARCHIVE_ENTRY_BYTES:
+            lines = archive.read(info).decode('utf-8', errors='ignore').splitlines()
+            rules = rules.extended(lines, os.path.dirname(info.filename))
+
+    members, ignored = [], 0
+    dir_ignored = {}
+    for info in infos:
+        parts = info.filename.split('/')
+        skip = False
+        for depth in range(1, len(parts)):
+            parent = '/'.join(parts[:depth])
+            if parent not in dir_ignored:
+                dir_ignored[parent] = rules.ignored(parent, True)
+            if dir_ignored[parent]:
+                skip = True
+                break
+        if skip or rules.ignored(info.filename, False):
+            ignored += 1
+        else:
+            members.append(info)
+    members.sort(key=lambda i: i.filename)
+    return members[:FOLDER_MAX_FILES], ignored, len(members) > FOLDER_MAX_FILES
+
+
+# --- Packing ---
+
+def _content_order(entry: dict) -> tuple:
+    path = entry['path']
+    return os.path.basename(path).lower() not in _KEY_FILES, path.count('/'), path
+
+
+def _manifest_line_bytes(entry: dict) -> int:
+    """Worst-case size of an entry's manifest line (with a tag)."""
+    line = f"  {entry['path']} ({format_size(entry['size'])})"
+    return len(line.encode('utf-8')) + len(" [not included]") + len(entry['note'] or '') + 4
+
+
+def _read_within_budget(pool: ThreadPoolExecutor, workers: int, items: list, read, max_tokens: int) -> list:
+    """
+    Reads files in packing order until the content budget is spent. `items`
+    are (path, size, source) in path order and read(source) returns
+    (content, note, digest). Returns the entries for _pack, in path order;
+    files left unread (or too big for what is left) are listed by path and
+    size only, as "not included".
+    """
+    entries = [
+        {'path': path, 'size': size, 'content': None, 'note': "not included", 'digest': None}
+        for path, size, _ in items
+    ]
+    manifest_bytes = min(sum(_manifest_line_bytes(e) for e in entries),
+                         int(max_tokens * CHARS_PER_TOKEN * _MANIFEST_BUDGET_FRACTION))
+    remaining = max_tokens * CHARS_PER_TOKEN - manifest_bytes - _PACK_OVERHEAD_BYTES
+    file_max_bytes = FOLDER_FILE_MAX_TOKENS * CHARS_PER_TOKEN
+    order = sorted(range(len(items)), key=lambda i: _content_order(entries[i]))
+    digests = set()
+    position = 0
+    while position < len(order) and remaining >= _MIN_BLOCK_BYTES:
+        # One wave of reads at a time, so no more is read than the budget can still take
+        wave = []
+        while position < len(order) and len(wave) < workers:
+            index = order[position]
+            position += 1
+            if min(entries[index]['size'], file_max_bytes) <= remaining:
+                wave.append(index)
+        for index, (content, note, digest) in zip(wave, pool.map(lambda i: read(items[i][2]), wave)):
+            entry = entries[index]
+            entry.update(content=content, note=note, digest=digest)
+            if content is not None and digest not in digests:
+                digests.add(digest)
+                remaining -= len(f"--- Content of {entry['path']} ---\n{content}\n".encode('utf-8'))
+    return entries
+
+
+def _pack(kind: str, name: str, entries: list, ignored: int, truncated: bool, max_tokens: int) -> tuple[str, dict]:
+    """
+    Builds the context block for a folder or archive. `entries` are dicts with
+    'path', 'size', 'content', 'note' and 'digest', in path order.
+    """
+    max_bytes = max_tokens * CHARS_PER_TOKEN
+
+    # 1. Dedupe by content hash (the first path in order is kept)
+    first_with_digest = {}
+    for entry in entries:
+        digest = entry['digest']
+        if digest is None:
+            continue
+        if digest in first_with_digest:
+            entry['note'] = f"same as {first_with_digest[digest]}"
+            entry['content'] = None
+        else:
+            first_with_digest[digest] = entry['path']
+
+    # 2. Reserve room for the manifest (worst-case tags), capped to a share of the budget
+    manifest_budget = int(max_bytes * _MANIFEST_BUDGET_FRACTION)
+    manifest_lines, manifest_bytes = [], 0
+    for entry in entries:
+        line_bytes = _manifest_line_bytes(entry)
+        if manifest_bytes + line_bytes > manifest_budget:
+            break
+        manifest_lines.append(entry)
+        manifest_bytes += line_bytes
+    listed_out = len(entries) - len(manifest_lines)
+
+    # 3. Pack contents in priority order; smaller files may still fit after a big one is skipped
+    remaining = max_bytes - manifest_bytes - _PACK_OVERHEAD_BYTES
+    blocks = {}
+    for entry in sorted((e for e in entries if e['content'] is not None), key=_content_order):
+        block = f"--- Content of {entry['path']} ---\n{entry['content']}\n"
+        block_bytes = len(block.encode('utf-8'))
+        if block_bytes <= remaining:
+            blocks[entry['path']] = block
+            remaining -= block_bytes
+        else:
+            entry['note'] = "not included"
+
+    stats = {
+        'files': len(entries),
+        'included': len(blocks),
+        'omitted': sum(1 for e in entries if e['note'] == "not included"),
+        'duplicates': sum(1 for e in entries if (e['note'] or '').startswith("same as")),
+        'binary': sum(1 for e in entries if e['note'] == "binary"),
+        'ignored': ignored,
+        'truncated': truncated,
+    }
+
+    lines = [f"=== {kind} {name}: {stats['files']} files, {stats['included']} included below ==="]
+    lines.append("Manifest:")
+    for entry in manifest_lines:
+        tag = f" [{entry['note']}]" if entry['note'] else ""
+        lines.append(f"  {entry['path']} ({format_size(entry['size'])}){tag}")
+    if listed_out:
+        lines.append(f"  [... {listed_out} more files not listed ...]")
+    if truncated:
+        lines.append(f"  [... stopped after {FOLDER_MAX_FILES} files ...]")
+    lines.append("")
+    body = "\n".join(lines) + "\n" + "".join(
+        blocks[e['path']] for e in sorted(entries, key=_content_order) if e['path'] in blocks
+    )
+    return body + f"=== End of {kind.lower()} {name} ===\n", stats
+
+
+def _format_report(stats: dict, elapsed: float) -> str:
+    report = f"indexed {stats['files']} files in {elapsed:.1f} secs, included {stats['included']}"
+    details = []
+    if stats['omitted']:
+        details.append(f"{stats['omitted']} over the token budget")
+    if stats['duplicates']:
+        details.append(f"{stats['duplicates']} duplicate(s)")
+    if stats['binary']:
+        details.append(f"{stats['binary']} binary")
+    if stats['ignored']:
+        details.append(f"{stats['ignored']} ignored")
+    if stats['truncated']:
+        details.append(f"stopped at {FOLDER_MAX_FILES} files")
+    if details:
+        report += f" (skipped: {', '.join(details)})"
+    return report
+
+
+# --- Public API ---
+
+def read_directory(dir_path: str, max_tokens: int = FOLDER_ATTACHMENT_MAX_TOKENS,
+                   workers: int = FOLDER_READ_WORKERS) -> tuple[str | None, str | None]:
+    """
+    Packs a directory into a single context block.
+
+    Returns:
+        tuple[str | None, str | None]: (content, report). content is None if
+        the directory could not be read; report summarizes what was indexed.
+    """
+    start = time.perf_counter()
+    root = os.path.abspath(dir_path)
+    name = os.path.basename(os.path.normpath(root))
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            files, ignored, truncated = _walk_directory(pool, root)
+            items = [(rel_path, size, (os.path.join(root, rel_path), size)) for rel_path, size in files]
+            entries = _read_within_budget(pool, max(1, workers), items,
+                                          lambda source: _read_disk_file(*source), max_tokens)
+    except OSError as e:
+        print(f"Error reading folder {dir_path}: {e}")
+        return None, f"could not be read: {e}"
+
+    content, stats = _pack("Folder", name, entries, ignored, truncated, max_tokens)
+    return content, _format_report(stats, time.perf_counter() - start)
+
+
+def read_archive(archive_path: str, max_tokens: int = FOLDER_ATTACHMENT_MAX_TOKENS,
+                 workers: int = FOLDER_READ_WORKERS) -> tuple[str | None, str | None]:
+    """Packs a .zip archive like read_directory, without extracting it to disk."""
+    start = time.perf_counter()
+    name = os.path.basename(archive_path)
+    try:
+        with zipfile.ZipFile(archive_path) as archive:
+            members, ignored, truncated = _archive_members(archive)
+            with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+                items = [(info.filename, info.file_size, info) for info in members]
+                entries = _read_within_budget(pool, max(1, workers), items,
+                                              lambda info: _read_archive_member(archive, info), max_tokens)
+    except (zipfile.BadZipFile, OSError) as e:
+        print(f"Error reading archive {archive_path}: {e}")
+        return None, f"could not be read: {e}"
+
+    content, stats = _pack("Archive", name, entries, ignored, truncated, max_tokens)
+    return content, _format_report(stats, time.perf_counter() - start)
@@ -0,0 +1,278 @@
+"""
+Headless multi-session load generator for capacity planning.
+
+Simulates N concurrent chat tabs against an Ollama server (or the local
+stand-in from stub_server.py) using the same ChatSession engine as the
+GUI, then reports throughput, TTFT/latency percentiles and
+error rates. Passing several session counts (e.g. --sessions 1,2,4,8)
+runs one stage per count so the point where latency falls apart is easy
+to spot.
+
+Example:
+    python loadgen.py --stub --sessions 1,2,4 --turns 3 --think-time 1 \\
+        --model gemma3:1b=3 --model llava:latest=1 \\
+        --prompt-words 40=6 --prompt-words 800=1 \\
+        --attach assets/image.png --attach-prob 0.3
+    python loadgen.py --stub-servers 3 --sessions 6 --turns 4    # backend pool routing
+"""
+import argparse
+import json
+import random
+import threading
+import time
+
+import ollama
+
+from backend_pool import BackendPool
+from config import DEFAULT_SYSTEM_PROMPT, VLM_MODELS
+from chat_session import ChatSession
+from stub_server import start_stub_server, add_stub_arguments, settings_from_args
+
+_PROMPT_WORDS = (
+    "explain how memory bandwidth thread count and batch size interact when "
+    "running quantized language models on shared servers with many users"
+).split()
+
+
+# --- Argument Helpers ---
+
+def _parse_weighted(values: list, cast=str) -> list:
+    """Parses ['a=3', 'b'] into [(a, 3.0), (b, 1.0)]."""
+    weighted = []
+    for value in values:
+        name, sep, weight = value.rpartition('=')
+        if not sep:
+            name, weight = value, "1"
+        weighted.append((cast(name), float(weight)))
+    return weighted
+
+
+def _pick(weighted: list, rng: random.Random):
+    names = [w[0] for w in weighted]
+    weights = [w[1] for w in weighted]
+    return rng.choices(names, weights=weights, k=1)[0]
+
+
+def percentile(values: list, pct: float) -> float:
+    """Linear-interpolated percentile of a list (0 for an empty list)."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * pct / 100.0
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+# --- Simulated Session ---
+
+class SimulatedSession:
+    """One simulated chat tab: a ChatSession with its own client and think time."""
+    def __init__(self, session_id: int, args, host: str | None, results: list,
+                 results_lock: threading.Lock, stop_at: float | None, pool: BackendPool | None = None):
+        self.session_id = session_id
+        self.args = args
+        self.results = results
+        self.results_lock = results_lock
+        self.stop_at = stop_at
+        self.rng = random.Random(args.seed * 1000 + session_id if args.seed is not None else None)
+        self.models = _parse_weighted(args.model)
+        self.prompt_sizes = _parse_weighted(args.prompt_words, cast=int)
+        self.session = ChatSession(
+            self.models[0][0], use_gpu=args.gpu, system_prompt=args.system_prompt,
+            client=pool or ollama.Client(host=host), use_cache=args.cache
+        )
+
+    def _make_prompt(self, turn: int) -> str:
+        n_words = _pick(self.prompt_sizes, self.rng)
+        words = [self.rng.choice(_PROMPT_WORDS) for _ in range(n_words)]
+        return f"Session {self.session_id}, question {turn + 1}: " + " ".join(words)
+
+    def _maybe_attach(self):
+        if self.args.attach and self.rng.random() < self.args.attach_prob:
+            self.session.attach_file(self.rng.choice(self.args.attach), source="attached")
+
+    def run(self):
+        for turn in range(self.args.turns):
+            if self.args.think_time > 0:
+                time.sleep(self.rng.expovariate(1.0 / self.args.think_time))
+            if self.stop_at and time.perf_counter() >= self.stop_at:
+                return
+
+            model = _pick(self.models, self.rng)
+            self.session.selected_model = model
+            self.session.chat_mode = 'vlm' if model in VLM_MODELS else 'llm_only'
+            self._maybe_attach()
+            image_list, pdf_list, text_list = self.session.attachments()
+
+            start = time.perf_counter()
+            result = self.session.send(self._make_prompt(turn))
+            latency = time.perf_counter() - start
+            stats = result['stats']
+
+            errors = 0
+            while not self.session.events.empty():
+                msg_type, text = self.session.events.get_nowait()
+                if msg_type == "LOG" and "[!!]" in text:
+                    errors += 1
+
+            with self.results_lock:
+                self.results.append({
+                    'session': self.session_id,
+                    'model': model,
+                    'success': result['success'],
+                    'latency': latency,
+                    'ttft': stats.get('ttft', latency),
+                    'attempts': stats.get('attempts', 0),
+                    'errors': errors,
+                    'eval_count': stats.get('eval_count', 0),
+                    'images': len(image_list),
+                    'files': len(pdf_list) + len(text_list),
+                })
+
+
+# --- Stages & Reporting ---
+
+def run_stage(n_sessions: int, args, host: str | None, pool: BackendPool | None = None) -> dict:
+    """Runs one load stage with n_sessions concurrent conversations (sharing `pool` if given)."""
+    results = []
+    results_lock = threading.Lock()
+    stop_at = time.perf_counter() + args.duration if args.duration else None
+
+    threads = []
+    start = time.perf_counter()
+    for i in range(n_sessions):
+        session = SimulatedSession(i + 1, args, host, results, results_lock, stop_at, pool)
+        thread = threading.Thread(target=session.run, daemon=True)
+        threads.append(thread)
+        thread.start()
+        if args.ramp_up and n_sessions > 1:
+            time.sleep(args.ramp_up / (n_sessions - 1))
+    for thread in threads:
+        thread.join()
+    wall_time = time.perf_counter() - start
+
+    return summarize(results, n_sessions, wall_time)
+
+
+def summarize(results: list, n_sessions: int, wall_time: float) -> dict:
+    ok = [r for r in results if r['success']]
+    total_requests = len(results)
+    total_attempts = sum(r['attempts'] for r in results)
+    summary = {
+        'sessions': n_sessions,
+        'wall_time': wall_time,
+        'requests': total_requests,
+        'failed': total_requests - len(ok),
+        'error_rate': (total_requests - len(ok)) / total_requests if total_requests else 0.0,
+        'attempt_error_rate': sum(r['errors'] for r in results) / total_attempts if total_attempts else 0.0,
+        'throughput_rps': len(ok) / wall_time if wall_time else 0.0,
+        'tokens_per_sec': sum(r['eval_count'] for r in ok) / wall_time if wall_time else 0.0,
+        'per_model': {},
+    }
+    for name, key in (('ttft', 'ttft'), ('latency', 'latency')):
+        values = [r[key] for r in ok]
+        for pct in (50, 90, 95, 99):
+            summary[f'{name}_p{pct}'] = percentile(values, pct)
+
+    for model in sorted({r['model'] for r in results}):
+        model_results = [r for r in results if r['model'] == model]
+        model_ok = [r for r in model_results if r['success']]
+        summary['per_model'][model] = {
+            'requests': len(model_results),
+            'failed': len(model_results) - len(model_ok),
+            'ttft_p50': percentile([r['ttft'] for r in model_ok], 50),
+            'latency_p95': percentile([r['latency'] for r in model_ok], 95),
+        }
+    return summary
+
+
+def print_summary(summary: dict):
+    print(f"\n=== {summary['sessions']} concurrent session(s) ===")
+    print(f"Requests: {summary['requests']}  failed: {summary['failed']}  "
+          f"error rate: {summary['error_rate']:.1%}  (per attempt: {summary['attempt_error_rate']:.1%})")
+    print(f"Throughput: {summary['throughput_rps']:.2f} req/s  {summary['tokens_per_sec']:.1f} tokens/s  "
+          f"(wall {summary['wall_time']:.1f} s)")
+    print("TTFT    p50 {ttft_p50:7.2f}s  p90 {ttft_p90:7.2f}s  p95 {ttft_p95:7.2f}s  p99 {ttft_p99:7.2f}s".format(**summary))
+    print("Latency p50 {latency_p50:7.2f}s  p90 {latency_p90:7.2f}s  p95 {latency_p95:7.2f}s  p99 {latency_p99:7.2f}s".format(**summary))
+    for model, m in summary['per_model'].items():
+        print(f"  {model:<20} requests {m['requests']:>4}  failed {m['failed']:>3}  "
+              f"TTFT p50 {m['ttft_p50']:.2f}s  latency p95 {m['latency_p95']:.2f}s")
+    if summary.get('hedging', {}).get('hedged'):
+        h = summary['hedging']
+        print(f"Hedging: {h['hedged']} of {h['streams']} requests ({h['hedge_rate']:.1%}), "
+              f"hedge won {h['hedge_wins']} ({h['win_rate']:.0%}), {h['over_budget']} skipped over budget")
+    for backend in summary.get('backends', []):
+        print(f"  backend {backend['host']:<24} requests {backend['requests']:>4}  "
+              f"failures {backend['failures']:>3}  {'up' if backend['healthy'] else 'DOWN'}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate concurrent chat sessions against Ollama.")
+    parser.add_argument("--sessions", default="4",
+                        help="Concurrent sessions, or a comma-separated sweep (e.g. 1,2,4,8).")
+    parser.add_argument("--turns", type=int, default=5, help="Turns per session.")
+    parser.add_argument("--think-time", type=float, default=2.0,
+                        help="Mean think time between turns in seconds (exponential).")
+    parser.add_argument("--ramp-up", type=float, default=0.0,
+                        help="Seconds over which sessions are started.")
+    parser.add_argument("--duration", type=float, default=0.0,
+                        help="Stop starting new turns after this many seconds (0 = no limit).")
+    parser.add_argument("--model", action="append",
+                        help="Model with optional weight, e.g. gemma3:1b=3. Repeatable.")
+    parser.add_argument("--prompt-words", action="append",
+                        help="Prompt size in words with optional weight, e.g. 500=2. Repeatable.")
+    parser.add_argument("--attach", action="append", default=[],
+                        help="File to attach on some turns. Repeatable.")
+    parser.add_argument("--attach-prob", type=float, default=0.0,
+                        help="Probability that a turn carries an attachment.")
+    parser.add_argument("--system-prompt", default=DEFAULT_SYSTEM_PROMPT)
+    parser.add_argument("--gpu", action="store_true", help="Request GPU options (default: CPU).")
+    parser.add_argument("--cache", action="store_true",
+                        help="Allow the response cache (off by default so every turn hits the server).")
+    parser.add_argument("--seed", type=int, default=None, help="Random seed for reproducible runs.")
+    parser.add_argument("--host", default=None,
+                        help="Ollama host URL (default: client default). Comma-separated URLs use a backend pool.")
+    parser.add_argument("--stub", action="store_true",
+                        help="Run against an in-process stand-in server instead of Ollama.")
+    parser.add_argument("--stub-servers", type=int, default=0,
+                        help="Run against this many stand-in servers behind a backend pool.")
+    parser.add_argument("--hedge", action="store_true",
+                        help="Hedge late requests across the backend pool (see HEDGE_* in config.py).")
+    parser.add_argument("--json", dest="json_path", help="Write the stage summaries to this file.")
+    add_stub_arguments(parser)
+    args = parser.parse_args()
+
+    args.model = args.model or ['gemma3:1b']
+    args.prompt_words = args.prompt_words or ['50']
+    if args.attach_prob and not args.attach:
+        parser.error("--attach-prob requires at least one --attach file")
+
+    host = args.host
+    if args.stub or args.stub_servers:
+        models = [name for name, _ in _parse_weighted(args.model)]
+        servers = [start_stub_server(settings=settings_from_args(args, models))
+                   for _ in range(max(1, args.stub_servers))]
+        host = ",".join(server.url for server in servers)
+        print(f"Using stand-in server(s) at {host}")
+
+    pool = BackendPool(host.split(','), hedging=args.hedge) if host and ',' in host else None
+    if args.hedge and pool is None:
+        parser.error("--hedge needs several backends (a comma-separated --host or --stub-servers)")
+    summaries = []
+    for n_sessions in [int(n) for n in args.sessions.split(',') if n.strip()]:
+        summary = run_stage(n_sessions, args, host, pool)
+        if pool is not None:
+            summary['backends'] = pool.status()
+            summary['hedging'] = pool.hedge_stats()
+        print_summary(summary)
+        summaries.append(summary)
+
+    if args.json_path:
+        with open(args.json_path, 'w', encoding='utf-8') as f:
+            json.dump(summaries, f, indent=2)
+        print(f"\nWrote {args.json_path}")
+
+
+if __name__ == "__main__":
+    main()
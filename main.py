@@ -1,11 +1,21 @@
+import argparse
+import os
+import time
 import tkinter as tk
 from tkinter import ttk
 from tkinterdnd2 import TkinterDnD
 
 # Import the refactored components
-from config import ALL_MODELS, VLM_PREFIX, LLM_PREFIX
+from config import (
+    ALL_MODELS, VLM_PREFIX, LLM_PREFIX, RESPONSE_CACHE_ENABLED, SEMANTIC_CACHE_ENABLED,
+    SERVER_HOST, SERVER_PORT, SERVER_MAX_CONCURRENT,
+    TAB_HIBERNATE_AFTER, TAB_HIBERNATE_CHECK_INTERVAL, HIBERNATE_DIR, SESSION_STORE_ENABLED
+)
 from style import setup_styling
+from attachment_pool import get_attachment_pool
 from chatbot_instance import ChatbotInstance
+from session_store import get_session_store
+from saved_chats_window import SavedChatsWindow
 
 class ChatbotManager:
     """
@@ -18,6 +28,7 @@ class ChatbotManager:
 
         self.tab_counter = 0
         self.chat_instances = {}
+        self.selected_tab_id = None
 
         # --- Control Frame (Top) ---
         self.control_frame = ttk.Frame(root)
@@ -30,6 +41,14 @@ class ChatbotManager:
         )
         add_tab_button.pack(side="right", padx=(10, 0))
 
+        if SESSION_STORE_ENABLED:
+            saved_chats_button = ttk.Button(
+                self.control_frame,
+                text="Saved Chats",
+                command=self.show_saved_chats
+            )
+            saved_chats_button.pack(side="right", padx=(10, 0))
+
         model_label = ttk.Label(self.control_frame, text="Model:")
         model_label.pack(side="left", padx=(10, 0))
 
@@ -53,21 +72,42 @@ class ChatbotManager:
             offvalue=False
         )
         self.gpu_toggle.pack(side="left", padx=5)
+
+        self.use_cache_var = tk.BooleanVar(value=RESPONSE_CACHE_ENABLED)
+        self.cache_toggle = ttk.Checkbutton(
+            self.control_frame,
+            text="Use Cache",
+            variable=self.use_cache_var,
+            onvalue=True,
+            offvalue=False,
+            command=self.on_cache_toggled
+        )
+        self.cache_toggle.pack(side="left", padx=5)
+
+        self.use_semantic_cache_var = tk.BooleanVar(value=SEMANTIC_CACHE_ENABLED)
+        self.semantic_cache_toggle = ttk.Checkbutton(
+            self.control_frame,
+            text="Similar Questions",
+            variable=self.use_semantic_cache_var,
+            onvalue=True,
+            offvalue=False,
+            command=self.on_cache_toggled
+        )
+        self.semantic_cache_toggle.pack(side="left", padx=5)
         
         # --- Notebook (Tabs) ---
         self.notebook = ttk.Notebook(root)
         self.notebook.pack(fill="both", expand=True, padx=10, pady=(0, 10))
+        self.notebook.bind("<<NotebookTabChanged>>", self.on_tab_changed)
 
         self.root.protocol("WM_DELETE_WINDOW", self.on_app_quit)
         self.add_new_chat_tab() # Start with one chat tab
 
+        if TAB_HIBERNATE_AFTER:
+            self.root.after(TAB_HIBERNATE_CHECK_INTERVAL * 1000, self.hibernate_idle_tabs)
+
     def add_new_chat_tab(self):
         """Creates a new tab with a new, independent chat instance."""
-        self.tab_counter += 1
-        tab_id = f"chat_{self.tab_counter}"
-
-        tab_frame = ttk.Frame(self.notebook)
-
         # Get settings from the control bar
         selected_formatted_string = self.model_var.get()
         if not selected_formatted_string:
@@ -90,6 +130,14 @@ class ChatbotManager:
             selected_model = 'llava:latest'
             selected_mode = 'vlm'
 
+        self._add_chat_tab(selected_mode, selected_model, use_gpu)
+
+    def _add_chat_tab(self, selected_mode, selected_model, use_gpu, history_id=None):
+        self.tab_counter += 1
+        tab_id = f"chat_{self.tab_counter}"
+
+        tab_frame = ttk.Frame(self.notebook)
+
         # Create tab name
         model_base_name = selected_model.split(':')[0]
         gpu_flag = " [G]" if use_gpu else ""
@@ -106,10 +154,76 @@ class ChatbotManager:
             close_callback,
             selected_mode,
             selected_model,
-            use_gpu
+            use_gpu,
+            use_cache=self.use_cache_var.get(),
+            use_semantic_cache=self.use_semantic_cache_var.get(),
+            history_id=history_id
         )
 
         self.chat_instances[tab_id] = chat
+        return chat
+
+    def show_saved_chats(self):
+        """Opens the window that lists and searches saved chats."""
+        store = get_session_store()
+        if store is None:
+            print("Error: Chat history is not available.")
+            return
+        SavedChatsWindow(self.root, store, self.open_saved_chat)
+
+    def open_saved_chat(self, session_id, turn=None):
+        """Shows a saved chat (its tab if it is already open, else a new one), scrolled to `turn` ((id, seq))."""
+        chat = next((c for c in self.chat_instances.values() if c.history_id == session_id), None)
+        if chat is not None:
+            self.notebook.select(chat.root)
+        else:
+            meta = get_session_store().load_session(session_id)
+            if meta is None:
+                print(f"Error: Saved chat {session_id} not found.")
+                return
+            chat = self._add_chat_tab(meta['chat_mode'], meta['model'], meta['use_gpu'], history_id=session_id)
+        jump = (lambda: chat.jump_to_turn(*turn)) if turn is not None else None
+        if chat.hibernated:
+            # The tab may still be saving; it jumps once it is awake
+            chat.wake(self.use_cache_var.get(), self.use_semantic_cache_var.get(), on_ready=jump)
+        elif jump is not None:
+            jump()
+
+    def on_cache_toggled(self):
+        """Applies the response-cache switches to every open chat."""
+        use_cache = self.use_cache_var.get()
+        use_semantic_cache = self.use_semantic_cache_var.get()
+        for chat in self.chat_instances.values():
+            if chat.hibernated:
+                continue # Picks up the current switches when it wakes
+            chat.session.use_cache = use_cache
+            chat.session.use_semantic_cache = use_semantic_cache
+
+    def on_tab_changed(self, event):
+        """Wakes the selected tab if it was hibernated and gives its attachment jobs priority."""
+        selected = self.notebook.select()
+        now = time.monotonic()
+        previous = self.chat_instances.get(self.selected_tab_id)
+        if previous is not None:
+            previous.last_active = now
+        for tab_id, chat in self.chat_instances.items():
+            if str(chat.root) == selected:
+                focus = lambda chat=chat: get_attachment_pool().set_focus(chat.session)
+                if chat.hibernated:
+                    chat.wake(self.use_cache_var.get(), self.use_semantic_cache_var.get(), on_ready=focus)
+                else:
+                    focus()
+                chat.last_active = now
+                self.selected_tab_id = tab_id
+
+    def hibernate_idle_tabs(self):
+        """Saves and unloads tabs that have been in the background for TAB_HIBERNATE_AFTER minutes."""
+        selected = self.notebook.select()
+        cutoff = time.monotonic() - TAB_HIBERNATE_AFTER * 60
+        for tab_id, chat in self.chat_instances.items():
+            if str(chat.root) != selected and chat.last_active < cutoff and chat.can_hibernate():
+                chat.hibernate(os.path.join(HIBERNATE_DIR, f"{os.getpid()}-{tab_id}.json"))
+        self.root.after(TAB_HIBERNATE_CHECK_INTERVAL * 1000, self.hibernate_idle_tabs)
 
     def close_tab(self, tab_id, tab_frame):
         """Callback function to close a specific tab."""
@@ -126,11 +240,43 @@ class ChatbotManager:
     def on_app_quit(self):
         """Called when the main window 'X' is clicked."""
         print("Closing all chats and exiting.")
+        for chat in self.chat_instances.values():
+            if chat.hibernated:
+                chat.discard_saved_state()
+        get_attachment_pool().shutdown()
+        store = get_session_store() if SESSION_STORE_ENABLED else None
+        if store is not None:
+            store.close() # Writes the turns still queued
         self.root.destroy()
 
 
 # --- Main execution ---
-if __name__ == "__main__":
+def parse_args():
+    parser = argparse.ArgumentParser(description="Multimodal chatbot for Ollama.")
+    parser.add_argument("--serve", action="store_true",
+                        help="Run the headless HTTP/SSE server instead of the GUI.")
+    parser.add_argument("--host", default=SERVER_HOST, help="Server bind address (--serve).")
+    parser.add_argument("--port", type=int, default=SERVER_PORT, help="Server port (--serve).")
+    parser.add_argument("--ollama-host", default=None,
+                        help="Ollama URL for --serve/--batch (default: client default). "
+                             "Several comma-separated URLs are load-balanced.")
+    parser.add_argument("--attachment-root", default=None,
+                        help="Directory server clients may attach files from (--serve).")
+    parser.add_argument("--max-concurrent", type=int, default=SERVER_MAX_CONCURRENT,
+                        help="Generations the server runs at once (--serve).")
+    parser.add_argument("--batch", metavar="JOBS_JSONL", default=None,
+                        help="Process a JSONL file of jobs without the GUI.")
+    parser.add_argument("--output", default="batch_results.jsonl",
+                        help="Results/checkpoint file for --batch.")
+    parser.add_argument("--workers", type=int, default=2,
+                        help="Jobs processed in parallel per model (--batch).")
+    parser.add_argument("--skip-failed", action="store_true",
+                        help="On resume, do not retry jobs that failed before (--batch).")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Bypass the response cache (--serve/--batch).")
+    return parser.parse_args()
+
+def run_gui():
     # CRITICAL: We must use TkinterDnD.Tk() as the root window
     root = TkinterDnD.Tk()
     root.geometry("1000x700")
@@ -150,4 +296,17 @@ if __name__ == "__main__":
 
     # Create and run the app
     app = ChatbotManager(root)
-    root.mainloop()
\ No newline at end of file
+    root.mainloop()
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.serve:
+        from chat_server import run_server
+        run_server(args.host, args.port, args.ollama_host, args.attachment_root, args.max_concurrent,
+                   use_cache=not args.no_cache)
+    elif args.batch:
+        from batch import run_batch
+        run_batch(args.batch, args.output, args.workers, args.ollama_host,
+                  retry_failed=not args.skip_failed, use_cache=not args.no_cache)
+    else:
+        run_gui()
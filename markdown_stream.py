@@ -0,0 +1,99 @@
+"""
+Resumable markdown parsing for replies that arrive chunk by chunk.
+
+MarkdownStreamParser keeps only the unfinished current line as state, so a
+chunk costs time proportional to its own length (plus one re-render of each
+line when it is finished), not to the reply so far. feed() returns render
+events:
+
+    ('partial', text)     more of the current text line, to show as-is for now
+    ('line', text)        the finished text line; replaces its partial text
+    ('code_open', lang)   a ``` fence opened (replaces any partial text)
+    ('code', text)        more code for the open block
+    ('code_close', None)  the fence closed
+"""
+import re
+
+HEADING_PATTERN = re.compile(r"(#{1,3})\s+")
+# Inline code first, so * inside `code` is left alone
+INLINE_PATTERN = re.compile(r"`([^`]+)`|\*\*(.+?)\*\*|\*([^*]+)\*")
+
+
+def _could_be_fence(line: str) -> bool:
+    stripped = line.lstrip()
+    return stripped.startswith("```") or "```".startswith(stripped)
+
+
+def inline_segments(line: str) -> list:
+    """Splits a line into (text, tag) runs for bold, italic and inline code (tag None for plain text)."""
+    segments = []
+    last = 0
+    for match in INLINE_PATTERN.finditer(line):
+        if match.start() > last:
+            segments.append((line[last:match.start()], None))
+        if match.group(1) is not None:
+            segments.append((match.group(1), "code_span"))
+        elif match.group(2) is not None:
+            segments.append((match.group(2), "bold"))
+        else:
+            segments.append((match.group(3), "italic"))
+        last = match.end()
+    if last < len(line):
+        segments.append((line[last:], None))
+    return segments
+
+
+class MarkdownStreamParser:
+    def __init__(self):
+        self.in_code = False
+        self.line = ""  # The current, unfinished line
+        self.shown = 0  # Characters of self.line already emitted
+
+    def feed(self, chunk: str) -> list:
+        events = []
+        while chunk:
+            newline = chunk.find("\n")
+            if newline == -1:
+                self.line += chunk
+                self._emit_partial(events)
+                break
+            self.line += chunk[:newline + 1]
+            chunk = chunk[newline + 1:]
+            self._finish_line(events)
+        return events
+
+    def close(self) -> list:
+        """Ends the reply: finishes the last line and closes an unterminated code block."""
+        events = []
+        if self.line:
+            self.line += "\n"
+            self._finish_line(events)
+        if self.in_code:
+            self.in_code = False
+            events.append(('code_close', None))
+        return events
+
+    def _emit_partial(self, events: list):
+        # A code line that may turn out to be the closing fence is held back until it is complete
+        if self.in_code and self.shown == 0 and _could_be_fence(self.line):
+            return
+        new_text = self.line[self.shown:]
+        if new_text:
+            events.append(('code' if self.in_code else 'partial', new_text))
+            self.shown = len(self.line)
+
+    def _finish_line(self, events: list):
+        line, shown = self.line, self.shown
+        self.line, self.shown = "", 0
+        stripped = line.strip()
+        if self.in_code:
+            if shown == 0 and stripped.startswith("```") and not stripped.strip("`"):
+                self.in_code = False
+                events.append(('code_close', None))
+            else:
+                events.append(('code', line[shown:]))
+        elif stripped.startswith("```"):
+            self.in_code = True
+            events.append(('code_open', stripped[3:].strip()))
+        else:
+            events.append(('line', line))
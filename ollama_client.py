@@ -4,10 +4,25 @@ import time
 import platform
 import os
 import queue
+import threading
 from config import MAX_RETRIES, FORBIDDEN_KEYWORDS
+from autotune import get_tuned_options, client_host
 
-def _get_ollama_options(use_gpu: bool) -> dict:
-    """Builds the options dict for the Ollama client based on settings."""
+def cpu_inference_threads() -> int:
+    """Threads Ollama is asked to use in CPU mode: slightly fewer than all cores, to keep the UI responsive."""
+    try:
+        cores = os.cpu_count()
+        return max(1, cores - 2 if cores else 4)
+    except:
+        return 4 # Failsafe
+
+def _get_ollama_options(use_gpu: bool, model: str | None = None, host: str | None = None) -> dict:
+    """
+    Builds the options dict for the Ollama client based on settings. In CPU
+    mode, a profile saved by autotune.py for (host, model) overrides the
+    default thread count and adds its batch and context sizes. With no host
+    (a BackendPool), the pool applies the profile of the endpoint it picks.
+    """
     options = {}
     system = platform.system()
 
@@ -22,12 +37,9 @@ def _get_ollama_options(use_gpu: bool) -> dict:
             options['num_gpu'] = 1 # Default request
     else:
         options['num_gpu'] = 0 # Force CPU
-        try:
-            # Use slightly fewer than all cores to keep UI responsive
-            cores = os.cpu_count()
-            options['num_thread'] = max(1, cores - 2 if cores else 4)
-        except:
-            options['num_thread'] = 4 # Failsafe
+        options['num_thread'] = cpu_inference_threads()
+        if model and host:
+            options.update(get_tuned_options(host, model))
 
     return options
 
@@ -53,16 +65,116 @@ def _is_response_valid(reply: str) -> bool:
             return False
     return True
 
+def _wait_before_retry(cancel_event: threading.Event | None):
+    """Waits before retrying, waking early if the call is cancelled."""
+    if cancel_event is not None:
+        cancel_event.wait(1)
+    else:
+        time.sleep(1)
+
+def build_user_message(prompt: str, file_context_parts: list | None = None,
+                       image_bytes_list: list | None = None) -> dict:
+    """
+    Builds the user message for a turn, wrapping any attached file contents
+    around the user's question.
+    """
+    final_prompt = prompt
+    file_context = "\n".join(file_context_parts or [])
+    if file_context:
+        final_prompt = (
+            "Here is the context from the attached files:\n"
+            f"{file_context}\n"
+            "--- End of file context ---\n\n"
+            f"User's question: {prompt}"
+        )
+
+    user_message = {'role': 'user', 'content': final_prompt}
+    if image_bytes_list:
+        user_message['images'] = image_bytes_list
+    return user_message
+
+def _resolve_images(message: dict) -> dict:
+    """History keeps attachment-store handles; the API needs the image bytes."""
+    images = message.get('images')
+    if not images:
+        return message
+    resolved = dict(message)
+    resolved['images'] = [getattr(img, 'image', img) for img in images]
+    return resolved
+
+def build_messages_for_call(system_prompt: str, history: list, user_message: dict | None) -> list:
+    """Assembles the system prompt, prior turns and the new user turn (None: just the prefix)."""
+    messages_for_call = [{'role': 'system', 'content': system_prompt}]
+    messages_for_call.extend(_resolve_images(m) for m in history)
+    if user_message is not None:
+        messages_for_call.append(_resolve_images(user_message))
+    return messages_for_call
+
+def model_is_loaded(client, model: str) -> bool:
+    """
+    Whether `model` is in memory already, so a request for it evicts
+    nothing. With a BackendPool: loaded on an endpoint with a free slot.
+    """
+    name = model if ":" in model else f"{model}:latest"
+    warm_models = getattr(client, 'warm_models', None)
+    try:
+        loaded = warm_models() if warm_models else {m.model for m in client.ps().models}
+    except Exception:
+        return False
+    return name in loaded or model in loaded
+
+def prewarm_prefix(client, selected_model: str, use_gpu: bool, messages: list,
+                   extra_options: dict | None = None,
+                   cancel_event: threading.Event | None = None) -> dict | None:
+    """
+    Has the server evaluate `messages` (a conversation prefix) and generate
+    a single token, so the next request starting with them finds the prefix
+    in the prompt cache. The options are those execute_ollama_call() sends,
+    since a different context size or GPU setting would reload the model.
+    Returns the server's 'prompt_eval_count' and 'prompt_eval_duration', or
+    None if `cancel_event` was set: the stream is closed at the next chunk,
+    which drops the request on the server.
+    """
+    options = _get_ollama_options(use_gpu, selected_model, client_host(client))
+    if extra_options:
+        options.update(extra_options)
+    # 0 means "no limit" to Ollama's runner, so one token is the least it can be asked for
+    options['num_predict'] = 1
+    stats = {'prompt_eval_count': 0, 'prompt_eval_duration': 0}
+    response = client.chat(model=selected_model, messages=messages, stream=True, options=options)
+    try:
+        for chunk in response:
+            if cancel_event is not None and cancel_event.is_set():
+                return None
+            for key in stats:
+                stats[key] = chunk.get(key) or stats[key]
+    finally:
+        close = getattr(response, 'close', None)
+        if close:
+            close()
+    return stats
+
 def execute_ollama_call(
     client: ollama.Client,
     selected_model: str,
     use_gpu: bool,
     messages_for_call: list,
-    logic_queue: queue.Queue
+    logic_queue: queue.Queue,
+    on_chunk=None,
+    stats: dict | None = None,
+    cancel_event: threading.Event | None = None,
+    extra_options: dict | None = None
 ) -> tuple[str, float, bool]:
     """
     Executes the Ollama chat call with retry logic.
 
+    The reply is streamed so the time to first token can be measured.
+    `on_chunk(text)` is called for every streamed piece of the reply, and
+    `stats` (if given) is filled with 'ttft', 'attempts' and the server's
+    token counters for the last attempt. Setting `cancel_event` aborts the
+    call between chunks (stats['cancelled'] is then True). `extra_options`
+    (sampling settings such as temperature) are merged into the request.
+
     Returns:
         tuple[str, float, bool]: (reply, elapsed_time, success_flag)
     """
@@ -70,25 +182,55 @@ def execute_ollama_call(
     reply = ""
     elapsed_time = 0
     
-    options = _get_ollama_options(use_gpu)
+    options = _get_ollama_options(use_gpu, selected_model, client_host(client))
+    if extra_options:
+        options.update(extra_options)
 
     for attempt in range(MAX_RETRIES):
+        if stats is not None:
+            stats['attempts'] = attempt + 1
+        if cancel_event is not None and cancel_event.is_set():
+            break
         try:
             # Start timer
             start_time = time.perf_counter()
+            ttft = None
+            parts = []
+            final_chunk = None
 
             response = client.chat(
                 model=selected_model,
                 messages=messages_for_call,
-                stream=False,
+                stream=True,
                 options=options
             )
 
+            for chunk in response:
+                if cancel_event is not None and cancel_event.is_set():
+                    response.close() # Drop the connection so the server stops generating
+                    break
+                content = chunk.get('message', {}).get('content', '')
+                if content:
+                    if ttft is None:
+                        ttft = time.perf_counter() - start_time
+                    parts.append(content)
+                    if on_chunk:
+                        on_chunk(content)
+                if chunk.get('done'):
+                    final_chunk = chunk
+
             # End timer
             end_time = time.perf_counter()
             elapsed_time = end_time - start_time
 
-            reply = response.get('message', {}).get('content', '')
+            reply = "".join(parts)
+            if cancel_event is not None and cancel_event.is_set():
+                break
+            if stats is not None:
+                stats['ttft'] = ttft if ttft is not None else elapsed_time
+                if final_chunk is not None:
+                    for key in ('prompt_eval_count', 'prompt_eval_duration', 'eval_count', 'eval_duration'):
+                        stats[key] = final_chunk.get(key) or 0
 
             if _is_response_valid(reply):
                 valid_response_received = True
@@ -103,11 +245,14 @@ def execute_ollama_call(
         except ResponseError as e:
             # Handle API error (e.g., timeout)
             logic_queue.put(("LOG", f"\n[!!] Ollama Error (Attempt {attempt+1}/{MAX_RETRIES}): {e.error} [!!]"))
-            time.sleep(1) # Wait before retrying
+            _wait_before_retry(cancel_event)
         except Exception as e:
             # Handle other Python errors
             logic_queue.put(("LOG", f"\n[!!] THREAD ERROR (Attempt {attempt+1}/{MAX_RETRIES}): {e} [!!]"))
-            time.sleep(1) # Wait before retrying
+            _wait_before_retry(cancel_event)
+
+    if stats is not None:
+        stats['cancelled'] = cancel_event is not None and cancel_event.is_set()
 
-    # All retries failed
+    # All retries failed (or the call was cancelled)
     return reply, elapsed_time, False
\ No newline at end of file
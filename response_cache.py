@@ -0,0 +1,181 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from config import (
+    RESPONSE_CACHE_PATH, RESPONSE_CACHE_MEMORY_ENTRIES,
+    RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_TTL
+)
+
+# Options that only change how fast a reply is computed, not what it says
+_RUNTIME_ONLY_OPTIONS = {'num_gpu', 'num_thread', 'num_batch', 'use_mmap', 'use_mlock', 'low_vram'}
+
+# Prune the disk store after this many writes
+_PRUNE_EVERY = 50
+
+
+def is_cacheable(options: dict | None) -> bool:
+    """Only deterministic requests may be served from the cache."""
+    options = options or {}
+    return options.get('temperature') == 0 or options.get('seed') is not None
+
+
+def _digest_image(image) -> str:
+    if getattr(image, 'digest', None):
+        return image.digest # Attachment-store handle: already hashed
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        return hashlib.sha256(image).hexdigest()
+    if isinstance(image, str) and os.path.isfile(image):
+        digest = hashlib.sha256()
+        with open(image, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+        return digest.hexdigest()
+    return hashlib.sha256(str(image).encode('utf-8')).hexdigest()
+
+
+def make_cache_key(model: str, options: dict | None, messages: list) -> str:
+    """
+    Canonical hash of model + sampling options + messages. Image bytes are
+    replaced by their SHA-256 so large attachments are never serialized.
+    """
+    canonical_messages = []
+    for message in messages:
+        entry = {'role': message.get('role'), 'content': message.get('content', '')}
+        if message.get('images'):
+            entry['images'] = [_digest_image(img) for img in message['images']]
+        canonical_messages.append(entry)
+
+    canonical_options = {k: v for k, v in (options or {}).items() if k not in _RUNTIME_ONLY_OPTIONS}
+    payload = json.dumps(
+        {'model': model, 'options': canonical_options, 'messages': canonical_messages},
+        sort_keys=True, separators=(',', ':'), ensure_ascii=False
+    )
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """
+    Exact-match reply cache: an in-memory LRU in front of a SQLite store.
+    Entries expire after `ttl` seconds and the store is trimmed (least
+    recently used first) to `max_bytes`. Safe to share between threads.
+    """
+    def __init__(self, db_path: str = RESPONSE_CACHE_PATH,
+                 memory_entries: int = RESPONSE_CACHE_MEMORY_ENTRIES,
+                 max_bytes: int = RESPONSE_CACHE_MAX_BYTES,
+                 ttl: float = RESPONSE_CACHE_TTL):
+        self.memory_entries = memory_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._memory = OrderedDict() # key -> (reply, created)
+        self._writes = 0
+
+        if db_path != ":memory:":
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY, model TEXT, reply TEXT,"
+            " created REAL, last_access REAL, size INTEGER)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_access ON responses(last_access)")
+        self._db.commit()
+
+    def get(self, key: str) -> str | None:
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                reply, created = entry
+                if now - created <= self.ttl:
+                    self._memory.move_to_end(key)
+                    self.hits += 1
+                    return reply
+                del self._memory[key]
+
+            row = self._db.execute("SELECT reply, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            reply, created = row
+            if now - created > self.ttl:
+                self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._db.commit()
+                self.misses += 1
+                return None
+
+            self._db.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+            self._db.commit()
+            self._remember(key, reply, created)
+            self.hits += 1
+            return reply
+
+    def put(self, key: str, model: str, reply: str):
+        now = time.time()
+        with self._lock:
+            self._remember(key, reply, now)
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses (key, model, reply, created, last_access, size)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (key, model, reply, now, now, len(reply.encode('utf-8')))
+            )
+            self._writes += 1
+            if self._writes % _PRUNE_EVERY == 0:
+                self._prune(now)
+            self._db.commit()
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._db.execute("DELETE FROM responses")
+            self._db.commit()
+
+    def _remember(self, key: str, reply: str, created: float):
+        self._memory[key] = (reply, created)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def _prune(self, now: float):
+        """Drops expired entries, then the least recently used until under max_bytes."""
+        self._db.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl,))
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        excess = total - self.max_bytes
+        freed = 0
+        victims = []
+        for key, size in self._db.execute("SELECT key, size FROM responses ORDER BY last_access"):
+            victims.append((key,))
+            freed += size
+            if freed >= excess:
+                break
+        self._db.executemany("DELETE FROM responses WHERE key = ?", victims)
+        for (key,) in victims:
+            self._memory.pop(key, None)
+
+
+_shared_cache = None
+_shared_cache_failed = False
+_shared_cache_lock = threading.Lock()
+
+def get_response_cache() -> ResponseCache | None:
+    """Returns the process-wide cache shared by every session (None if it can't be opened)."""
+    global _shared_cache, _shared_cache_failed
+    with _shared_cache_lock:
+        if _shared_cache is None and not _shared_cache_failed:
+            try:
+                _shared_cache = ResponseCache()
+            except (sqlite3.Error, OSError) as e:
+                print(f"Error opening response cache, caching disabled: {e}")
+                _shared_cache_failed = True
+        return _shared_cache
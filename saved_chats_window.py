@@ -0,0 +1,110 @@
+import time
+import tkinter as tk
+from tkinter import ttk
+from concurrent.futures import ThreadPoolExecutor
+
+from config import SEARCH_DELAY
+
+# Searches run here so a query matching most of the history can't stall the UI
+_search_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="chat-search")
+
+
+class SavedChatsWindow:
+    """
+    Lists recent saved chats and searches all of them. Opening an entry calls
+    `open_callback(session_id, turn)`; turn is the matching turn's (id, seq)
+    for search results and None for a whole chat.
+    """
+    def __init__(self, root, store, open_callback):
+        self.store = store
+        self.open_callback = open_callback
+        self.entries = []         # (session_id, turn) per listbox row
+        self._search_id = None    # Pending debounced search
+        self._generation = 0      # Only the newest search's results are shown
+
+        self.window = tk.Toplevel(root)
+        self.window.title("Saved Chats")
+        self.window.geometry("700x450")
+
+        search_frame = ttk.Frame(self.window)
+        search_frame.pack(side="top", fill="x", padx=10, pady=(10, 0))
+        ttk.Label(search_frame, text="Search:").pack(side="left", padx=(0, 5))
+        self.query_var = tk.StringVar()
+        search_entry = ttk.Entry(search_frame, textvariable=self.query_var)
+        search_entry.pack(side="left", fill="x", expand=True)
+        search_entry.bind("<KeyRelease>", self._on_query_changed)
+        search_entry.bind("<Return>", lambda e: self._open_selected())
+        if not store.search_available:
+            search_entry.config(state="disabled")
+        self.status_label = ttk.Label(search_frame, text="")
+        self.status_label.pack(side="left", padx=(10, 0))
+
+        buttons = ttk.Frame(self.window)
+        buttons.pack(side="bottom", fill="x", padx=10, pady=10)
+        ttk.Button(buttons, text="Open", command=self._open_selected).pack(side="right")
+
+        self.listbox = tk.Listbox(self.window, font=("Arial", 13), activestyle="none")
+        scrollbar = ttk.Scrollbar(self.window, orient=tk.VERTICAL, command=self.listbox.yview)
+        self.listbox.config(yscrollcommand=scrollbar.set)
+        scrollbar.pack(side="right", fill="y", pady=(10, 0))
+        self.listbox.pack(side="left", fill="both", expand=True, padx=(10, 0), pady=(10, 0))
+        self.listbox.bind("<Double-Button-1>", lambda e: self._open_selected())
+
+        self._show_recent()
+        search_entry.focus()
+
+    def _show_recent(self):
+        rows = []
+        for meta in self.store.list_sessions():
+            updated = time.strftime("%Y-%m-%d %H:%M", time.localtime(meta['updated']))
+            rows.append(((meta['id'], None),
+                         f"{updated}  {meta['title'] or '(untitled)'}  [{meta['model']}, {meta['turns']} turns]"))
+        self._fill(rows, "No saved chats yet.")
+        self.status_label.config(text="")
+
+    def _fill(self, rows: list, empty_text: str):
+        self.listbox.delete(0, tk.END)
+        self.entries = [entry for entry, _ in rows]
+        self.listbox.insert(tk.END, *([text for _, text in rows] if rows else [empty_text]))
+
+    # --- Search ---
+
+    def _on_query_changed(self, event):
+        if self._search_id is not None:
+            self.window.after_cancel(self._search_id)
+        self._search_id = self.window.after(SEARCH_DELAY, self._search)
+
+    def _search(self):
+        self._search_id = None
+        self._generation += 1
+        query = self.query_var.get().strip()
+        if not query:
+            self._show_recent()
+            return
+        self.status_label.config(text="Searching...")
+        start = time.perf_counter()
+        future = _search_executor.submit(self.store.search, query)
+        self._poll_search(future, self._generation, start)
+
+    def _poll_search(self, future, generation, start):
+        if generation != self._generation or not self.window.winfo_exists():
+            return # A newer query was typed, or the window was closed
+        if not future.done():
+            self.window.after(15, self._poll_search, future, generation, start)
+            return
+        results = future.result()
+        rows = []
+        for result in results:
+            created = time.strftime("%Y-%m-%d", time.localtime(result['created']))
+            rows.append(((result['session_id'], (result['turn_id'], result['seq'])),
+                         f"{created}  {result['title'] or '(untitled)'}: {result['snippet']}"))
+        self._fill(rows, "No matches.")
+        self.status_label.config(text=f"{len(results)} found in {(time.perf_counter() - start) * 1000:.0f} ms")
+
+    def _open_selected(self):
+        selection = self.listbox.curselection()
+        if not self.entries:
+            return
+        session_id, turn = self.entries[selection[0] if selection else 0]
+        self.window.destroy()
+        self.open_callback(session_id, turn)
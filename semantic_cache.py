@@ -0,0 +1,149 @@
+import hashlib
+import threading
+
+# --- NumPy Import ---
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
+from config import (
+    SEMANTIC_CACHE_EMBED_MODEL, SEMANTIC_CACHE_THRESHOLD, SEMANTIC_CACHE_MAX_ENTRIES
+)
+from response_cache import make_cache_key
+
+
+def context_digest(history: list, file_context_parts: list, image_bytes_list: list) -> str:
+    """
+    Hash of everything around the question: prior turns, attached file text
+    and images. Only questions asked in an identical context can match.
+    """
+    context = list(history)
+    context.append({
+        'role': 'attachments',
+        'content': "\n".join(file_context_parts or []),
+        'images': image_bytes_list or [],
+    })
+    return make_cache_key('', None, context)
+
+
+def _scope_key(model: str, system_prompt: str) -> tuple:
+    return model, hashlib.sha256((system_prompt or '').encode('utf-8')).hexdigest()
+
+
+class _ScopeIndex:
+    """Normalized question embeddings and replies for one (model, persona)."""
+    def __init__(self, dim: int):
+        self.vectors = np.zeros((16, dim), dtype=np.float32)
+        self.replies = []
+        self.rows_by_context = {} # context digest -> [row, ...]
+
+    def add(self, vector, reply: str, digest: str):
+        row = len(self.replies)
+        if row == self.vectors.shape[0]:
+            grown = np.zeros((row * 2, self.vectors.shape[1]), dtype=np.float32)
+            grown[:row] = self.vectors
+            self.vectors = grown
+        self.vectors[row] = vector
+        self.replies.append(reply)
+        self.rows_by_context.setdefault(digest, []).append(row)
+
+    def search(self, vector, digest: str) -> tuple[int, float]:
+        rows = self.rows_by_context.get(digest)
+        if not rows:
+            return -1, 0.0
+        similarities = self.vectors[rows] @ vector
+        best = int(np.argmax(similarities))
+        return rows[best], float(similarities[best])
+
+    def __len__(self):
+        return len(self.replies)
+
+
+class SemanticCache:
+    """
+    Opt-in cache for near-duplicate questions. The user's question is
+    embedded with a small embedding model and compared (cosine similarity)
+    against earlier questions asked to the same model and persona in the
+    same context; above `threshold` the earlier reply is returned.
+    """
+    def __init__(self, embed_model: str = SEMANTIC_CACHE_EMBED_MODEL,
+                 threshold: float = SEMANTIC_CACHE_THRESHOLD,
+                 max_entries: int = SEMANTIC_CACHE_MAX_ENTRIES):
+        self.embed_model = embed_model
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._scopes = {}
+
+    def embed(self, client, text: str):
+        """Returns the L2-normalized embedding of `text`, or None on failure."""
+        try:
+            response = client.embed(model=self.embed_model, input=text)
+            vector = np.asarray(response['embeddings'][0], dtype=np.float32)
+        except Exception as e:
+            print(f"Semantic cache: embedding failed ({e})")
+            return None
+        norm = float(np.linalg.norm(vector))
+        return vector / norm if norm else None
+
+    def lookup(self, model: str, system_prompt: str, vector, digest: str) -> tuple[str | None, float]:
+        """Returns (reply, similarity) for the closest match, or (None, best similarity)."""
+        with self._lock:
+            index = self._scopes.get(_scope_key(model, system_prompt))
+            if index is None or index.vectors.shape[1] != vector.shape[0]:
+                self.misses += 1
+                return None, 0.0
+            row, similarity = index.search(vector, digest)
+            if row >= 0 and similarity >= self.threshold:
+                self.hits += 1
+                return index.replies[row], similarity
+            self.misses += 1
+            return None, similarity
+
+    def store(self, model: str, system_prompt: str, vector, digest: str, reply: str):
+        with self._lock:
+            key = _scope_key(model, system_prompt)
+            index = self._scopes.get(key)
+            if index is None or index.vectors.shape[1] != vector.shape[0]:
+                index = self._scopes[key] = _ScopeIndex(vector.shape[0])
+            if len(index) >= self.max_entries:
+                index = self._scopes[key] = self._compact(index)
+            index.add(vector, reply, digest)
+
+    def _compact(self, index: _ScopeIndex) -> _ScopeIndex:
+        """Keeps the newest half of a full scope."""
+        keep_from = len(index) // 2
+        context_of_row = {row: digest for digest, rows in index.rows_by_context.items() for row in rows}
+        compacted = _ScopeIndex(index.vectors.shape[1])
+        for row in range(keep_from, len(index)):
+            compacted.add(index.vectors[row], index.replies[row], context_of_row[row])
+        return compacted
+
+    def invalidate(self, model: str | None = None, system_prompt: str | None = None):
+        """Drops a model's entries (optionally for one persona only), or everything."""
+        with self._lock:
+            if model is None:
+                self._scopes.clear()
+            elif system_prompt is None:
+                for key in [k for k in self._scopes if k[0] == model]:
+                    del self._scopes[key]
+            else:
+                self._scopes.pop(_scope_key(model, system_prompt), None)
+
+
+_shared_cache = None
+_shared_cache_lock = threading.Lock()
+
+def get_semantic_cache() -> SemanticCache | None:
+    """Returns the process-wide semantic cache, or None when NumPy is missing."""
+    global _shared_cache
+    if not NUMPY_AVAILABLE:
+        return None
+    with _shared_cache_lock:
+        if _shared_cache is None:
+            _shared_cache = SemanticCache()
+        return _shared_cache
@@ -0,0 +1,470 @@
+"""
+Saved conversations, in SQLite.
+
+Every finished turn is queued and written by a single writer thread (the
+database is in WAL mode, so reads never wait for it): saving costs the
+caller a queue put. Images are stored once per content hash in `blobs`
+and referenced from `turn_images`, so a screenshot sent in many turns is
+kept once and turn rows stay small.
+
+Turns form a tree: each one points at the turn it follows (`parent_id`),
+and editing a message or regenerating a reply adds a sibling instead of
+copying the conversation, so a shared prefix is stored once however many
+branches grow from it. A session's `head_id` is the last turn of the branch
+being shown.
+
+Reopening a conversation reads only the newest turns of that branch, by
+walking parent links up from the head; older ones are read a page at a
+time (load_turns with `before_id`), so the cost does not depend on how
+long the conversation is or how many branches it has.
+
+Turns are indexed for full-text search (SQLite FTS5) by the writer thread,
+in the same transaction that saves them. The index covers the question as
+sent (including the text of attached files) and the reply. Without FTS5 in
+the local SQLite build, search() finds nothing and everything else works.
+"""
+import os
+import re
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+
+from config import SESSION_STORE_PATH, SESSION_LOAD_TURNS, SESSION_LIST_LIMIT, SEARCH_RESULT_LIMIT
+from attachment_store import StoredAttachment, get_attachment_store, digest_bytes
+
+TITLE_CHARS = 60
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id TEXT PRIMARY KEY, title TEXT NOT NULL DEFAULT '',
+    model TEXT, chat_mode TEXT, use_gpu INTEGER, system_prompt TEXT,
+    created REAL, updated REAL, turns INTEGER NOT NULL DEFAULT 0, head_id INTEGER
+);
+CREATE INDEX IF NOT EXISTS sessions_updated ON sessions(updated);
+CREATE TABLE IF NOT EXISTS turns (
+    id INTEGER PRIMARY KEY, session_id TEXT NOT NULL, parent_id INTEGER, seq INTEGER NOT NULL,
+    prompt TEXT, user_content TEXT, reply TEXT, model TEXT, created REAL
+);
+CREATE INDEX IF NOT EXISTS turns_parent ON turns(session_id, parent_id);
+CREATE TABLE IF NOT EXISTS turn_images (
+    turn_id INTEGER NOT NULL, position INTEGER NOT NULL, digest TEXT NOT NULL,
+    PRIMARY KEY (turn_id, position)
+);
+CREATE INDEX IF NOT EXISTS turn_images_digest ON turn_images(digest);
+CREATE TABLE IF NOT EXISTS blobs (
+    digest TEXT PRIMARY KEY, data BLOB NOT NULL, size INTEGER
+);
+CREATE TABLE IF NOT EXISTS turn_ids (id INTEGER PRIMARY KEY AUTOINCREMENT);
+"""
+# Older databases have no id counter yet: it starts after the turns already saved
+_SEED_TURN_IDS = """
+INSERT INTO turn_ids (id) SELECT id FROM turns
+    WHERE id > COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'turn_ids'), 0) ORDER BY id DESC LIMIT 1;
+DELETE FROM turn_ids;
+"""
+# A session's turn count is the depth of the branch it shows. Older versions counted every
+# saved turn, including the other versions of edited and regenerated ones.
+_TURN_COUNT_REPAIR = """
+UPDATE sessions SET turns = COALESCE((SELECT seq FROM turns WHERE id = sessions.head_id), 0)
+    WHERE turns != COALESCE((SELECT seq FROM turns WHERE id = sessions.head_id), 0);
+"""
+# Indexes the turns table's own text (external content), so nothing is stored twice
+_FTS_SCHEMA = (
+    "CREATE VIRTUAL TABLE turns_fts USING fts5("
+    " user_content, reply, content='turns', content_rowid='id', tokenize='unicode61 remove_diacritics 2')"
+)
+# Databases from before branching kept one list of turns per session, numbered by seq.
+# Row ids are kept, so the search index stays valid.
+_TREE_MIGRATION = """
+ALTER TABLE turns RENAME TO turns_list;
+CREATE TABLE turns (
+    id INTEGER PRIMARY KEY, session_id TEXT NOT NULL, parent_id INTEGER, seq INTEGER NOT NULL,
+    prompt TEXT, user_content TEXT, reply TEXT, model TEXT, created REAL
+);
+INSERT INTO turns (id, session_id, parent_id, seq, prompt, user_content, reply, model, created)
+    SELECT t.id, t.session_id,
+           (SELECT p.id FROM turns_list p WHERE p.session_id = t.session_id AND p.seq = t.seq - 1),
+           t.seq, t.prompt, t.user_content, t.reply, t.model, t.created
+    FROM turns_list t;
+DROP TABLE turns_list;
+ALTER TABLE sessions ADD COLUMN head_id INTEGER;
+UPDATE sessions SET head_id = (SELECT id FROM turns WHERE session_id = sessions.id ORDER BY seq DESC LIMIT 1);
+"""
+
+
+def _image_entry(image) -> tuple:
+    """(digest, bytes) for a history image: an attachment-store handle or raw bytes."""
+    data = getattr(image, 'image', image)
+    digest = getattr(image, 'digest', None) or digest_bytes(data, 'image')
+    return digest, data
+
+
+def turn_messages(turn: dict) -> list:
+    """The two history messages (user, assistant) of a loaded turn."""
+    user_message = {'role': 'user', 'content': turn['user_content']}
+    if turn['images']:
+        user_message['images'] = turn['images']
+    return [user_message, {'role': 'assistant', 'content': turn['reply']}]
+
+
+def _match_query(text: str, any_word: bool = False) -> str | None:
+    """
+    Turns what the user typed into an FTS5 query: every word must match (or,
+    with `any_word`, at least one), the last one as a prefix.
+    """
+    words = re.findall(r"\w+", text)
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words]
+    terms[-1] += "*"
+    return (" OR " if any_word else " ").join(terms)
+
+
+class SessionStore:
+    def __init__(self, db_path: str = SESSION_STORE_PATH):
+        if db_path == ":memory:":
+            # The writer thread and the readers each open their own connection, and each
+            # in-memory connection is a separate empty database
+            raise ValueError("SessionStore needs a database file, not an in-memory database")
+        self.db_path = db_path
+        if os.path.dirname(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self._read_lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(turns)")]
+        if columns and 'parent_id' not in columns:
+            self._db.executescript(_TREE_MIGRATION)
+        self._db.executescript(_SCHEMA)
+        self._db.executescript(_SEED_TURN_IDS)
+        self._db.executescript(_TURN_COUNT_REPAIR)
+        self._db.commit()
+        self.search_available, needs_index = self._create_search_index()
+        # Searches get their own connection, so a slow one never holds up loading a chat
+        self._search_lock = threading.Lock()
+        self._search_db = sqlite3.connect(db_path, check_same_thread=False)
+
+        self._writes = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, name="session-store", daemon=True)
+        self._writer.start()
+        if needs_index:
+            # Turns saved before the index existed are indexed in the background
+            self._writes.put(('reindex', None))
+
+    def _create_search_index(self) -> tuple[bool, bool]:
+        """(FTS5 available, index was just created)."""
+        exists = self._db.execute("SELECT 1 FROM sqlite_master WHERE name = 'turns_fts'").fetchone()
+        if exists:
+            return True, False
+        try:
+            self._db.execute(_FTS_SCHEMA)
+            self._db.commit()
+            return True, True
+        except sqlite3.OperationalError as e:
+            print(f"Chat search is disabled (SQLite has no FTS5): {e}")
+            return False, False
+
+    # --- Writes (queued) ---
+
+    def create_session(self, model: str, chat_mode: str, use_gpu: bool, system_prompt: str) -> str:
+        """Returns the new session's id at once; the row is written in the background."""
+        session_id = uuid.uuid4().hex
+        now = time.time()
+        self._writes.put(('create', (session_id, model, chat_mode, int(use_gpu), system_prompt, now, now)))
+        return session_id
+
+    def append_turn(self, session_id: str, prompt: str, user_message: dict, reply: str,
+                    model: str, system_prompt: str, parent_id: int | None, seq: int) -> int:
+        """
+        Saves a turn following `parent_id` (None for a first turn), `seq` turns
+        deep, and makes it the session's head. Returns the new turn's id.
+        """
+        turn_id = self._reserve_turn_id()
+        images = [_image_entry(img) for img in user_message.get('images') or []]
+        turn = {
+            'id': turn_id, 'parent_id': parent_id, 'seq': seq, 'prompt': prompt,
+            'user_content': user_message['content'], 'reply': reply, 'model': model,
+            'system_prompt': system_prompt, 'created': time.time(), 'images': images,
+        }
+        self._writes.put(('turn', (session_id, turn)))
+        return turn_id
+
+    def _reserve_turn_id(self) -> int:
+        """
+        A new turn id, so a turn can be branched from before it is written. Ids
+        come from the database rather than a counter in this process, so two
+        windows (or the server) sharing the file never hand out the same one.
+        """
+        with self._read_lock:
+            turn_id = self._db.execute("INSERT INTO turn_ids DEFAULT VALUES").lastrowid
+            self._db.execute("DELETE FROM turn_ids WHERE id = ?", (turn_id,))
+            self._db.commit()
+        return turn_id
+
+    def set_head(self, session_id: str, turn_id: int):
+        """Makes the branch ending at `turn_id` the one a reopened session shows."""
+        self._writes.put(('head', (session_id, turn_id)))
+
+    def delete_session(self, session_id: str):
+        self._writes.put(('delete', session_id))
+
+    def flush(self, timeout: float | None = None) -> bool:
+        """Waits until everything queued so far is on disk."""
+        done = threading.Event()
+        self._writes.put(('flush', done))
+        return done.wait(timeout)
+
+    def close(self):
+        self._writes.put(None)
+        self._writer.join()
+        with self._read_lock:
+            self._db.close()
+        with self._search_lock:
+            self._search_db.close()
+
+    def _write_loop(self):
+        db = sqlite3.connect(self.db_path, isolation_level=None) # Transactions are managed below
+        db.execute("PRAGMA synchronous=NORMAL") # Safe in WAL mode; a crash loses at most the last commit
+        running = True
+        while running:
+            items = [self._writes.get()]
+            while True:
+                try:
+                    items.append(self._writes.get_nowait())
+                except queue.Empty:
+                    break
+            writes, flushed = [], []
+            for item in items:
+                if item is None:
+                    running = False
+                elif item[0] == 'flush':
+                    flushed.append(item[1])
+                else:
+                    writes.append(item)
+            try:
+                # Everything waiting is written in one transaction, each item in its own
+                # savepoint: one that fails is dropped without losing the rest of the batch
+                if writes:
+                    db.execute("BEGIN IMMEDIATE") # Waits out another process's write instead of failing
+                    for kind, args in writes:
+                        db.execute("SAVEPOINT item")
+                        try:
+                            getattr(self, f"_write_{kind}")(db, args)
+                        except Exception as e:
+                            print(f"Error saving chat history ({kind}): {e}")
+                            db.execute("ROLLBACK TO item")
+                        db.execute("RELEASE item")
+                    db.execute("COMMIT")
+            except Exception as e:
+                print(f"Error saving chat history: {e}")
+                if db.in_transaction:
+                    db.execute("ROLLBACK")
+            finally:
+                # Whoever is waiting on a flush or close is never left hanging
+                for done in flushed:
+                    done.set()
+        db.close()
+
+    def _write_create(self, db, row: tuple):
+        db.execute(
+            "INSERT OR IGNORE INTO sessions (id, model, chat_mode, use_gpu, system_prompt, created, updated)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?)", row
+        )
+
+    def _write_turn(self, db, args: tuple):
+        session_id, turn = args
+        turn_id = turn['id']
+        db.execute(
+            "INSERT INTO turns (id, session_id, parent_id, seq, prompt, user_content, reply, model, created)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (turn_id, session_id, turn['parent_id'], turn['seq'], turn['prompt'], turn['user_content'],
+             turn['reply'], turn['model'], turn['created'])
+        )
+        if self.search_available:
+            db.execute("INSERT INTO turns_fts (rowid, user_content, reply) VALUES (?, ?, ?)",
+                       (turn_id, turn['user_content'], turn['reply']))
+        for position, (digest, data) in enumerate(turn['images']):
+            if db.execute("SELECT 1 FROM blobs WHERE digest = ?", (digest,)).fetchone() is None:
+                db.execute("INSERT INTO blobs (digest, data, size) VALUES (?, ?, ?)", (digest, data, len(data)))
+            db.execute("INSERT INTO turn_images (turn_id, position, digest) VALUES (?, ?, ?)",
+                       (turn_id, position, digest))
+        title = " ".join(turn['prompt'].split())[:TITLE_CHARS]
+        db.execute(
+            "UPDATE sessions SET updated = ?, turns = ?, head_id = ?, model = ?, system_prompt = ?,"
+            " title = CASE WHEN title = '' THEN ? ELSE title END WHERE id = ?",
+            (turn['created'], turn['seq'], turn_id, turn['model'], turn['system_prompt'], title, session_id)
+        )
+
+    def _write_head(self, db, args: tuple):
+        session_id, turn_id = args
+        db.execute(
+            "UPDATE sessions SET head_id = ?, turns = COALESCE((SELECT seq FROM turns WHERE id = ?), turns),"
+            " updated = ? WHERE id = ?", (turn_id, turn_id, time.time(), session_id)
+        )
+
+    def _write_reindex(self, db, _):
+        db.execute("INSERT INTO turns_fts (turns_fts) VALUES ('rebuild')")
+
+    def _write_delete(self, db, session_id: str):
+        if self.search_available:
+            # External-content index: entries are removed with the values they were indexed with
+            db.execute(
+                "INSERT INTO turns_fts (turns_fts, rowid, user_content, reply)"
+                " SELECT 'delete', id, user_content, reply FROM turns WHERE session_id = ?", (session_id,)
+            )
+        db.execute("DELETE FROM turn_images WHERE turn_id IN (SELECT id FROM turns WHERE session_id = ?)", (session_id,))
+        db.execute("DELETE FROM turns WHERE session_id = ?", (session_id,))
+        db.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+        db.execute("DELETE FROM blobs WHERE digest NOT IN (SELECT digest FROM turn_images)")
+
+    # --- Reads ---
+
+    def list_sessions(self, limit: int = SESSION_LIST_LIMIT) -> list:
+        """The most recently used sessions that have at least one turn, newest first."""
+        with self._read_lock:
+            rows = self._db.execute(
+                "SELECT id, title, model, chat_mode, use_gpu, updated, turns FROM sessions"
+                " WHERE turns > 0 ORDER BY updated DESC LIMIT ?", (limit,)
+            ).fetchall()
+        return [
+            {'id': r[0], 'title': r[1], 'model': r[2], 'chat_mode': r[3], 'use_gpu': bool(r[4]),
+             'updated': r[5], 'turns': r[6]}
+            for r in rows
+        ]
+
+    def search(self, text: str, limit: int = SEARCH_RESULT_LIMIT) -> list:
+        """
+        Turns of any saved chat matching every word of `text` (if none do, any
+        of them), best match first: [{'session_id', 'turn_id', 'seq', 'title',
+        'snippet', 'created'}, ...]. Safe to call from any thread.
+        """
+        if not self.search_available:
+            return []
+        rows = self._search(_match_query(text), limit)
+        if not rows and len(re.findall(r"\w+", text)) > 1:
+            rows = self._search(_match_query(text, any_word=True), limit)
+        return [
+            {'session_id': r[0], 'turn_id': r[1], 'seq': r[2], 'title': r[3], 'created': r[4],
+             'snippet': " ".join(r[5].split())}
+            for r in rows
+        ]
+
+    def _search(self, query: str | None, limit: int) -> list:
+        if query is None:
+            return []
+        with self._search_lock:
+            try:
+                return self._search_db.execute(
+                    "SELECT t.session_id, t.id, t.seq, s.title, t.created,"
+                    " snippet(turns_fts, -1, '[', ']', '...', 12)"
+                    " FROM turns_fts JOIN turns t ON t.id = turns_fts.rowid JOIN sessions s ON s.id = t.session_id"
+                    " WHERE turns_fts MATCH ? ORDER BY rank LIMIT ?", (query, limit)
+                ).fetchall()
+            except sqlite3.OperationalError as e:
+                print(f"Error searching chats: {e}")
+                return []
+
+    def load_session(self, session_id: str) -> dict | None:
+        """The session's settings, its head turn and how deep that turn is ('depth')."""
+        with self._read_lock:
+            row = self._db.execute(
+                "SELECT s.title, s.model, s.chat_mode, s.use_gpu, s.system_prompt, s.head_id, COALESCE(t.seq, 0)"
+                " FROM sessions s LEFT JOIN turns t ON t.id = s.head_id WHERE s.id = ?", (session_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {'id': session_id, 'title': row[0], 'model': row[1], 'chat_mode': row[2],
+                'use_gpu': bool(row[3]), 'system_prompt': row[4], 'head_id': row[5], 'depth': row[6]}
+
+    def load_turns(self, session_id: str, before_id: int | None = None, limit: int = SESSION_LOAD_TURNS,
+                   head_id: int | None = None) -> list:
+        """
+        Up to `limit` turns of one branch, oldest first: those leading up to
+        `before_id`, or else the last ones up to `head_id` (default: the
+        session's head). Images come back as attachment-store handles, and
+        'versions' lists the ids of each turn's saved versions (itself included).
+        """
+        with self._read_lock:
+            if before_id is not None:
+                start = self._db.execute("SELECT parent_id FROM turns WHERE id = ?", (before_id,)).fetchone()
+            elif head_id is not None:
+                start = (head_id,)
+            else:
+                start = self._db.execute("SELECT head_id FROM sessions WHERE id = ?", (session_id,)).fetchone()
+            if start is None or start[0] is None or limit <= 0:
+                return []
+            rows = self._db.execute(
+                "WITH RECURSIVE path(id, n) AS ("
+                " SELECT ?, 1 UNION ALL"
+                " SELECT t.parent_id, path.n + 1 FROM turns t JOIN path ON t.id = path.id"
+                " WHERE t.parent_id IS NOT NULL AND path.n < ?)"
+                " SELECT t.id, t.parent_id, t.seq, t.prompt, t.user_content, t.reply, t.model, t.created,"
+                " (SELECT group_concat(v.id) FROM turns v WHERE v.session_id = t.session_id AND v.parent_id IS t.parent_id)"
+                " FROM path JOIN turns t ON t.id = path.id ORDER BY path.n DESC", (start[0], limit)
+            ).fetchall()
+            images = {}
+            if rows:
+                marks = ",".join("?" * len(rows))
+                for turn_id, digest, data in self._db.execute(
+                    "SELECT t.turn_id, t.digest, b.data FROM turn_images t JOIN blobs b ON b.digest = t.digest"
+                    f" WHERE t.turn_id IN ({marks}) ORDER BY t.turn_id, t.position", [r[0] for r in rows]
+                ):
+                    images.setdefault(turn_id, []).append((digest, data))
+
+        store = get_attachment_store()
+        turns = []
+        for turn_id, parent_id, seq, prompt, user_content, reply, model, created, versions in rows:
+            handles = [
+                store.get(digest) or store.put(StoredAttachment(digest, image=data))
+                for digest, data in images.get(turn_id, [])
+            ]
+            turns.append({'id': turn_id, 'parent_id': parent_id, 'seq': seq, 'prompt': prompt,
+                          'user_content': user_content, 'reply': reply, 'model': model,
+                          'created': created, 'images': handles,
+                          'versions': sorted(int(v) for v in versions.split(","))})
+        return turns
+
+    # --- Branches ---
+
+    def branch_leaf(self, turn_id: int) -> tuple | None:
+        """(id, seq) of the last turn of the newest branch through `turn_id`."""
+        with self._read_lock:
+            return self._db.execute(
+                "WITH RECURSIVE down(id) AS ("
+                " SELECT ? UNION ALL"
+                " SELECT (SELECT MAX(c.id) FROM turns c WHERE c.parent_id = down.id) FROM down"
+                " WHERE down.id IS NOT NULL)"
+                " SELECT t.id, t.seq FROM down JOIN turns t ON t.id = down.id ORDER BY t.seq DESC LIMIT 1",
+                (turn_id,)
+            ).fetchone()
+
+    def on_branch(self, head_id: int | None, turn_id: int) -> bool:
+        """Whether `turn_id` is on the branch ending at `head_id`."""
+        if head_id is None:
+            return False
+        with self._read_lock:
+            return self._db.execute(
+                "WITH RECURSIVE path(id) AS ("
+                " SELECT ? UNION ALL SELECT t.parent_id FROM turns t JOIN path ON t.id = path.id"
+                " WHERE t.parent_id IS NOT NULL)"
+                " SELECT 1 FROM path WHERE id = ? LIMIT 1", (head_id, turn_id)
+            ).fetchone() is not None
+
+
+_shared_store = None
+_shared_store_failed = False
+_shared_store_lock = threading.Lock()
+
+def get_session_store() -> SessionStore | None:
+    """Returns the process-wide store (None if it can't be opened; history is then not saved)."""
+    global _shared_store, _shared_store_failed
+    with _shared_store_lock:
+        if _shared_store is None and not _shared_store_failed:
+            try:
+                _shared_store = SessionStore()
+            except (sqlite3.Error, OSError) as e:
+                print(f"Error opening chat history, conversations will not be saved: {e}")
+                _shared_store_failed = True
+        return _shared_store
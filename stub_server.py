@@ -0,0 +1,310 @@
+"""
+A small local stand-in for the Ollama HTTP API.
+
+It speaks just enough of the protocol (/api/chat, /api/embed, /api/tags,
+/api/ps) for the load generator and other headless tools to run without a
+real model server. Prompt evaluation and decoding are simulated with configurable
+token rates, and a fixed number of "slots" models how a real server queues
+concurrent requests.
+
+Run standalone:
+    python stub_server.py --port 11500 --decode-rate 40
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import zlib
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from config import ALL_MODELS, VLM_PREFIX, LLM_PREFIX
+
+# Neutral filler vocabulary (must never trip FORBIDDEN_KEYWORDS)
+_REPLY_WORDS = (
+    "the quick brown fox jumps over a lazy dog while local models "
+    "stream tokens across the wire and every request waits its turn"
+).split()
+
+
+def _default_models() -> list:
+    models = []
+    for formatted in ALL_MODELS:
+        for prefix in (VLM_PREFIX, LLM_PREFIX):
+            if formatted.startswith(prefix):
+                models.append(formatted[len(prefix):])
+    return models
+
+
+def _now_iso() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+def _estimate_tokens(text: str) -> int:
+    # Rough heuristic: ~4 characters per token
+    return max(1, len(text) // 4)
+
+
+class StubSettings:
+    """Tunable behaviour of a stand-in server."""
+    def __init__(self, prompt_rate=400.0, decode_rate=30.0, reply_tokens=64,
+                 slots=1, error_rate=0.0, models=None, load_time=0.0, cpu_cores=None):
+        self.prompt_rate = prompt_rate      # prompt tokens evaluated per second
+        self.decode_rate = decode_rate      # generated tokens per second
+        self.reply_tokens = reply_tokens    # tokens per reply
+        self.slots = max(1, slots)          # concurrent generations
+        self.error_rate = error_rate        # fraction of requests answered with HTTP 500
+        self.models = list(models) if models else _default_models()
+        self.load_time = load_time          # simulated cold-load time per model
+        self.cpu_cores = cpu_cores          # if set, num_thread/num_batch change the rates (for autotune)
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    # --- Helpers ---
+
+    def log_message(self, format, *args):
+        pass # Keep the console quiet under load
+
+    def _read_json(self) -> dict:
+        length = int(self.headers.get('Content-Length') or 0)
+        if not length:
+            return {}
+        try:
+            return json.loads(self.rfile.read(length))
+        except ValueError:
+            return {}
+
+    def _send_json(self, payload: dict, status: int = 200):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, status: int, message: str):
+        self._send_json({'error': message}, status)
+
+    # --- Routes ---
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        if self.path == '/':
+            body = b"Ollama is running"
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif self.path == '/api/tags':
+            self._send_json({'models': [self._model_entry(m) for m in self.server.settings.models]})
+        elif self.path == '/api/ps':
+            with self.server.state_lock:
+                loaded = list(self.server.loaded_models)
+            self._send_json({'models': [self._model_entry(m) for m in loaded]})
+        else:
+            self._send_error(404, f"unknown path {self.path}")
+
+    def do_POST(self):
+        request = self._read_json()
+        if self.path == '/api/chat':
+            self._handle_chat(request)
+        elif self.path == '/api/embed':
+            self._handle_embed(request)
+        else:
+            self._send_error(404, f"unknown path {self.path}")
+
+    def _model_entry(self, name: str) -> dict:
+        return {
+            'name': name, 'model': name, 'size': 0, 'digest': '',
+            'modified_at': _now_iso(),
+            'details': {'format': 'gguf', 'family': name.split(':')[0]},
+        }
+
+    # --- Embeddings ---
+
+    def _handle_embed(self, request: dict):
+        """Bag-of-words hashing embeddings: similar wording gives similar vectors."""
+        inputs = request.get('input') or ''
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        embeddings = []
+        for text in inputs:
+            vector = [0.0] * 64
+            for word in text.lower().split():
+                vector[zlib.crc32(word.strip('.,!?').encode('utf-8')) % 64] += 1.0
+            embeddings.append(vector)
+        self._send_json({'model': request.get('model', ''), 'embeddings': embeddings})
+
+    # --- Chat Simulation ---
+
+    def _handle_chat(self, request: dict):
+        settings = self.server.settings
+        model = request.get('model', '')
+        if model not in settings.models:
+            self._send_error(404, f"model '{model}' not found")
+            return
+        if settings.error_rate and random.random() < settings.error_rate:
+            self._send_error(500, "simulated server error")
+            return
+
+        messages = request.get('messages') or []
+        prompt_text = "".join(str(m.get('content', '')) for m in messages)
+        prompt_tokens = _estimate_tokens(prompt_text)
+        options = request.get('options') or {}
+        prompt_rate, decode_rate = self._effective_rates(options)
+        n_predict = options.get('num_predict')
+        reply_tokens = settings.reply_tokens if n_predict is None or n_predict < 0 else int(n_predict)
+        stream = request.get('stream', True)
+
+        start = time.perf_counter()
+        # Wait for a free generation slot, like a real server queue
+        with self.server.slots:
+            load_duration = self._load_model(model)
+            prompt_eval = prompt_tokens / prompt_rate
+            time.sleep(prompt_eval)
+
+            words = [random.choice(_REPLY_WORDS) for _ in range(reply_tokens)]
+            if stream:
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/x-ndjson')
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+            eval_start = time.perf_counter()
+            for i, word in enumerate(words):
+                time.sleep(1.0 / decode_rate)
+                if stream:
+                    token = word if i == 0 else f" {word}"
+                    try:
+                        self._write_chunk({
+                            'model': model, 'created_at': _now_iso(),
+                            'message': {'role': 'assistant', 'content': token},
+                            'done': False,
+                        })
+                    except (BrokenPipeError, ConnectionResetError):
+                        return # Client cancelled
+            eval_duration = time.perf_counter() - eval_start
+
+        final = {
+            'model': model, 'created_at': _now_iso(),
+            'message': {'role': 'assistant', 'content': '' if stream else " ".join(words) + "."},
+            'done': True, 'done_reason': 'stop',
+            'total_duration': int((time.perf_counter() - start) * 1e9),
+            'load_duration': int(load_duration * 1e9),
+            'prompt_eval_count': prompt_tokens,
+            'prompt_eval_duration': int(prompt_eval * 1e9),
+            'eval_count': reply_tokens,
+            'eval_duration': int(eval_duration * 1e9),
+        }
+        if stream:
+            try:
+                self._write_chunk(final)
+                self.wfile.write(b"0\r\n\r\n")
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+        else:
+            self._send_json(final)
+
+    def _effective_rates(self, options: dict) -> tuple[float, float]:
+        """Crude CPU model: prompt eval scales with threads, decode stops at the physical cores."""
+        settings = self.server.settings
+        if not settings.cpu_cores:
+            return settings.prompt_rate, settings.decode_rate
+        logical = settings.cpu_cores
+        physical = max(1, logical // 2)
+        threads = max(1, int(options.get('num_thread') or logical))
+        prompt_scale = min(threads, logical) / logical
+        decode_scale = min(threads, physical) / physical
+        if threads > physical:
+            decode_scale *= 0.9 # SMT siblings fight over memory bandwidth
+        if threads > logical:
+            prompt_scale *= logical / threads
+            decode_scale *= logical / threads
+        batch = int(options.get('num_batch') or 512)
+        prompt_scale *= 0.6 + 0.4 * min(batch, 512) / 512
+        return settings.prompt_rate * prompt_scale, settings.decode_rate * decode_scale
+
+    def _load_model(self, model: str) -> float:
+        with self.server.state_lock:
+            if model in self.server.loaded_models:
+                return 0.0
+            self.server.loaded_models.append(model)
+        time.sleep(self.server.settings.load_time)
+        return self.server.settings.load_time
+
+    def _write_chunk(self, payload: dict):
+        data = (json.dumps(payload) + "\n").encode('utf-8')
+        self.wfile.write(f"{len(data):X}\r\n".encode('ascii') + data + b"\r\n")
+        self.wfile.flush()
+
+
+class StubOllamaServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, settings: StubSettings):
+        super().__init__(address, _StubHandler)
+        self.settings = settings
+        self.slots = threading.BoundedSemaphore(settings.slots)
+        self.state_lock = threading.Lock()
+        self.loaded_models = []
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+
+def start_stub_server(host: str = "127.0.0.1", port: int = 0,
+                      settings: StubSettings | None = None) -> StubOllamaServer:
+    """Starts a stand-in server on a daemon thread. Use port 0 for a free port."""
+    server = StubOllamaServer((host, port), settings or StubSettings())
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def add_stub_arguments(parser: argparse.ArgumentParser):
+    """Adds the stand-in server tuning flags to an argument parser."""
+    parser.add_argument("--stub-prompt-rate", type=float, default=400.0,
+                        help="Simulated prompt-eval speed (tokens/s).")
+    parser.add_argument("--stub-decode-rate", type=float, default=30.0,
+                        help="Simulated decode speed (tokens/s).")
+    parser.add_argument("--stub-reply-tokens", type=int, default=64,
+                        help="Tokens per simulated reply.")
+    parser.add_argument("--stub-slots", type=int, default=1,
+                        help="Concurrent generations the stand-in serves.")
+    parser.add_argument("--stub-error-rate", type=float, default=0.0,
+                        help="Fraction of requests that fail with HTTP 500.")
+
+
+def settings_from_args(args, models=None) -> StubSettings:
+    return StubSettings(
+        prompt_rate=args.stub_prompt_rate,
+        decode_rate=args.stub_decode_rate,
+        reply_tokens=args.stub_reply_tokens,
+        slots=args.stub_slots,
+        error_rate=args.stub_error_rate,
+        models=models,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the Ollama API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11500)
+    parser.add_argument("--models", nargs="*", help="Models to advertise (default: config lists).")
+    add_stub_arguments(parser)
+    args = parser.parse_args()
+
+    server = StubOllamaServer((args.host, args.port), settings_from_args(args, args.models))
+    print(f"Stub Ollama server listening on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Stopping stub server.")
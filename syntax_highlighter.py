@@ -0,0 +1,132 @@
+"""
+Syntax highlighting for chat code blocks, off the Tk thread.
+
+Lexing a long block with Pygments takes long enough to freeze the window, so
+it runs on a worker thread and produces, for every style tag, the character
+ranges it covers. The Tk side inserts the plain code at once and applies
+each tag with a single tag_add call when the ranges arrive.
+
+Lexers are cached per language. Code without a fence language is guessed
+from a few cheap content checks instead of Pygments' guess_lexer (which
+runs every lexer it knows). Each style's tag table is computed once.
+"""
+import re
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
+
+from config import CODE_HIGHLIGHT_STYLE
+
+# --- Pygments Import ---
+try:
+    from pygments import lex
+    from pygments.lexers import get_lexer_by_name
+    from pygments.styles import get_style_by_name
+    from pygments.util import ClassNotFound
+    PYGMENTS_AVAILABLE = True
+except ImportError:
+    PYGMENTS_AVAILABLE = False
+
+# Checked in order against the start of the block; the first match wins
+_GUESS_RULES = [
+    (re.compile(r"\A#!.*\bpython"), "python"),
+    (re.compile(r"\A#!.*\b(ba|z)?sh\b"), "bash"),
+    (re.compile(r"\A#!.*\bnode\b"), "javascript"),
+    (re.compile(r"\A\s*<\?php"), "php"),
+    (re.compile(r"\A\s*<\?xml"), "xml"),
+    (re.compile(r"\A\s*(<!DOCTYPE html|<html[\s>])|<(div|span|body|head)[\s>]", re.IGNORECASE), "html"),
+    (re.compile(r"\A\s*[\[{]\s*(\"|\]|\}|$)"), "json"),
+    (re.compile(r"^\s*#include\s*[<\"]", re.MULTILINE), "cpp"),
+    (re.compile(r"^package \w+\s*$|^func (\(\w+ \*?\w+\) )?\w+\(", re.MULTILINE), "go"),
+    (re.compile(r"^\s*(pub )?fn \w+|\blet mut\b", re.MULTILINE), "rust"),
+    (re.compile(r"^\s*(public|private|protected)\s+(static\s+)?(class|interface|void|int|String)\b", re.MULTILINE), "java"),
+    (re.compile(r"^\s*(async )?(def|class) \w+.*:\s*$|^\s*(from [\w.]+ )?import \w+|^\s*print\(", re.MULTILINE), "python"),
+    (re.compile(r"^\s*(const|let|var|function|export|import)\b|=>|console\.log", re.MULTILINE), "javascript"),
+    (re.compile(r"^\s*(SELECT|INSERT INTO|UPDATE|DELETE FROM|CREATE (TABLE|INDEX))\b", re.MULTILINE | re.IGNORECASE), "sql"),
+    (re.compile(r"^\s*(\$ |sudo |apt(-get)? |pip |npm |cd |ls |echo |export |git )", re.MULTILINE), "bash"),
+    (re.compile(r"^[\w.-]+:(\s.*)?$\n^\s+[\w.-]+:", re.MULTILINE), "yaml"),
+]
+_GUESS_SAMPLE_CHARS = 4000
+
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="highlight")
+
+
+def guess_language(code: str) -> str:
+    """A cheap guess at the language of unlabelled code ("text" if nothing matches)."""
+    sample = code[:_GUESS_SAMPLE_CHARS]
+    for pattern, language in _GUESS_RULES:
+        if pattern.search(sample):
+            return language
+    return "text"
+
+
+@lru_cache(maxsize=64)
+def get_lexer(language: str):
+    # No newline stripping/adding, so token offsets match the inserted text
+    try:
+        return get_lexer_by_name(language, stripnl=False, ensurenl=False)
+    except ClassNotFound:
+        return get_lexer_by_name("text", stripnl=False, ensurenl=False)
+
+
+@lru_cache(maxsize=8)
+def style_table(style_name: str = CODE_HIGHLIGHT_STYLE) -> dict:
+    """Tag name (a token type) -> Text tag options, for every token the style colours."""
+    try:
+        style = get_style_by_name(style_name)
+    except ClassNotFound:
+        style = get_style_by_name('default')
+
+    table = {}
+    for token, opts in style.list_styles():
+        kwargs = {}
+        if opts['color']: kwargs['foreground'] = '#' + opts['color']
+        if opts['bgcolor']: kwargs['background'] = '#' + opts['bgcolor']
+        if opts['bold']: kwargs['font'] = ("Consolas", 11, "bold")
+        if kwargs:
+            table[str(token)] = kwargs
+    return table
+
+
+def highlight_ranges(code: str, language: str | None, style_name: str = CODE_HIGHLIGHT_STYLE) -> dict:
+    """
+    Lexes `code` and returns {tag: [start, end, start, end, ...]} character
+    offsets. Tokens the style doesn't colour take their nearest coloured
+    parent's tag, and touching runs of one tag are merged.
+    """
+    table = style_table(style_name)
+    lexer = get_lexer((language or "").strip().lower() or guess_language(code))
+
+    resolved = {} # token type -> tag (or None), looked up once per type
+    ranges = {}
+    offset = 0
+    for token, text in lex(code, lexer):
+        end = offset + len(text)
+        if token not in resolved:
+            styled = token
+            while str(styled) not in table and styled.parent is not None:
+                styled = styled.parent
+            resolved[token] = str(styled) if str(styled) in table else None
+        tag = resolved[token]
+        if tag is not None and text:
+            spans = ranges.setdefault(tag, [])
+            if spans and spans[-1] == offset:
+                spans[-1] = end
+            else:
+                spans.extend((offset, end))
+        offset = end
+    return ranges
+
+
+@lru_cache(maxsize=64)
+def _cached_ranges(code: str, language: str | None, style_name: str) -> dict:
+    # Virtualized code blocks are rebuilt when scrolled back into view; don't lex them twice
+    return highlight_ranges(code, language, style_name)
+
+
+def highlight_async(code: str, language: str | None, style_name: str = CODE_HIGHLIGHT_STYLE,
+                    cache: bool = True) -> Future:
+    """
+    Lexes on the highlighter thread. The Future's result is highlight_ranges().
+    Pass cache=False for code that is still growing (a block being streamed).
+    """
+    return _executor.submit(_cached_ranges if cache else highlight_ranges, code, language, style_name)
@@ -1,6 +1,20 @@
 import os
+import io
+import math
+import mmap
 import pypdf
-from config import PDF_FUNCTIONALITY_DISABLED
+from PIL import Image, features
+from config import (
+    PASTED_IMAGE_FORMAT, PASTED_IMAGE_MAX_SIDE, PASTED_IMAGE_PNG_COMPRESS_LEVEL, PASTED_IMAGE_QUALITY,
+    PDF_FUNCTIONALITY_DISABLED, TEXT_ATTACHMENT_MAX_TOKENS, CHARS_PER_TOKEN,
+    TEXT_HEAD_FRACTION, TEXT_TAIL_FRACTION, LOG_MATCH_KEYWORDS
+)
+
+BINARY_SNIFF_BYTES = 8192
+SCAN_CHUNK_BYTES = 8 * 1024 * 1024
+MIN_MATCH_LINE_BYTES = 80 # Matching stops once the budget left can't hold a line this long
+_LOG_KEYWORDS = [k.lower().encode('utf-8') for k in LOG_MATCH_KEYWORDS]
+_NON_CONTROL_BYTES = bytes(b for b in range(256) if b >= 32 or b in (9, 10, 12, 13, 27))
 
 def read_image_bytes_from_file(image_path: str) -> bytes | None:
     """Reads an image file and returns its binary content (bytes)."""
@@ -14,6 +28,37 @@ def read_image_bytes_from_file(image_path: str) -> bytes | None:
         print(f"Error reading image file {image_path}: {e}")
         return None
 
+def encode_image(image, fmt: str = PASTED_IMAGE_FORMAT, max_side: int = PASTED_IMAGE_MAX_SIDE,
+                 quality: int = PASTED_IMAGE_QUALITY,
+                 compress_level: int = PASTED_IMAGE_PNG_COMPRESS_LEVEL) -> bytes:
+    """
+    Encodes an in-memory PIL image (e.g. a pasted screenshot) for the model:
+    optionally downscaled so its longest side is at most `max_side`, then
+    saved as PNG (at a fast compress level), JPEG or WebP. Vision models
+    work on a few hundred pixels per side, so the downscale loses little.
+    """
+    fmt = fmt.upper()
+    if fmt == "WEBP" and not features.check('webp'):
+        fmt = "PNG" # Pillow built without WebP support
+
+    if max_side and max(image.size) > max_side:
+        # Integer box reduction: ~10x faster than a resampling filter on 5K screenshots
+        image = image.reduce(math.ceil(max(image.size) / max_side))
+
+    with io.BytesIO() as output:
+        if fmt == "JPEG":
+            if image.mode != "RGB":
+                # JPEG has no alpha: flatten onto white
+                background = Image.new("RGB", image.size, (255, 255, 255))
+                background.paste(image, mask=image.getchannel("A") if "A" in image.getbands() else None)
+                image = background
+            image.save(output, format="JPEG", quality=quality)
+        elif fmt == "WEBP":
+            image.save(output, format="WEBP", quality=quality, method=0)
+        else:
+            image.save(output, format="PNG", compress_level=compress_level)
+        return output.getvalue()
+
 def read_text_file(file_path: str) -> str | None:
     """Reads a text-based file and returns its content."""
     try:
@@ -24,6 +69,146 @@ def read_text_file(file_path: str) -> str | None:
         print(f"Error reading text file {file_path}: {e}")
         return None
 
+def looks_binary(sample: bytes) -> bool:
+    """NUL bytes or lots of control characters mean the data is not text."""
+    if not sample:
+        return False
+    if b"\x00" in sample:
+        return True
+    control = len(sample.translate(None, _NON_CONTROL_BYTES)) # Deletes everything else, in C
+    return control / len(sample) > 0.1
+
+def is_binary_file(file_path: str) -> bool:
+    """Sniffs the start of a file (via mmap, without reading it all) for binary content."""
+    try:
+        with open(file_path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return False
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return looks_binary(mm[:BINARY_SNIFF_BYTES])
+    except (OSError, ValueError) as e:
+        print(f"Error sniffing file {file_path}: {e}")
+        return False
+
+def format_size(n_bytes: int) -> str:
+    for unit in ("B", "KB", "MB"):
+        if n_bytes < 1024:
+            return f"{n_bytes:.0f} {unit}"
+        n_bytes /= 1024
+    return f"{n_bytes:.1f} GB"
+
+def _matching_line_starts(chunk: bytes) -> list:
+    """Start offsets of the lines in `chunk` that contain a LOG_MATCH_KEYWORDS word."""
+    lowered = chunk.lower()
+    starts = set()
+    for keyword in _LOG_KEYWORDS:
+        pos = lowered.find(keyword)
+        while pos != -1:
+            line_start = lowered.rfind(b"\n", 0, pos) + 1
+            starts.add(line_start)
+            # Continue after this line: one hit per line is enough
+            line_end = lowered.find(b"\n", pos)
+            if line_end == -1:
+                break
+            pos = lowered.find(keyword, line_end)
+    return sorted(starts)
+
+def _sample_buffer(buf, size: int, max_bytes: int) -> tuple[str, str]:
+    """
+    Samples a buffer larger than max_bytes as head + tail + lines from the
+    middle that contain LOG_MATCH_KEYWORDS. Works on bytes and mmap objects
+    alike; the middle is scanned in bounded chunks, so memory use stays flat
+    however large the file is.
+    """
+    head_budget = int(max_bytes * TEXT_HEAD_FRACTION)
+    tail_budget = int(max_bytes * TEXT_TAIL_FRACTION)
+    match_budget = max_bytes - head_budget - tail_budget
+
+    # Head: up to the last full line within the budget
+    head_end = buf.rfind(b"\n", 0, head_budget) + 1 or head_budget
+    # Tail: from the first full line within the budget
+    tail_start = buf.find(b"\n", size - tail_budget, size) + 1 or size - tail_budget
+    tail_start = max(tail_start, head_end)
+
+    matched_lines = []
+    matched_bytes = 0
+    skipped_lines = 0
+    budget_hit = False
+    pos = head_end
+    while pos < tail_start and not budget_hit:
+        # End each chunk after its last full line, so a line straddling the boundary starts
+        # the next chunk. A line longer than a whole chunk (minified JSON, one-line dumps)
+        # is cut at the chunk size rather than read whole.
+        chunk_end = min(pos + SCAN_CHUNK_BYTES, tail_start)
+        if chunk_end < tail_start:
+            line_end = buf.rfind(b"\n", pos, chunk_end)
+            if line_end != -1:
+                chunk_end = line_end + 1
+        chunk = buf[pos:chunk_end]
+        for line_start in _matching_line_starts(chunk):
+            line_end = chunk.find(b"\n", line_start)
+            line = chunk[line_start:] if line_end == -1 else chunk[line_start:line_end]
+            if matched_bytes + len(line) + 1 > match_budget:
+                # Too long for what is left (a stack trace or JSON line): skip it, shorter
+                # matching lines further on may still fit
+                skipped_lines += 1
+                if match_budget - matched_bytes < MIN_MATCH_LINE_BYTES:
+                    budget_hit = True
+                    break
+                continue
+            matched_lines.append(line)
+            matched_bytes += len(line) + 1
+        pos = chunk_end
+
+    head = buf[:head_end].decode('utf-8', errors='ignore')
+    tail = buf[tail_start:size].decode('utf-8', errors='ignore')
+    dropped = max(tail_start - head_end - matched_bytes, 0)
+
+    parts = [head]
+    if matched_lines:
+        parts.append(f"\n[... {len(matched_lines)} matching lines from the middle of the file ...]\n")
+        parts.append("\n".join(l.decode('utf-8', errors='ignore') for l in matched_lines) + "\n")
+    parts.append(f"\n[... {format_size(dropped)} omitted ...]\n")
+    parts.append(tail)
+
+    report = (f"kept the first {head.count(chr(10))} lines, the last {tail.count(chr(10))} lines and "
+              f"{len(matched_lines)}{'+' if budget_hit or skipped_lines else ''} matching lines of {format_size(size)}; "
+              f"dropped {format_size(dropped)}")
+    return "".join(parts), report
+
+def read_text_file_budgeted(file_path: str, max_tokens: int = TEXT_ATTACHMENT_MAX_TOKENS) -> tuple[str | None, str | None]:
+    """
+    Reads a text-based file within a token budget without loading it whole.
+
+    Returns:
+        tuple[str | None, str | None]: (content, report). content is None for
+        unreadable or binary files; report describes what was dropped, or is
+        None if the whole file fit.
+    """
+    max_bytes = max_tokens * CHARS_PER_TOKEN
+    try:
+        with open(file_path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                return "", None
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if looks_binary(mm[:BINARY_SNIFF_BYTES]):
+                    return None, "skipped: binary content"
+                if size <= max_bytes:
+                    return mm[:].decode('utf-8', errors='ignore'), None
+                return _sample_buffer(mm, size, max_bytes)
+    except (OSError, ValueError) as e:
+        print(f"Error reading text file {file_path}: {e}")
+        return None, None
+
+def sample_text(text: str, max_tokens: int = TEXT_ATTACHMENT_MAX_TOKENS) -> tuple[str, str | None]:
+    """Applies the same head + tail + matching-lines budget to in-memory text."""
+    data = text.encode('utf-8')
+    max_bytes = max_tokens * CHARS_PER_TOKEN
+    if len(data) <= max_bytes:
+        return text, None
+    return _sample_buffer(data, len(data), max_bytes)
+
 def extract_pdf_text(file_path: str) -> str | None:
     """Extracts text from a PDF file."""
     if PDF_FUNCTIONALITY_DISABLED: